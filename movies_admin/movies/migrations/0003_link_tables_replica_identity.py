@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Link tables log full old row on update/delete, so ETL change data capture knows which movie lost the link.
+    """
+
+    dependencies = [
+        ('movies', '0002_default_superuser'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE content.person_film_work REPLICA IDENTITY FULL;",
+            "ALTER TABLE content.person_film_work REPLICA IDENTITY DEFAULT;"
+        ),
+        migrations.RunSQL(
+            "ALTER TABLE content.genre_film_work REPLICA IDENTITY FULL;",
+            "ALTER TABLE content.genre_film_work REPLICA IDENTITY DEFAULT;"
+        ),
+    ]
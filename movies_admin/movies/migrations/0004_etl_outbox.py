@@ -0,0 +1,66 @@
+from django.db import migrations
+
+CREATE_OUTBOX = """
+CREATE TABLE IF NOT EXISTS content.etl_outbox (
+    id bigserial PRIMARY KEY,
+    entity text NOT NULL,
+    entity_id uuid NOT NULL,
+    created timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION content.etl_outbox_track() RETURNS trigger AS $$
+DECLARE
+    changed record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+
+    IF TG_TABLE_NAME = 'film_work' THEN
+        INSERT INTO content.etl_outbox (entity, entity_id) VALUES ('movie', changed.id);
+    ELSIF TG_TABLE_NAME = 'person' THEN
+        INSERT INTO content.etl_outbox (entity, entity_id) VALUES ('person', changed.id);
+    ELSIF TG_TABLE_NAME = 'genre' THEN
+        INSERT INTO content.etl_outbox (entity, entity_id) VALUES ('genre', changed.id);
+    ELSE
+        -- link tables: the movie gains or loses person or genre
+        INSERT INTO content.etl_outbox (entity, entity_id) VALUES ('movie', changed.film_work_id);
+        IF TG_OP = 'UPDATE' AND OLD.film_work_id <> NEW.film_work_id THEN
+            INSERT INTO content.etl_outbox (entity, entity_id) VALUES ('movie', OLD.film_work_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+DROP_OUTBOX = """
+DROP FUNCTION IF EXISTS content.etl_outbox_track() CASCADE;
+DROP TABLE IF EXISTS content.etl_outbox;
+"""
+TRACKED_TABLES = ("film_work", "person", "genre", "person_film_work", "genre_film_work")
+
+
+def create_trigger(table: str) -> migrations.RunSQL:
+    return migrations.RunSQL(
+        f"CREATE TRIGGER etl_outbox_track AFTER INSERT OR UPDATE OR DELETE ON content.{table} "
+        f"FOR EACH ROW EXECUTE FUNCTION content.etl_outbox_track();",
+        f"DROP TRIGGER IF EXISTS etl_outbox_track ON content.{table};"
+    )
+
+
+class Migration(migrations.Migration):
+    """
+    Outbox of changed movies, persons and genres for ETL. It's filled by triggers at content tables, including link
+    tables - so link deletions are tracked too.
+    """
+
+    dependencies = [
+        ('movies', '0003_link_tables_replica_identity'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_OUTBOX, DROP_OUTBOX),
+        *[create_trigger(table) for table in TRACKED_TABLES],
+    ]
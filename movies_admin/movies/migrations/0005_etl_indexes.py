@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0004_etl_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['modified', 'id'], name='genre_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['modified', 'id'], name='person_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='basefilmwork',
+            index=models.Index(fields=['modified', 'id'], name='film_work_modified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='personrole',
+            index=models.Index(fields=['person', 'film_work'], name='person_film_work_person_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genremovie',
+            index=models.Index(fields=['genre', 'film_work'], name='genre_film_work_genre_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+CREATE_LEASE = """
+CREATE TABLE IF NOT EXISTS content.etl_lease (
+    name text PRIMARY KEY,
+    holder text NOT NULL,
+    acquired_at timestamp with time zone NOT NULL,
+    renewed_at timestamp with time zone NOT NULL
+);
+"""
+DROP_LEASE = """
+DROP TABLE IF EXISTS content.etl_lease;
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    Leases of ETL pipelines - several ETL processes may run against the database, every pipeline is run by the
+    process holding its lease.
+    """
+
+    dependencies = [
+        ('movies', '0005_etl_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_LEASE, DROP_LEASE),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+TRACKED_TABLES = ("film_work", "person", "genre", "person_film_work", "genre_film_work")
+
+
+def disable_trigger(table: str) -> migrations.RunSQL:
+    return migrations.RunSQL(
+        f"ALTER TABLE content.{table} DISABLE TRIGGER etl_outbox_track;",
+        f"ALTER TABLE content.{table} ENABLE TRIGGER etl_outbox_track;"
+    )
+
+
+class Migration(migrations.Migration):
+    """
+    Outbox triggers are disabled until ETL is switched to outbox mode - otherwise nobody drains the outbox.
+    They are enabled by `postgres_to_es.py enable-outbox` and disabled again by `postgres_to_es.py disable-outbox`.
+    """
+
+    dependencies = [
+        ('movies', '0006_etl_lease'),
+    ]
+
+    operations = [
+        *[disable_trigger(table) for table in TRACKED_TABLES],
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Checkpoints of leased ETL pipelines - process which takes over the lease continues from them.
+    """
+
+    dependencies = [
+        ('movies', '0007_etl_outbox_triggers_disabled'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE content.etl_lease ADD COLUMN IF NOT EXISTS checkpoints jsonb;",
+            "ALTER TABLE content.etl_lease DROP COLUMN IF EXISTS checkpoints;"
+        ),
+    ]
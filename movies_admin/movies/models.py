@@ -26,6 +26,7 @@ class Genre(TimeStampedModel):
         verbose_name = _('жанр')
         verbose_name_plural = _('жанры')
         db_table = "content\".\"genre"
+        indexes = [models.Index(fields=['modified', 'id'], name='genre_modified_id_idx')]
 
     def __str__(self):
         return self.name
@@ -46,6 +47,7 @@ class Person(TimeStampedModel):
         verbose_name = _('участник')
         verbose_name_plural = _('участники')
         db_table = "content\".\"person"
+        indexes = [models.Index(fields=['modified', 'id'], name='person_modified_id_idx')]
 
     def __str__(self):
         return self.full_name
@@ -79,6 +81,7 @@ class BaseFilmwork(TimeStampedModel):
 
     class Meta:
         db_table = "content\".\"film_work"
+        indexes = [models.Index(fields=['modified', 'id'], name='film_work_modified_id_idx')]
 
     def _find_person_by_role(self, role) -> Person:
         for person in self.persons.all():
@@ -163,6 +166,7 @@ class PersonRole(models.Model):
     class Meta:
         db_table = "content\".\"person_film_work"
         unique_together = (('role', 'film_work', 'person'),)
+        indexes = [models.Index(fields=['person', 'film_work'], name='person_film_work_person_idx')]
 
 
 class GenreMovie(models.Model):
@@ -174,3 +178,4 @@ class GenreMovie(models.Model):
     class Meta:
         db_table = "content\".\"genre_film_work"
         unique_together = (('genre', 'film_work'),)
+        indexes = [models.Index(fields=['genre', 'film_work'], name='genre_film_work_genre_idx')]
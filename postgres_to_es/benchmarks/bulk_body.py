@@ -0,0 +1,85 @@
+"""
+Compares bulk body built as joined json.dumps strings (previous implementation) with body streamed by chunks of
+orjson-encoded actions. Reports serialization time and peak memory allocated while building body of one batch.
+Needs neither Postgres nor Elasticsearch. Launch from postgres_to_es folder:
+    python -m benchmarks.bulk_body
+"""
+import json
+import time
+import tracemalloc
+import uuid
+from typing import Callable, List
+
+from src.loading import BulkBatch
+
+BATCH_SIZES = (100, 1000, 10000)
+REPEATS = 5
+INDEX_NAME = "movies"
+
+
+def make_movie(cast_size: int = 20) -> dict:
+    persons = [{"id": str(uuid.uuid4()), "name": f"Person {i} Surname"} for i in range(cast_size)]
+    return {
+        "id": str(uuid.uuid4()),
+        "imdb_rating": 7.5,
+        "genre": [{"id": str(uuid.uuid4()), "name": "Drama"}, {"id": str(uuid.uuid4()), "name": "Comedy"}],
+        "title": "Some movie title",
+        "description": "Quite long description of the movie. " * 20,
+        "directors_names": [p["name"] for p in persons[:2]],
+        "actors_names": [p["name"] for p in persons[2:-3]],
+        "writers_names": [p["name"] for p in persons[-3:]],
+        "actors": persons[2:-3],
+        "writers": persons[-3:],
+        "directors": persons[:2],
+    }
+
+
+def joined_json_body(essences: List[dict]) -> int:
+    request_body = []
+    for essence in essences:
+        header = {
+            "index": {
+                "_index": INDEX_NAME,
+                "_id": essence["id"]
+            }
+        }
+        request_body.append(json.dumps(header))
+        request_body.append(json.dumps(essence))
+
+    request_body = "\n".join(request_body) + "\n"
+    return len(request_body.encode())  # requests encodes str body before sending
+
+
+def streamed_orjson_body(essences: List[dict]) -> int:
+    batch = BulkBatch(INDEX_NAME)
+    for essence in essences:
+        batch.add(essence)
+    return sum(len(chunk) for chunk in batch.iter_body())
+
+
+def measure(build: Callable, essences: List[dict]):
+    build(essences)
+    started_at = time.perf_counter()
+    for _ in range(REPEATS):
+        build(essences)
+    elapsed = (time.perf_counter() - started_at) / REPEATS * 1000
+
+    tracemalloc.start()
+    build(essences)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def main():
+    print(f"{'batch':>8} {'json, ms':>10} {'json, MiB':>10} {'orjson, ms':>11} {'orjson, MiB':>12} {'speedup':>8}")
+    for batch_size in BATCH_SIZES:
+        essences = [make_movie() for _ in range(batch_size)]
+        json_time, json_peak = measure(joined_json_body, essences)
+        orjson_time, orjson_peak = measure(streamed_orjson_body, essences)
+        print(f"{batch_size:>8} {json_time:>10.2f} {json_peak:>10.2f} {orjson_time:>11.2f} {orjson_peak:>12.2f} "
+              f"{json_time / orjson_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measures ETL hot queries with and without indexes added by movies_admin 0005_etl_indexes migration.
+Indexes are dropped inside transaction which is rolled back, so the database is left untouched - but tables are
+locked while queries run without indexes, don't launch it against production. Requires migrated database filled
+with movies. Launch from postgres_to_es folder:
+    python -m benchmarks.hot_queries
+"""
+import time
+from typing import Dict
+
+import psycopg2
+import psycopg2.extras
+from psycopg2.extras import DictCursor
+
+from src.consts import DEFAULT_DATE, DEFAULT_ID
+from src.db import DSN, uuid_array
+from src.producers import CHANGED_MOVIES_IDS_QUERY, UPDATED_GENRES_QUERY, UPDATED_PERSONS_QUERY
+
+REPEATS = 20
+PAGE_SIZE = 100
+ETL_INDEXES = ("film_work_modified_id_idx", "person_modified_id_idx", "genre_modified_id_idx",
+               "person_film_work_person_idx", "genre_film_work_genre_idx")
+UPDATED_MOVIES_QUERY = """
+    SELECT id, modified
+    FROM content.film_work
+    WHERE (modified, id) > (%(modified)s, %(id)s)
+    ORDER BY modified, id
+"""
+MOVIES_BY_PERSONS_QUERY = """
+    SELECT DISTINCT fw.id, fw.modified
+    FROM content.film_work fw
+    JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    WHERE (fw.modified, fw.id) > (%(modified)s, %(id)s) AND pfw.person_id = ANY(%(ids)s::uuid[])
+    ORDER BY fw.modified, fw.id
+"""
+MOVIES_BY_GENRES_QUERY = """
+    SELECT DISTINCT fw.id, fw.modified
+    FROM content.film_work fw
+    JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    WHERE (fw.modified, fw.id) > (%(modified)s, %(id)s) AND gfw.genre_id = ANY(%(ids)s::uuid[])
+    ORDER BY fw.modified, fw.id
+"""
+
+
+def build_queries(cursor) -> Dict[str, tuple]:
+    """
+    Builds queries the way ETL runs them - pages of the recently changed rows.
+    """
+    cursor.execute("SELECT modified FROM content.film_work ORDER BY modified DESC OFFSET %s LIMIT 1", (PAGE_SIZE,))
+    recent = cursor.fetchone()
+    recent = recent["modified"] if recent is not None else DEFAULT_DATE
+    cursor.execute(f"SELECT id FROM content.person ORDER BY modified DESC LIMIT {PAGE_SIZE}")
+    persons = uuid_array(row["id"] for row in cursor.fetchall())
+    cursor.execute(f"SELECT id FROM content.genre ORDER BY modified DESC LIMIT {PAGE_SIZE}")
+    genres = uuid_array(row["id"] for row in cursor.fetchall())
+
+    keyset = {"modified": recent, "id": DEFAULT_ID}
+    page = f" LIMIT {PAGE_SIZE}"
+    return {
+        "updated movies page": (UPDATED_MOVIES_QUERY + page, keyset),
+        "updated persons page": (UPDATED_PERSONS_QUERY + page, keyset),
+        "updated genres page": (UPDATED_GENRES_QUERY + page, keyset),
+        "movies by persons page": (MOVIES_BY_PERSONS_QUERY + page, {**keyset, "ids": persons}),
+        "movies by genres page": (MOVIES_BY_GENRES_QUERY + page, {**keyset, "ids": genres}),
+        "changed movies plan": (CHANGED_MOVIES_IDS_QUERY, {
+            "movie_modified": recent, "movie_id": DEFAULT_ID, "person_modified": recent, "person_id": DEFAULT_ID,
+            "genre_modified": recent, "genre_id": DEFAULT_ID,
+        }),
+    }
+
+
+def measure(cursor, query: str, params: dict) -> float:
+    cursor.execute(query, params)  # warm up
+    cursor.fetchall()
+    started_at = time.perf_counter()
+    for _ in range(REPEATS):
+        cursor.execute(query, params)
+        cursor.fetchall()
+    return (time.perf_counter() - started_at) / REPEATS * 1000
+
+
+def main():
+    psycopg2.extras.register_uuid()
+    with psycopg2.connect(**DSN, cursor_factory=DictCursor) as connection, connection.cursor() as cursor:
+        queries = build_queries(cursor)
+        indexed = {name: measure(cursor, *query) for name, query in queries.items()}
+
+        for index in ETL_INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS content.{index}")
+        not_indexed = {name: measure(cursor, *query) for name, query in queries.items()}
+        connection.rollback()
+
+    print(f"{'query':<24} {'no indexes, ms':>15} {'indexes, ms':>12} {'speedup':>8}")
+    for name in queries:
+        speedup = not_indexed[name] / indexed[name]
+        print(f"{name:<24} {not_indexed[name]:>15.2f} {indexed[name]:>12.2f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compares movies lookup by ids built as mogrify-ed IN list with lookup by single uuid[] parameter of prepared statement.
+Requires database filled with movies. Launch from postgres_to_es folder:
+    python -m benchmarks.id_lookups
+"""
+import time
+from typing import Callable, List
+
+import psycopg2
+import psycopg2.extras
+from psycopg2.extras import DictCursor
+
+from src.db import DSN, execute_prepared, uuid_array
+
+BATCH_SIZES = (100, 1000, 10000)
+REPEATS = 20
+QUERY = """
+    SELECT fw.id, fw.title, fw.modified
+    FROM content.film_work fw
+    WHERE fw.id {condition}
+"""
+
+
+def lookup_by_in_list(cursor, ids: List) -> None:
+    args = ",".join(cursor.mogrify("%s", (_id,)).decode() for _id in ids)
+    cursor.execute(QUERY.format(condition=f"IN ({args})"))
+    cursor.fetchall()
+
+
+def lookup_by_array_parameter(cursor, ids: List) -> None:
+    execute_prepared(cursor, QUERY.format(condition="= ANY(%(ids)s::uuid[])"), {"ids": uuid_array(ids)})
+    cursor.fetchall()
+
+
+def measure(lookup: Callable, cursor, ids: List) -> float:
+    lookup(cursor, ids)  # warm up, prepares statement for the prepared lookup
+    started_at = time.perf_counter()
+    for _ in range(REPEATS):
+        lookup(cursor, ids)
+    return (time.perf_counter() - started_at) / REPEATS * 1000
+
+
+def main():
+    psycopg2.extras.register_uuid()
+    with psycopg2.connect(**DSN, cursor_factory=DictCursor) as connection, connection.cursor() as cursor:
+        cursor.execute(f"SELECT id FROM content.film_work LIMIT {max(BATCH_SIZES)}")
+        all_ids = [row["id"] for row in cursor.fetchall()]
+        print(f"{'batch':>8} {'IN list, ms':>14} {'uuid[], ms':>14} {'speedup':>8}")
+        for batch_size in BATCH_SIZES:
+            ids = all_ids[:batch_size]
+            in_list = measure(lookup_by_in_list, cursor, ids)
+            array_parameter = measure(lookup_by_array_parameter, cursor, ids)
+            print(f"{len(ids):>8} {in_list:>14.2f} {array_parameter:>14.2f} {in_list / array_parameter:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
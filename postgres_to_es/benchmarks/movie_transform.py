@@ -0,0 +1,116 @@
+"""
+Compares per-movie transform_movie_data coroutine (previous implementation - FullMovie object, Roles enum keyed
+grouping and a comprehension per output list) with batch transform_movies fed by whole fetched page.
+Synthetic films have 50 persons cast each. Needs neither Postgres nor Elasticsearch. Launch from postgres_to_es folder:
+    python -m benchmarks.movie_transform
+"""
+import datetime
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from src.filters import transform_movies
+from src.models import Roles
+from src.wrappers import coroutine
+
+PAGE_SIZES = (100, 1000, 10000)
+CAST_SIZE = 50
+REPEATS = 5
+
+
+@dataclass
+class FullMovie:
+    fw_id: uuid.UUID
+    title: str
+    description: Optional[str]
+    rating: Optional[float]
+    created: datetime.datetime
+    modified: datetime.datetime
+    genres: List[dict]  # {"id": ..., "name": ...}
+    persons: List[dict]  # {"id": ..., "full_name": ..., "role": ...}
+
+
+def make_movie(cast_size: int = CAST_SIZE) -> dict:
+    roles = ["director"] * 2 + ["writer"] * 3 + ["actor"] * (cast_size - 5)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {
+        "fw_id": uuid.uuid4(),
+        "title": "Some movie title",
+        "description": "Quite long description of the movie. " * 20,
+        "rating": 7.5,
+        "created": now,
+        "modified": now,
+        "genres": [{"id": str(uuid.uuid4()), "name": "Drama"}, {"id": str(uuid.uuid4()), "name": "Comedy"}],
+        "persons": [{"id": str(uuid.uuid4()), "full_name": f"Person {i} Surname", "role": role}
+                    for i, role in enumerate(roles)],
+    }
+
+
+@coroutine
+def legacy_transform_movie_data(target):
+    while movie := (yield):
+        movie = FullMovie(**movie)
+        persons = {Roles.WRITER: [], Roles.ACTOR: [], Roles.DIRECTOR: []}
+        for person in movie.persons:
+            if person["role"] is None or person["full_name"] is None or person["id"] is None:
+                raise ValueError("Invalid persons data")
+            persons[Roles(person["role"])].append(person)
+
+        for genre in movie.genres:
+            if genre["name"] is None or genre["id"] is None:
+                raise ValueError("Invalid genres data")
+
+        writers, actors, directors = persons[Roles.WRITER], persons[Roles.ACTOR], persons[Roles.DIRECTOR]
+        target.send({
+            "id": str(movie.fw_id),
+            "imdb_rating": movie.rating,
+            "genre": [{"id": g["id"], "name": g["name"]} for g in movie.genres],
+            "title": movie.title,
+            "description": movie.description,
+            "directors_names": [d["full_name"] for d in directors],
+            "actors_names": [a["full_name"] for a in actors],
+            "writers_names": [w["full_name"] for w in writers],
+            "actors": [{"id": a["id"], "name": a["full_name"]} for a in actors],
+            "writers": [{"id": w["id"], "name": w["full_name"]} for w in writers],
+            "directors": [{"id": d["id"], "name": d["full_name"]} for d in directors]
+        })
+
+
+@coroutine
+def collect(documents: list):
+    while document := (yield):
+        documents.append(document)
+
+
+def per_movie(movies: List[dict]) -> List[dict]:
+    documents = []
+    transformer = legacy_transform_movie_data(collect(documents))
+    for movie in movies:
+        transformer.send(movie)
+    return documents
+
+
+def batch(movies: List[dict]) -> List[dict]:
+    return transform_movies(movies)
+
+
+def measure(transform: Callable, movies: List[dict]) -> float:
+    transform(movies)
+    started_at = time.perf_counter()
+    for _ in range(REPEATS):
+        transform(movies)
+    return (time.perf_counter() - started_at) / REPEATS * 1000
+
+
+def main():
+    print(f"{'page':>8} {'per movie, ms':>14} {'batch, ms':>10} {'speedup':>8}")
+    for page_size in PAGE_SIZES:
+        movies = [make_movie() for _ in range(page_size)]
+        assert per_movie(movies) == batch(movies), "batch transformer output differs"
+        per_movie_time, batch_time = measure(per_movie, movies), measure(batch, movies)
+        print(f"{page_size:>8} {per_movie_time:>14.2f} {batch_time:>10.2f} {per_movie_time / batch_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,36 @@
+import argparse
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
 from datetime import datetime, timezone
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, List, Optional, Tuple
 
 import psycopg2.extras
 
+from src.cdc import stream_changes
 from src.config import CONFIG
-from src.filters import transform_movie_data, transform_genre_data, load_essences, transform_person_data
+from src.consts import DEFAULT_DATE
+from src.db import close_pool, get_pool
+from src.digests import get_digests
+from src.filters import transform_movie_data, transform_genre_data, loading_essences, transform_person_data
+from src.lease import Lease, LeaseLost, get_lease
+from src.metrics import metrics
+from src.outbox import check_outbox_tracking, run_outbox_process, set_outbox_tracking
 from src.producers import (
     extract_movies_updated_due_to_person_change,
     extract_movies_updated_due_to_movie_change,
     extract_movies_updated_due_to_genre_change,
     extract_genres_updated_due_to_genre_change,
-    extract_updated_persons
+    extract_updated_persons,
+    extract_updated_movies,
+    rename_persons_in_movies
 )
+from src.scheduler import PollingScheduler
+from src.sharding import Shard, ShardWorker, find_orphaned_shards_states, get_shards, remove_shards_states
 from src.state import State
-from src.utils import ensure_es_index_exists
+from src.utils import create_versioned_index, delete_index, ensure_es_index_exists, finish_bulk_load, swap_alias
 
 logger = logging.getLogger(__name__)
 
@@ -24,43 +40,374 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 
-def run_etl_process(state: State):
+def sync_movies(state: State, index_name: str, shard: Optional[Shard] = None, lease: Optional[Lease] = None):
     """
-    Starts to periodically launch all of ETL pipelines.
+    Syncs movies index, or only movies owned by shard. Sync is aborted by LeaseLost once lease is lost.
+    Persons renames are applied to movies by partial updates if ES_PARTIAL_PERSON_UPDATES is set. The first sync
+    indexes all of movies as a whole anyway.
     """
-    ensure_es_index_exists(CONFIG.ELASTIC_URL, CONFIG.ES_MOVIES_INDEX)
-    ensure_es_index_exists(CONFIG.ELASTIC_URL, CONFIG.ES_GENRE_INDEX)
-    ensure_es_index_exists(CONFIG.ELASTIC_URL, CONFIG.ES_PERSONS_INDEX)
-
-    while True:
-        logger.info("Starting full sync")
-        started_at = datetime.now(timezone.utc)
-        state.set_last_full_state_sync_started_at(started_at)
+    rename_persons = CONFIG.ES_PARTIAL_PERSON_UPDATES and state.last_person_for_movies_synced_at != DEFAULT_DATE
+    if rename_persons:
+        # advances persons checkpoint - movies don't have to be fetched
+        rename_persons_in_movies(state, index_name, lease)
 
-        movies_loader = load_essences(CONFIG.ES_MOVIES_INDEX)
+    with loading_essences(index_name, state, lease) as movies_loader:
         movies_transformer = transform_movie_data(movies_loader)
-        extract_movies_updated_due_to_genre_change(movies_transformer, state)
-        extract_movies_updated_due_to_movie_change(movies_transformer, state)
-        extract_movies_updated_due_to_person_change(movies_transformer, state)
-        movies_loader.close()
+        if CONFIG.PLANNED_MOVIES_SYNC:
+            extract_updated_movies(movies_transformer, state, shard)
+        else:
+            extract_movies_updated_due_to_genre_change(movies_transformer, state)
+            extract_movies_updated_due_to_movie_change(movies_transformer, state)
+            if not rename_persons:
+                extract_movies_updated_due_to_person_change(movies_transformer, state)
 
-        genres_loader = load_essences(CONFIG.ES_GENRE_INDEX)
+
+def sync_genres(state: State, index_name: str, lease: Optional[Lease] = None):
+    """
+    Syncs genres index.
+    """
+    with loading_essences(index_name, state, lease) as genres_loader:
         genres_transformer = transform_genre_data(genres_loader)
         extract_genres_updated_due_to_genre_change(genres_transformer, state)
-        genres_loader.close()
 
-        load = load_essences(CONFIG.ES_PERSONS_INDEX)
+
+def sync_persons(state: State, index_name: str, lease: Optional[Lease] = None):
+    """
+    Syncs persons index.
+    """
+    with loading_essences(index_name, state, lease) as load:
         transform = transform_person_data(load)
         extract_updated_persons(transform, state)
-        load.close()
 
+
+PIPELINES: Dict[str, Callable[..., None]] = {
+    "movies": sync_movies,
+    "genres": sync_genres,
+    "persons": sync_persons,
+}
+# indexes (or aliases of rebuilt indexes) pipelines load to
+PIPELINES_INDEXES: Dict[str, str] = {
+    "movies": CONFIG.ES_MOVIES_INDEX,
+    "genres": CONFIG.ES_GENRE_INDEX,
+    "persons": CONFIG.ES_PERSONS_INDEX,
+}
+# tables pipelines extract from, pipeline is polled only if any of them changed. Movies links changes update movie
+PIPELINES_TABLES: Dict[str, Tuple[str, ...]] = {
+    "movies": ("film_work", "person", "genre"),
+    "genres": ("genre",),
+    "persons": ("person",),
+}
+# movies shards states are kept next to the main state file
+STATE_PREFIX = f"{CONFIG.ETL_STATE_STORAGE_FOLDER}/state"
+REBUILD_STATE_PREFIX = f"{CONFIG.ETL_STATE_STORAGE_FOLDER}/rebuild"
+# long-lived movies shards workers by state prefix and index they sync
+_shards_workers: Dict[Tuple[str, str], List[ShardWorker]] = {}
+
+
+def run_movies_shard(shard: Shard, connection: Connection, state_prefix: str, index_name: str):
+    """
+    Entry point of shard worker process. Syncs movies owned by shard from checkpoints of shard's own state on every
+    request of coordinator. State is read by every sync, so checkpoints handed over by rebuild are picked up.
+    """
+    psycopg2.extras.register_uuid()
+    try:
+        while connection.recv():
+            try:
+                logger.debug(f"Starting movies shard {shard.name} sync")
+                state = State(shard.state_file(state_prefix))
+                sync_movies(state, index_name, shard)
+                state.complete_pipeline_sync("movies")
+                logger.debug(f"Completed movies shard {shard.name} sync")
+                connection.send(None)
+            except Exception as e:
+                logger.exception(f"Movies shard {shard.name} sync failed")
+                connection.send(repr(e))
+    except EOFError:
+        pass  # coordinator exited
+    finally:
+        close_pool()
+
+
+def get_shards_workers(state_prefix: str, index_name: str) -> List[ShardWorker]:
+    """
+    Returns workers of ETL_SHARDS shards, workers are started by their first sync.
+    """
+    workers = _shards_workers.get((state_prefix, index_name))
+    if workers is None:
+        orphaned = find_orphaned_shards_states(state_prefix, CONFIG.ETL_SHARDS)
+        if orphaned:
+            logger.warning(f"Shards states {', '.join(orphaned)} are left by other ETL_SHARDS and are not used - "
+                           f"{CONFIG.ETL_SHARDS} shards sync movies from their own checkpoints, from scratch at first")
+        workers = [ShardWorker(shard, run_movies_shard, (state_prefix, index_name))
+                   for shard in get_shards(CONFIG.ETL_SHARDS)]
+        _shards_workers[(state_prefix, index_name)] = workers
+    return workers
+
+
+def stop_shards_workers(state_prefix: str):
+    for key in [key for key in _shards_workers if key[0] == state_prefix]:
+        for worker in _shards_workers.pop(key):
+            worker.stop()
+
+
+def run_sharded_movies_sync(state_prefix: str, index_name: str):
+    """
+    Coordinates movies sync by ETL_SHARDS long-lived worker processes - transform and serialization of movies are
+    spread between cores. Waits for all of shards, syncs are terminated along with their workers if coordinator is
+    interrupted. Shards don't depend on each other, failed shard continues from its own
+    checkpoints on the next sync.
+    """
+    if not CONFIG.PLANNED_MOVIES_SYNC or CONFIG.ES_SKIP_UNCHANGED_DOCUMENTS or CONFIG.ES_PARTIAL_PERSON_UPDATES:
+        raise ValueError("ETL_SHARDS requires PLANNED_MOVIES_SYNC and can't be combined with "
+                         "ES_SKIP_UNCHANGED_DOCUMENTS or ES_PARTIAL_PERSON_UPDATES")
+
+    workers = get_shards_workers(state_prefix, index_name)
+    for worker in workers:
+        worker.request()
+    try:
+        for worker in workers:
+            worker.wait(None)
+    except BaseException:
+        for worker in workers:
+            worker.stop()
+        raise
+
+    failed = [f"{worker.shard.name} ({worker.error})" for worker in workers if worker.error is not None]
+    if failed:
+        raise RuntimeError(f"Movies shards {', '.join(failed)} failed")
+
+
+def run_pipeline(name: str,
+                 state: State,
+                 index_name: Optional[str] = None,
+                 state_prefix: str = STATE_PREFIX,
+                 lease: Optional[Lease] = None) -> bool:
+    """
+    Runs single pipeline and resets its synced entities cache after it's completed. Returns whether pipeline was run.
+    Pipeline loads to its index from PIPELINES_INDEXES if other index is not provided.
+    Movies are synced by shards if ETL_SHARDS is set, shards keep their states by state_prefix.
+    If lease is provided pipeline is run only if lease is held by this process, lease is renewed while it runs.
+    Pipeline is aborted as soon as lease is lost, the new holder continues from checkpoints saved to lease.
+    """
+    if lease is not None and not lease.acquire():
+        logger.debug(f"{name} sync is run by other process, skipping")
+        return False
+
+    logger.debug(f"Starting {name} sync")
+    index_name = index_name or PIPELINES_INDEXES[name]
+    state.set_pipeline_sync_started_at(name, datetime.now(timezone.utc))
+    with lease.keep_alive() if lease is not None else nullcontext():
+        try:
+            if name == "movies" and CONFIG.ETL_SHARDS > 1:
+                run_sharded_movies_sync(state_prefix, index_name)
+            else:
+                PIPELINES[name](state, index_name, lease=lease)
+        except Exception:
+            # LeaseLost may come wrapped by loading error, lost lease is what matters
+            if lease is None or lease.is_held():
+                raise
+            logger.warning(f"{name} sync aborted, lease {lease.name} is lost")
+            return False
+    state.complete_pipeline_sync(name)
+    if lease is not None:
+        lease.acquire()  # saves checkpoints of completed sync to lease
+    logger.debug(f"Completed {name} sync")
+    return True
+
+
+def run_full_sync(state: State,
+                  indexes: Optional[Dict[str, str]] = None,
+                  state_prefix: str = STATE_PREFIX,
+                  leases: Optional[Dict[str, Lease]] = None):
+    """
+    Runs all of pipelines once. Pipelines are launched one by one or concurrently - then sync takes as long as
+    the slowest pipeline does. Pipelines leased by other processes are skipped.
+    """
+    logger.info("Starting full sync")
+    indexes = indexes or PIPELINES_INDEXES
+    leases = leases or {}
+    started_at = datetime.now(timezone.utc)
+    state.set_last_full_state_sync_started_at(started_at)
+
+    if CONFIG.ETL_CONCURRENT_PIPELINES:
+        with ThreadPoolExecutor(max_workers=len(PIPELINES), thread_name_prefix="pipeline") as executor:
+            futures = [executor.submit(run_pipeline, name, state, indexes[name], state_prefix, leases.get(name))
+                       for name in PIPELINES]
+            for future in futures:
+                future.result()  # re-raises pipeline error if any
+    else:
+        for name in PIPELINES:
+            run_pipeline(name, state, indexes[name], state_prefix, leases.get(name))
+
+    logger.info(f"Full sync completed. Metrics: {metrics.snapshot()}")
+
+
+def check_leases_config():
+    """
+    Refuses settings which keep sync progress in local files only, while ETL_LEASES hands pipelines over between
+    processes. Local digests of a process which takes pipeline back are stale - documents updated by other holder
+    meanwhile would be skipped as unchanged. Shards keep movies checkpoints in their own state files, lease would
+    hand over coordinator's checkpoints which never advance - new holder would reindex all of movies.
+    """
+    if CONFIG.ETL_LEASES and CONFIG.ES_SKIP_UNCHANGED_DOCUMENTS:
+        raise ValueError("ETL_LEASES can't be combined with ES_SKIP_UNCHANGED_DOCUMENTS")
+    if CONFIG.ETL_LEASES and CONFIG.ETL_SHARDS > 1:
+        raise ValueError("ETL_LEASES can't be combined with ETL_SHARDS")
+
+
+def rebuild_indexes():
+    """
+    Rebuilds all of indexes without downtime. Every index is loaded from scratch to a new version created with
+    bulk-optimized settings, while the old one keeps serving queries by alias. When all of versions are loaded their
+    settings are restored and aliases are swapped to them, old versions are deleted.
+    Regular sync continues from checkpoints reached by rebuild, movies shards continue from checkpoints of their
+    rebuild shards.
+    With ETL_LEASES rebuild holds leases of all of pipelines and of CDC stream until aliases are swapped, so nothing
+    is loaded to the old versions meanwhile - rebuild refuses to start while sync processes hold them, sync processes
+    started later wait for it. Checkpoints are handed over to sync processes by pipelines leases. Without leases
+    sync process must be stopped for the whole rebuild, checkpoints are copied to its state file.
+    """
+    if CONFIG.ETL_LEASES:
+        names = ["rebuild", "cdc", *(f"pipeline_{name}" for name in PIPELINES)]
+        leases = {name: get_lease(name) for name in names}
+        check_leases_config()
+    else:
+        leases = {}
+        logger.warning("ETL_LEASES is not set - sync process must be stopped until indexes are rebuilt")
+
+    checkpoints = {}
+    try:
+        held_elsewhere = [name for name, lease in leases.items() if not lease.acquire()]
+        if held_elsewhere:
+            raise RuntimeError(f"Leases {', '.join(held_elsewhere)} are held by other processes - "
+                               f"indexes are being rebuilt or sync processes are running, stop them first")
+
+        def progressed_at() -> float:  # rebuild progresses as long as any of its pipelines does
+            return max(lease.progressed_at for lease in leases.values())
+
+        with ExitStack() as stack:
+            for lease in leases.values():
+                stack.enter_context(lease.keep_alive(progressed_at))
+            rebuild_state = rebuild_versions(leases)
+        checkpoints = {f"pipeline_{name}": rebuild_state.get_checkpoints(name) for name in PIPELINES}
+    finally:
+        for name, lease in leases.items():
+            lease.release(checkpoints.get(name))
+    logger.info("Indexes rebuilt")
+
+
+def rebuild_versions(leases: Dict[str, Lease]) -> State:
+    """
+    Loads new versions of all of indexes and swaps aliases to them. Returns state of rebuild.
+    Aliases are swapped only if all of leases are still held.
+    """
+    rebuild_state = State(None)
+    remove_shards_states(REBUILD_STATE_PREFIX, CONFIG.ETL_SHARDS)  # left by interrupted rebuild
+    versions = {name: create_versioned_index(CONFIG.ELASTIC_URL, alias) for name, alias in PIPELINES_INDEXES.items()}
+    pipelines_leases = {name: leases[f"pipeline_{name}"] for name in PIPELINES} if leases else None
+    run_full_sync(rebuild_state, versions, REBUILD_STATE_PREFIX, pipelines_leases)
+    stop_shards_workers(REBUILD_STATE_PREFIX)
+    for lease in leases.values():
+        lease.ensure_held()  # changes loaded by other holder to the old versions would be lost by swap
+
+    for name, index_name in versions.items():
+        alias = PIPELINES_INDEXES[name]
+        finish_bulk_load(CONFIG.ELASTIC_URL, alias, index_name)
+        for previous in swap_alias(CONFIG.ELASTIC_URL, alias, index_name):
+            delete_index(CONFIG.ELASTIC_URL, previous)
+        get_digests(alias).adopt(get_digests(index_name))
+
+    if not leases:  # otherwise checkpoints are handed over by leases, state file of sync process is not touched
+        state = State(f"{STATE_PREFIX}.json")
+        state.copy_checkpoints(rebuild_state)
         state.complete_full_sync()
-        logger.info("Full sync completed. Sleeping.")
+    if CONFIG.ETL_SHARDS > 1:  # shards states are local to process, shards aren't run with leases
+        for shard in get_shards(CONFIG.ETL_SHARDS):
+            shard_state = State(shard.state_file(STATE_PREFIX))
+            shard_state.copy_checkpoints(State(shard.state_file(REBUILD_STATE_PREFIX)))
+            shard_state.complete_pipeline_sync("movies")
+        remove_shards_states(REBUILD_STATE_PREFIX, CONFIG.ETL_SHARDS)
+    return rebuild_state
+
+
+def run_etl_process(state: State):
+    """
+    Starts to periodically launch all of ETL pipelines, or to stream changes from replication slot in CDC mode.
+    With ETL_LEASES every pipeline is run by a single ETL process at a time, CDC stream is consumed by a single
+    process as well - others wait to take it over. Pipeline's checkpoints are kept along with its lease, so process
+    which takes pipeline over continues from them. Leases are released when process stops.
+    """
+    check_leases_config()
+    leases = {name: get_lease(f"pipeline_{name}", state, name) for name in PIPELINES} if CONFIG.ETL_LEASES else {}
+    try:
+        sync_continuously(state, leases)
+    finally:
+        stop_shards_workers(STATE_PREFIX)
+        for lease in leases.values():
+            lease.release()
+
+
+def sync_continuously(state: State, leases: Dict[str, Lease]):
+    for index_name in PIPELINES_INDEXES.values():
+        if ensure_es_index_exists(CONFIG.ELASTIC_URL, index_name):
+            get_digests(index_name).reset()  # documents of the new index must be loaded even if they didn't change
+    with get_pool().connection() as connection:
+        logger.info(f"Connected to Postgres, server version {connection.server_version}")
+
+    check_outbox_tracking(CONFIG.ETL_CHANGES_SOURCE == "outbox")
+    if CONFIG.ETL_CHANGES_SOURCE == "cdc":
+        lease = get_lease("cdc")
+        if lease is not None:
+            leases["cdc"] = lease
+
+        def progressed_at() -> float:  # catch up progresses by pipelines leases
+            return max(lease.progressed_at for lease in leases.values())
+
+        while True:
+            if lease is not None:
+                lease.wait()  # replication slot is consumed by a single process
+            try:
+                with lease.keep_alive(progressed_at) if lease is not None else nullcontext():
+                    stream_changes(state, catch_up=lambda: run_full_sync(state, leases=leases), lease=lease)
+            except LeaseLost:
+                logger.warning("Changes stream is taken over by other process, waiting for it to stop")
+    if CONFIG.ETL_CHANGES_SOURCE == "outbox":
+        run_full_sync(state, leases=leases)  # catches up changes made before outbox tracking was enabled
+        run_outbox_process()  # outbox records are locked by drainer, several processes may drain it
+        return
+    if CONFIG.ETL_ADAPTIVE_POLLING:
+        def run(name: str) -> bool:
+            if run_pipeline(name, state, lease=leases.get(name)):
+                logger.info(f"{name} sync completed. Metrics: {metrics.snapshot()}")
+                return True
+            return False
+
+        PollingScheduler(PIPELINES_TABLES, run, leases).run_forever()
+        return
+
+    while True:
+        run_full_sync(state, leases=leases)
+        logger.info("Sleeping.")
         time.sleep(CONFIG.UPDATES_CHECK_INTERVAL_SEC)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Syncs Elasticsearch indexes with movies database")
+    parser.add_argument("mode", nargs="?", choices=("sync", "rebuild", "enable-outbox", "disable-outbox"),
+                        default="sync",
+                        help="sync - keep indexes in sync continuously, "
+                             "rebuild - rebuild indexes from scratch behind aliases and exit, "
+                             "enable-outbox/disable-outbox - switch outbox triggers before/after outbox mode and exit")
+    args = parser.parse_args()
+
     logger.info("Starting ETL process")
-    state = State(f"{CONFIG.ETL_STATE_STORAGE_FOLDER}/state.json")
     psycopg2.extras.register_uuid()
-    run_etl_process(state)
+    try:
+        if args.mode == "rebuild":
+            rebuild_indexes()
+        elif args.mode in ("enable-outbox", "disable-outbox"):
+            set_outbox_tracking(args.mode == "enable-outbox")
+        else:
+            run_etl_process(State(f"{STATE_PREFIX}.json"))
+    finally:
+        close_pool()
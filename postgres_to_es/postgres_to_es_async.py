@@ -0,0 +1,272 @@
+"""
+Asyncio version of ETL process. Several pages are extracted from Postgres and several bulk requests are sent to
+Elasticsearch concurrently in a single event loop. Transformations and state checkpoints are the same as in
+postgres_to_es.py.
+"""
+import asyncio
+import functools
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, List, Tuple
+
+import aiohttp
+import asyncpg
+import backoff
+
+from src.config import CONFIG
+from src.db import DSN, to_positional
+from src.loading import BulkBatch, split_bulk_result
+from src.filters import transform_genre_data, transform_movies, transform_person_data
+from src.producers import (
+    CHANGED_MOVIES_IDS_QUERY,
+    LAST_MODIFIED_ROWS_QUERY,
+    MOVIES_BY_IDS_QUERY,
+    UPDATED_GENRES_QUERY,
+    UPDATED_PERSONS_QUERY,
+    changed_movies_ids_params
+)
+from src.state import State
+from src.utils import ensure_es_index_exists
+from src.wrappers import coroutine
+
+logger = logging.getLogger(__name__)
+
+if CONFIG.DEBUG:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+Page = List[asyncpg.Record]
+
+
+def positional(query: str, params: dict) -> Tuple[str, list]:
+    names = list(params)
+    return to_positional(query, names), [params[name] for name in names]
+
+
+async def in_executor(func: Callable, *args) -> Any:
+    """
+    Runs blocking call (state file fsync, dead letter file write, synchronous ES request) in default thread pool
+    executor so it doesn't stall requests in flight.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+async def init_connection(connection: asyncpg.Connection):
+    await connection.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+@coroutine
+def collect(documents: List[dict]):
+    while document := (yield):
+        documents.append(document)
+
+
+def transform(transformer: Callable, rows: Page) -> List[dict]:
+    """
+    Runs rows through transform_* coroutine and returns transformed documents.
+    """
+    documents = []
+    target = transformer(collect(documents))
+    for row in rows:
+        target.send(dict(row))
+    return documents
+
+
+async def iter_pages(connection: asyncpg.Connection, query: str, params: dict) -> AsyncIterator[Page]:
+    """
+    Streams query results with server-side cursor and yields them by pages of FETCH_FROM_PG_BY rows.
+    Must be called inside transaction.
+    """
+    query, args = positional(query, params)
+    page = []
+    async for row in connection.cursor(query, *args, prefetch=CONFIG.PG_CURSOR_ITERSIZE):
+        page.append(row)
+        if len(page) >= CONFIG.FETCH_FROM_PG_BY:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+async def process_in_order(pages: AsyncIterator[Page],
+                           process: Callable[[Page], Awaitable[None]],
+                           checkpoint: Callable[[Page], Awaitable[None]]):
+    """
+    Processes up to ASYNC_PAGES_IN_FLIGHT pages concurrently. Checkpoint of a page is committed only when the page
+    itself and all of pages before it are processed.
+    """
+    in_flight: Deque[Tuple[asyncio.Future, Page]] = deque()
+    try:
+        async for page in pages:
+            in_flight.append((asyncio.ensure_future(process(page)), page))
+            while in_flight and (len(in_flight) >= CONFIG.ASYNC_PAGES_IN_FLIGHT or in_flight[0][0].done()):
+                task, done_page = in_flight.popleft()
+                await task
+                await checkpoint(done_page)
+
+        while in_flight:
+            task, done_page = in_flight.popleft()
+            await task
+            await checkpoint(done_page)
+    except BaseException:
+        for task, _ in in_flight:
+            task.cancel()
+        raise
+
+
+class AsyncBulkLoader:
+    """
+    Sends bulk requests to Elasticsearch, up to ASYNC_BULKS_IN_FLIGHT requests at once.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+        self._semaphore = asyncio.Semaphore(CONFIG.ASYNC_BULKS_IN_FLIGHT)
+
+    @backoff.on_exception(backoff.expo, aiohttp.ClientError, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+    async def _post_bulk(self, body: bytes) -> dict:
+        async with self._semaphore:
+            async with self.session.post(f"{CONFIG.ELASTIC_URL}/_bulk", data=body,
+                                         headers={"Content-Type": "application/x-ndjson"}) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def load(self, essences: List[dict], index_name: str):
+        """
+        Loads essences the same way send_bulk does - only documents rejected with 429/503 are retried, the rest of
+        rejected documents are saved to dead letter file.
+        """
+        if not essences:
+            return
+
+        pending = BulkBatch(index_name)
+        for essence in essences:
+            pending.add(essence)
+
+        started_at, attempt = time.monotonic(), 0
+        while (result := await self._post_bulk(pending.body))["errors"]:
+            pending = await in_executor(split_bulk_result, pending, result["items"])
+            if not pending.ids:
+                return
+
+            delay = min(2 ** attempt, 30)
+            if time.monotonic() - started_at + delay > CONFIG.ES_BULK_RETRY_MAX_TIME_SEC:
+                raise RuntimeError(f"Unable to load {len(pending.ids)} documents to {index_name}, "
+                                   f"Elasticsearch keeps rejecting them")
+            logger.warning(f"Elasticsearch rejected {len(pending.ids)} documents, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def sync_movies(pool: asyncpg.Pool, loader: AsyncBulkLoader, state: State):
+    """
+    Syncs movies changed due to movie, linked persons or linked genres change - the same way planned sync does.
+    """
+    movies_query, _ = positional(MOVIES_BY_IDS_QUERY, {"ids": None})
+
+    async def process(ids_page: Page):
+        ids = [row["id"] for row in ids_page if row["id"] not in state.movies_synced]
+        if not ids:
+            return
+
+        async with pool.acquire() as connection:
+            movies = await connection.fetch(movies_query, ids)
+        await loader.load(transform_movies(movies), CONFIG.ES_MOVIES_INDEX)
+        state.add_movies_synced(ids)
+
+    async with pool.acquire() as connection, connection.transaction(isolation="repeatable_read", readonly=True):
+        last_modified = {row["source"]: row for row in await connection.fetch(LAST_MODIFIED_ROWS_QUERY)}
+        await process_in_order(iter_pages(connection, CHANGED_MOVIES_IDS_QUERY, changed_movies_ids_params(state)),
+                               process, lambda page: in_executor(state.flush))
+
+    if "movie" in last_modified:
+        state.set_last_movie_synced_at(last_modified["movie"]["modified"], last_modified["movie"]["id"])
+    if "person" in last_modified:
+        state.set_last_person_for_movies_synced_at(last_modified["person"]["modified"], last_modified["person"]["id"])
+    if "genre" in last_modified:
+        state.set_last_genre_synced_at(last_modified["genre"]["modified"], last_modified["genre"]["id"])
+
+
+async def sync_genres(pool: asyncpg.Pool, loader: AsyncBulkLoader, state: State):
+    """
+    Syncs genres changed since the last checkpoint.
+    """
+    async def process(genres: Page):
+        genres = [g for g in genres if g["id"] not in state.genres_for_genres_synced]
+        await loader.load(transform(transform_genre_data, genres), CONFIG.ES_GENRE_INDEX)
+        state.add_genres_for_genres_synced(g["id"] for g in genres)
+
+    async def checkpoint(genres: Page):
+        state.set_last_genre_for_genres_synced_at(genres[-1]["modified"], genres[-1]["id"])
+        await in_executor(state.flush)
+
+    params = {"modified": state.last_genre_for_genres_synced_at, "id": state.last_genre_for_genres_synced_id}
+    async with pool.acquire() as connection, connection.transaction(readonly=True):
+        await process_in_order(iter_pages(connection, UPDATED_GENRES_QUERY, params), process, checkpoint)
+
+
+async def sync_persons(pool: asyncpg.Pool, loader: AsyncBulkLoader, state: State):
+    """
+    Syncs persons changed since the last checkpoint.
+    """
+    async def process(persons: Page):
+        persons = [p for p in persons if p["id"] not in state.persons_synced]
+        await loader.load(transform(transform_person_data, persons), CONFIG.ES_PERSONS_INDEX)
+        state.add_persons_synced(p["id"] for p in persons)
+
+    async def checkpoint(persons: Page):
+        state.set_last_person_synced_at(persons[-1]["modified"], persons[-1]["id"])
+        await in_executor(state.flush)
+
+    params = {"modified": state.last_person_synced_at, "id": state.last_person_synced_id}
+    async with pool.acquire() as connection, connection.transaction(readonly=True):
+        await process_in_order(iter_pages(connection, UPDATED_PERSONS_QUERY, params), process, checkpoint)
+
+
+PIPELINES = {
+    "movies": sync_movies,
+    "genres": sync_genres,
+    "persons": sync_persons,
+}
+
+
+async def run_pipeline(name: str, pool: asyncpg.Pool, loader: AsyncBulkLoader, state: State):
+    logger.debug(f"Starting {name} sync")
+    state.set_pipeline_sync_started_at(name, datetime.now(timezone.utc))
+    await PIPELINES[name](pool, loader, state)
+    await in_executor(state.complete_pipeline_sync, name)
+    logger.debug(f"Completed {name} sync")
+
+
+async def run_etl_process(state: State):
+    """
+    Starts to periodically launch all of ETL pipelines concurrently.
+    """
+    await asyncio.gather(*(in_executor(ensure_es_index_exists, CONFIG.ELASTIC_URL, index_name)
+                           for index_name in (CONFIG.ES_MOVIES_INDEX, CONFIG.ES_GENRE_INDEX, CONFIG.ES_PERSONS_INDEX)))
+
+    pool = await asyncpg.create_pool(
+        database=DSN["dbname"], user=DSN["user"], password=DSN["password"], host=DSN["host"], port=DSN["port"],
+        min_size=1, max_size=CONFIG.ASYNC_PAGES_IN_FLIGHT + len(PIPELINES), init=init_connection
+    )
+    connector = aiohttp.TCPConnector(limit=CONFIG.ASYNC_BULKS_IN_FLIGHT)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            loader = AsyncBulkLoader(session)
+            while True:
+                logger.info("Starting full sync")
+                state.set_last_full_state_sync_started_at(datetime.now(timezone.utc))
+                await asyncio.gather(*(run_pipeline(name, pool, loader, state) for name in PIPELINES))
+                logger.info("Full sync completed. Sleeping.")
+                await asyncio.sleep(CONFIG.UPDATES_CHECK_INTERVAL_SEC)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    logger.info("Starting async ETL process")
+    asyncio.run(run_etl_process(State(f"{CONFIG.ETL_STATE_STORAGE_FOLDER}/state.json")))
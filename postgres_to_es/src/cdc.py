@@ -0,0 +1,222 @@
+"""
+Change data capture source of ETL. Row changes of content tables are read from logical replication slot
+(test_decoding output plugin) instead of polling tables by modified keyset. Changed rows are turned into ids of
+affected movies, persons and genres which are loaded through the same transform/load stages as polled ones.
+Position in WAL is confirmed to Postgres only when all changes before it are loaded to Elasticsearch.
+Requires wal_level=logical and REPLICA IDENTITY FULL at link tables - so deleted links carry film_work_id.
+"""
+import logging
+import re
+import select
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+import backoff
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import LogicalReplicationConnection, ReplicationCursor
+
+from src.config import CONFIG
+from src.db import DSN, execute_prepared, get_pool, uuid_array
+from src.filters import loading_essences, transform_genre_data, transform_movie_data, transform_person_data
+from src.lease import Lease
+from src.producers import get_movies_by_ids
+from src.state import State
+
+logger = logging.getLogger(__name__)
+
+TRACKED_TABLES = {"film_work", "person", "genre", "person_film_work", "genre_film_work"}
+PERSONS_BY_IDS_QUERY = """
+    SELECT id, modified, full_name
+    FROM content.person
+    WHERE id = ANY(%(ids)s::uuid[])
+"""
+GENRES_BY_IDS_QUERY = """
+    SELECT id, name, description, modified
+    FROM content.genre
+    WHERE id = ANY(%(ids)s::uuid[])
+"""
+MOVIES_IDS_BY_LINKS_QUERY = """
+    SELECT film_work_id as id FROM content.person_film_work WHERE person_id = ANY(%(persons)s::uuid[])
+    UNION
+    SELECT film_work_id as id FROM content.genre_film_work WHERE genre_id = ANY(%(genres)s::uuid[])
+"""
+# test_decoding row change: table content.person: UPDATE: id[uuid]:'...' full_name[character varying]:'...'
+# update of replica identity columns lists old ones first: UPDATE: old-key: id[uuid]:'...' new-tuple: id[uuid]:'...'
+_CHANGE = re.compile(r"^table (\w+)\.(\w+): (INSERT|UPDATE|DELETE): (.*)$", re.S)
+_OLD_KEY = re.compile(r"^old-key: (.*?) new-tuple: (.*)$", re.S)
+_COLUMN = re.compile(r"(\w+)\[[^\]]+\]:('(?:[^']|'')*'|\S+)")
+
+
+def parse_change(payload: str) -> Optional[Dict[str, str]]:
+    """
+    Parses test_decoding row change of tracked table to columns dict, keeps table name by "__table__" key.
+    Old values of updated replica identity columns are kept by "old:<column>" keys.
+    Returns None for transaction boundaries and changes of other tables.
+    """
+    match = _CHANGE.match(payload)
+    if match is None or match[1] != "content" or match[2] not in TRACKED_TABLES:
+        return None
+
+    columns = {"__table__": match[2]}
+    old_key = _OLD_KEY.match(match[4])
+    if old_key is not None:
+        columns.update((f"old:{name}", value) for name, value in parse_columns(old_key[1]).items())
+    columns.update(parse_columns(old_key[2] if old_key is not None else match[4]))
+    return columns
+
+
+def parse_columns(values: str) -> Dict[str, str]:
+    columns = {}
+    for name, value in _COLUMN.findall(values):
+        if value.startswith("'"):
+            value = value[1:-1].replace("''", "'")
+        columns[name] = value
+    return columns
+
+
+@dataclass
+class ChangedIds:
+    """
+    Ids of essences affected by row changes received since the last load.
+    """
+    movies: Set[str] = field(default_factory=set)
+    persons: Set[str] = field(default_factory=set)
+    genres: Set[str] = field(default_factory=set)
+
+    def __bool__(self) -> bool:
+        return bool(self.movies or self.persons or self.genres)
+
+    def add(self, columns: Dict[str, str]) -> None:
+        table = columns["__table__"]
+        if table == "film_work":
+            self.movies.add(columns["id"])
+        elif table == "person":
+            self.persons.add(columns["id"])
+        elif table == "genre":
+            self.genres.add(columns["id"])
+        elif "film_work_id" in columns:
+            self.movies.add(columns["film_work_id"])
+            if "old:film_work_id" in columns:  # link moved to other movie, the old one lost it
+                self.movies.add(columns["old:film_work_id"])
+        else:
+            logger.warning(f"Link change without film_work_id, check REPLICA IDENTITY of {table}")
+
+
+def iter_pages(ids: Iterable[str]) -> Iterator[List[str]]:
+    """
+    Splits ids to pages of FETCH_FROM_PG_BY ids.
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), CONFIG.FETCH_FROM_PG_BY):
+        yield ids[start:start + CONFIG.FETCH_FROM_PG_BY]
+
+
+def load_changes(changes: ChangedIds) -> None:
+    """
+    Loads current data of changed essences and movies linked with changed persons and genres. Essences are fetched
+    by pages of FETCH_FROM_PG_BY, so e.g. genre rename doesn't pull all of its movies to memory at once.
+    Deleted essences are not found, so they are skipped - the same as polling ETL does.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        movies_ids = set(changes.movies)
+        if changes.persons or changes.genres:
+            execute_prepared(cursor, MOVIES_IDS_BY_LINKS_QUERY,
+                             {"persons": uuid_array(changes.persons), "genres": uuid_array(changes.genres)})
+            movies_ids.update(str(row["id"]) for row in cursor.fetchall())
+
+        if movies_ids:
+            with loading_essences(CONFIG.ES_MOVIES_INDEX) as loader:
+                movies = transform_movie_data(loader)
+                for page in iter_pages(movies_ids):
+                    movies.send(get_movies_by_ids(page, cursor))
+
+        if changes.persons:
+            with loading_essences(CONFIG.ES_PERSONS_INDEX) as loader:
+                persons = transform_person_data(loader)
+                for page in iter_pages(changes.persons):
+                    execute_prepared(cursor, PERSONS_BY_IDS_QUERY, {"ids": uuid_array(page)})
+                    for person in cursor.fetchall():
+                        persons.send(dict(person))
+
+        if changes.genres:
+            with loading_essences(CONFIG.ES_GENRE_INDEX) as loader:
+                genres = transform_genre_data(loader)
+                for page in iter_pages(changes.genres):
+                    execute_prepared(cursor, GENRES_BY_IDS_QUERY, {"ids": uuid_array(page)})
+                    for genre in cursor.fetchall():
+                        genres.send(dict(genre))
+
+    logger.info(f"Loaded changes of {len(movies_ids)} movies, {len(changes.persons)} persons and "
+                f"{len(changes.genres)} genres")
+
+
+def ensure_replication_slot(cursor: ReplicationCursor) -> bool:
+    """
+    Creates replication slot if it doesn't exist. Returns True if slot was created.
+    """
+    try:
+        cursor.create_replication_slot(CONFIG.CDC_SLOT_NAME, output_plugin="test_decoding")
+    except psycopg2.errors.DuplicateObject:
+        return False
+
+    logger.info(f"Replication slot {CONFIG.CDC_SLOT_NAME} created")
+    return True
+
+
+@backoff.on_exception(backoff.expo, psycopg2.OperationalError, max_time=CONFIG.PG_TIMEOUT_SEC)
+def stream_changes(state: State, catch_up: Callable[[], None], lease: Optional[Lease] = None) -> None:
+    """
+    Streams changes from replication slot and loads them to Elasticsearch. Changes are accumulated for up to
+    CDC_MAX_LATENCY_SEC, so a burst of row changes is loaded by a few bulk requests. Doesn't return.
+    catch_up is called to sync changes made before the slot was created, slot already retains changes made during
+    catch up. Completed catch up is saved to state, so catch up interrupted by restart is run again.
+    If lease is provided streaming stops with LeaseLost once lease is lost, changes which are not loaded yet are
+    not confirmed, so they are streamed to the new holder.
+    """
+    connection = psycopg2.connect(**DSN, connection_factory=LogicalReplicationConnection)
+    try:
+        cursor = connection.cursor()
+        if ensure_replication_slot(cursor):
+            state.set_state("cdc_caught_up_slot", None)
+            state.flush()
+        if state.get_state("cdc_caught_up_slot") != CONFIG.CDC_SLOT_NAME:
+            catch_up()
+            state.set_state("cdc_caught_up_slot", CONFIG.CDC_SLOT_NAME)
+            state.flush()
+
+        cursor.start_replication(slot_name=CONFIG.CDC_SLOT_NAME, decode=True,
+                                 options={"include-xids": "0", "skip-empty-xacts": "1"})
+        logger.info(f"Streaming changes from replication slot {CONFIG.CDC_SLOT_NAME}")
+
+        changes, pending_since, last_lsn = ChangedIds(), None, None
+        while True:
+            if lease is not None:
+                lease.ensure_held()
+            message = cursor.read_message()
+            if message is not None:
+                columns = parse_change(message.payload)
+                if columns is not None:
+                    changes.add(columns)
+                    if pending_since is None:
+                        pending_since = time.monotonic()
+                last_lsn = message.data_start
+
+            if changes and time.monotonic() - pending_since >= CONFIG.CDC_MAX_LATENCY_SEC:
+                load_changes(changes)
+                changes, pending_since = ChangedIds(), None
+                # confirmed as soon as loaded, so WAL is released even if stream never gets idle
+                cursor.send_feedback(flush_lsn=last_lsn)
+                last_lsn = None
+
+            if message is None:
+                if not changes and last_lsn is not None:
+                    cursor.send_feedback(flush_lsn=last_lsn)  # everything up to this position is loaded
+                    last_lsn = None
+
+                timeout = CONFIG.CDC_MAX_LATENCY_SEC if changes else CONFIG.CDC_FEEDBACK_INTERVAL_SEC
+                if not select.select([cursor], [], [], timeout)[0]:
+                    cursor.send_feedback()  # keepalive
+    finally:
+        connection.close()
@@ -7,7 +7,30 @@ from pydantic import BaseModel, validator
 class Config(BaseModel):
     DEBUG: bool = config("DEBUG", default=False, cast=bool)
     ETL_STATE_STORAGE_FOLDER = config("ETL_STATE_STORAGE_FOLDER", default="state/")
+    # ETL processes take leases of pipelines at Postgres, so several of them may run against the same database.
+    # Lease which is not renewed for PROCESS_HANGUP_TIMEOUT_SEC is taken over by other process
+    ETL_LEASES: bool = config("ETL_LEASES", default=False, cast=bool)
+    ETL_NODE_NAME: Optional[str] = config("ETL_NODE_NAME", default=None)
+    PROCESS_HANGUP_TIMEOUT_SEC: int = config("PROCESS_HANGUP_TIMEOUT_SEC", default=600, cast=int)
     UPDATES_CHECK_INTERVAL_SEC: int = config("UPDATES_CHECK_INTERVAL_SEC", default=60, cast=int)
+    # poll every pipeline by its own interval instead of UPDATES_CHECK_INTERVAL_SEC: interval drops to the minimum when
+    # pipeline's tables change and doubles up to the maximum while they don't. With ETL_LEASES maximum must be less
+    # than a half of PROCESS_HANGUP_TIMEOUT_SEC - leases are renewed at every poll
+    ETL_ADAPTIVE_POLLING: bool = config("ETL_ADAPTIVE_POLLING", default=False, cast=bool)
+    ETL_POLL_MIN_INTERVAL_SEC: float = config("ETL_POLL_MIN_INTERVAL_SEC", default=1, cast=float)
+    ETL_POLL_MAX_INTERVAL_SEC: float = config("ETL_POLL_MAX_INTERVAL_SEC", default=60, cast=float)
+    # run movies, genres and persons pipelines concurrently, each of them takes own connection from the pool
+    ETL_CONCURRENT_PIPELINES: bool = config("ETL_CONCURRENT_PIPELINES", default=False, cast=bool)
+    # "polling" - pipelines poll tables by modified keyset, "cdc" - changes are streamed from logical replication slot,
+    # "outbox" - changes are drained from outbox table filled by triggers
+    ETL_CHANGES_SOURCE: str = config("ETL_CHANGES_SOURCE", default="polling")
+    CDC_SLOT_NAME: str = config("CDC_SLOT_NAME", default="etl_content")
+    CDC_MAX_LATENCY_SEC: float = config("CDC_MAX_LATENCY_SEC", default=0.5, cast=float)
+    CDC_FEEDBACK_INTERVAL_SEC: int = config("CDC_FEEDBACK_INTERVAL_SEC", default=10, cast=int)
+    OUTBOX_DRAIN_BY: int = config("OUTBOX_DRAIN_BY", default=1000, cast=int)
+    OUTBOX_POLL_INTERVAL_SEC: float = config("OUTBOX_POLL_INTERVAL_SEC", default=1, cast=float)
+    # amount of journal records after which state journal is folded into state snapshot
+    ETL_STATE_JOURNAL_COMPACT_EVERY: int = config("ETL_STATE_JOURNAL_COMPACT_EVERY", default=10000, cast=int)
     # database settings
     DB_HOST: str = config("POSTGRES_HOST", default=None)
     DB_PORT: int = config("POSTGRES_PORT", default=None)
@@ -17,14 +40,57 @@ class Config(BaseModel):
     # extract from PG settings
     FETCH_FROM_PG_BY: int = config("FETCH_FROM_PG_BY", default=100, cast=int)
     PG_TIMEOUT_SEC: int = config("PG_TIMEOUT_SEC", default=60, cast=int)
+    # connection pool settings
+    PG_POOL_MAX_SIZE: int = config("PG_POOL_MAX_SIZE", default=5, cast=int)
+    PG_POOL_MAX_LIFETIME_SEC: int = config("PG_POOL_MAX_LIFETIME_SEC", default=3600, cast=int)
+    PG_POOL_HEALTHCHECK_IDLE_SEC: int = config("PG_POOL_HEALTHCHECK_IDLE_SEC", default=30, cast=int)
+    # borrower fails if all of PG_POOL_MAX_SIZE connections are taken for that long, e.g. leaked by other borrower
+    PG_POOL_ACQUIRE_TIMEOUT_SEC: int = config("PG_POOL_ACQUIRE_TIMEOUT_SEC", default=60, cast=int)
+    # stream updated rows with server-side cursors instead of querying them page by page
+    PG_STREAMING_EXTRACT: bool = config("PG_STREAMING_EXTRACT", default=False, cast=bool)
+    PG_CURSOR_ITERSIZE: int = config("PG_CURSOR_ITERSIZE", default=2000, cast=int)
+    # collect ids of movies changed due to movie, person or genre change at once, sync every movie once per iteration
+    PLANNED_MOVIES_SYNC: bool = config("PLANNED_MOVIES_SYNC", default=True, cast=bool)
     # es loading settings
     ELASTIC_URL: str = config("ELASTIC_URL", default="http://127.0.0.1:9200")
     LOAD_TO_ES_BY: int = config("LOAD_TO_ES_BY", default=100, cast=int)
+    ES_BULK_MAX_BYTES: int = config("ES_BULK_MAX_BYTES", default=5 * 1024 * 1024, cast=int)
+    ES_BULK_MAX_LATENCY_SEC: float = config("ES_BULK_MAX_LATENCY_SEC", default=5, cast=float)
+    ES_BULK_GZIP: bool = config("ES_BULK_GZIP", default=False, cast=bool)
+    ES_BULK_GZIP_LEVEL: int = config("ES_BULK_GZIP_LEVEL", default=1, cast=int)
+    # tune documents per bulk request at runtime within bounds, starting from LOAD_TO_ES_BY: it grows by step while
+    # bulks are loaded faster than target latency and is halved on slower bulks or 429 rejections
+    ES_ADAPTIVE_BULK_SIZE: bool = config("ES_ADAPTIVE_BULK_SIZE", default=False, cast=bool)
+    ES_BULK_MIN_DOCS: int = config("ES_BULK_MIN_DOCS", default=50, cast=int)
+    ES_BULK_MAX_DOCS: int = config("ES_BULK_MAX_DOCS", default=5000, cast=int)
+    ES_BULK_SIZE_STEP: int = config("ES_BULK_SIZE_STEP", default=100, cast=int)
+    ES_BULK_TARGET_LATENCY_SEC: float = config("ES_BULK_TARGET_LATENCY_SEC", default=1, cast=float)
+    # documents rejected with 429/503 are retried for this time, other rejected documents are saved to dead letter file
+    ES_BULK_RETRY_MAX_TIME_SEC: int = config("ES_BULK_RETRY_MAX_TIME_SEC", default=300, cast=int)
+    ES_DEAD_LETTER_FILE: Optional[str] = config("ES_DEAD_LETTER_FILE", default=None)
+    # load batches by pool of background workers while next batches are extracted
+    ES_PIPELINED_LOADING: bool = config("ES_PIPELINED_LOADING", default=False, cast=bool)
+    ES_LOADING_WORKERS: int = config("ES_LOADING_WORKERS", default=1, cast=int)
+    # batches sent to workers but not committed to state yet, producer waits when limit is reached
+    ES_LOADING_MAX_IN_FLIGHT: int = config("ES_LOADING_MAX_IN_FLIGHT", default=4, cast=int)
+    # keep digests of loaded documents in state folder, don't send documents which didn't change since the last load.
+    # Digests are local to process, so it can't be combined with ETL_LEASES
+    ES_SKIP_UNCHANGED_DOCUMENTS: bool = config("ES_SKIP_UNCHANGED_DOCUMENTS", default=False, cast=bool)
+    # apply persons renames to movies documents by update_by_query instead of re-indexing whole movies
+    ES_PARTIAL_PERSON_UPDATES: bool = config("ES_PARTIAL_PERSON_UPDATES", default=False, cast=bool)
     ES_MOVIES_INDEX: str = config("ES_MOVIES_INDEX", default="movies")
     ES_GENRE_INDEX: str = config("ES_GENRE_INDEX", default="genres")
     ES_PERSONS_INDEX: str = config("ES_PERSONS_INDEX", default="persons")
     ES_CONNECT_TIMEOUT = config("ES_CONNECT_TIMEOUT", default=60, cast=int)
     ES_STARTUP_TIMEOUT = config("ES_STARTUP_TIMEOUT", default=120, cast=int)
+    # sync movies by worker processes, each of them owns a hash range of movies ids and keeps own checkpoints.
+    # Shards sync movies by planned sync only, digests and persons renames checkpoints are not kept per shard.
+    # Changing it starts new shards from scratch - movies are fully reindexed, old shards states are left unused.
+    # Shards checkpoints are local to process, so it can't be combined with ETL_LEASES
+    ETL_SHARDS: int = config("ETL_SHARDS", default=1, cast=int)
+    # asyncio ETL runner settings
+    ASYNC_PAGES_IN_FLIGHT: int = config("ASYNC_PAGES_IN_FLIGHT", default=4, cast=int)
+    ASYNC_BULKS_IN_FLIGHT: int = config("ASYNC_BULKS_IN_FLIGHT", default=4, cast=int)
 
     @validator('UPDATES_CHECK_INTERVAL_SEC')
     def updates_check_interval_sec_correlates_with_hangup_timeout(cls, v, values):
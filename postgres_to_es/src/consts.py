@@ -1,6 +1,8 @@
 import datetime
+import uuid
 
 DEFAULT_DATE = datetime.datetime(year=1970, month=12, day=31, tzinfo=datetime.timezone.utc)
+DEFAULT_ID = uuid.UUID(int=0)  # (DEFAULT_DATE, DEFAULT_ID) is the keyset which precedes any row
 DATE_PARSE_PATTERN = "%Y-%m-%d %H:%M:%S.%f%z"
 DEFAULT_SETTING_FOR_ES_INDEX = {
     "refresh_interval": "1s",
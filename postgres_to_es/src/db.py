@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List, Optional, Set, Union
+from uuid import UUID
+from weakref import WeakKeyDictionary
+
+import psycopg2
+from psycopg2.extensions import connection as _connection, cursor as _cursor
+from psycopg2.extras import DictCursor
+
+from src.config import CONFIG
+
+logger = logging.getLogger(__name__)
+DSN = {"dbname": CONFIG.DB_NAME, "user": CONFIG.DB_USER, "password": CONFIG.DB_PASSWORD, "host": CONFIG.DB_HOST,
+       "port": CONFIG.DB_PORT}
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+# names of statements prepared at every connection. Prepared statements live as long as DB session does
+_prepared_statements: "WeakKeyDictionary[_connection, Set[str]]" = WeakKeyDictionary()
+
+
+@dataclass
+class _PooledConnection:
+    connection: _connection
+    created_at: float = field(default_factory=time.monotonic)
+    released_at: float = field(default_factory=time.monotonic)
+
+
+class ConnectionPool:
+    """
+    Pool of Postgres connections shared by all of ETL producers.
+    Connections which were idle for more than healthcheck_idle_sec are checked before being borrowed, connections older
+    than max_lifetime_sec are closed and replaced by new ones. Borrower waits for up to acquire_timeout_sec for
+    a connection when all of them are taken.
+    """
+
+    def __init__(self, dsn: dict, max_size: int, max_lifetime_sec: int, healthcheck_idle_sec: int,
+                 acquire_timeout_sec: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.max_lifetime_sec = max_lifetime_sec
+        self.healthcheck_idle_sec = healthcheck_idle_sec
+        self.acquire_timeout_sec = acquire_timeout_sec
+        self._idle: List[_PooledConnection] = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def _is_healthy(self, pooled: _PooledConnection) -> bool:
+        if pooled.connection.closed:
+            return False
+        if time.monotonic() - pooled.created_at > self.max_lifetime_sec:
+            logger.debug("Connection reached max lifetime")
+            return False
+        if time.monotonic() - pooled.released_at < self.healthcheck_idle_sec:
+            return True
+
+        try:
+            with pooled.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            pooled.connection.rollback()
+            return True
+        except psycopg2.Error:
+            logger.warning("Pooled connection is broken")
+            return False
+
+    def _acquire(self) -> _PooledConnection:
+        deadline = time.monotonic() + self.acquire_timeout_sec
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RuntimeError(f"No Postgres connection released in {self.acquire_timeout_sec}s, all of "
+                                           f"{self.max_size} pooled connections are taken. Raise PG_POOL_MAX_SIZE "
+                                           f"or look for connections not returned to the pool")
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    pooled = self._idle.pop()
+                else:
+                    pooled = None
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    return _PooledConnection(psycopg2.connect(**self.dsn, cursor_factory=DictCursor))
+                except BaseException:
+                    self._forget()
+                    raise
+
+            if self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def _forget(self) -> None:
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        if not pooled.connection.closed:
+            pooled.connection.close()
+        self._forget()
+
+    def _release(self, pooled: _PooledConnection) -> None:
+        try:
+            pooled.connection.rollback()
+        except psycopg2.Error:
+            self._discard(pooled)
+            return
+
+        pooled.released_at = time.monotonic()
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[_connection]:
+        """
+        Borrows connection from the pool. Transaction left opened by borrower is rolled back on return,
+        connection is closed if it turns to be broken.
+        """
+        pooled = self._acquire()
+        try:
+            yield pooled.connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(pooled)
+            raise
+        except BaseException:
+            self._release(pooled)
+            raise
+        self._release(pooled)
+
+    def close(self) -> None:
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._discard(pooled)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns process-wide connection pool, creates it on the first call.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DSN, CONFIG.PG_POOL_MAX_SIZE, CONFIG.PG_POOL_MAX_LIFETIME_SEC,
+                                   CONFIG.PG_POOL_HEALTHCHECK_IDLE_SEC, CONFIG.PG_POOL_ACQUIRE_TIMEOUT_SEC)
+        return _pool
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def uuid_array(ids: Iterable[Union[UUID, str]]) -> str:
+    """
+    Builds uuid[] literal from ids - whole list is bound as a single query parameter.
+    """
+    return "{" + ",".join(map(str, ids)) + "}"
+
+
+def to_positional(query: str, names: List[str]) -> str:
+    """
+    Replaces pyformat placeholders (`%(name)s`) with positional ones ($1, $2...) in order of provided names.
+    """
+    return _PLACEHOLDER.sub(lambda m: f"${names.index(m[1]) + 1}", query)
+
+
+def execute_prepared(cursor: _cursor, query: str, params: dict) -> None:
+    """
+    Executes query with pyformat placeholders (`%(name)s`) as server-side prepared statement.
+    Statement is prepared once per connection, so query is parsed and planned only once across all of batches.
+    Positions of parameters follow order of params keys, so statement is keyed by query along with parameters names.
+    """
+    names = list(params)
+    statement = "etl_" + hashlib.md5("\0".join((query, *names)).encode()).hexdigest()
+    prepared = _prepared_statements.setdefault(cursor.connection, set())
+    if statement not in prepared:
+        logger.debug(f"Preparing statement {statement}")
+        cursor.execute(f"PREPARE {statement} AS {to_positional(query, names)}")
+        prepared.add(statement)
+
+    cursor.execute(f"EXECUTE {statement} ({', '.join(f'%({name})s' for name in names)})", params)
@@ -0,0 +1,145 @@
+"""
+Digests of documents loaded to Elasticsearch. Document whose digest didn't change since it was loaded is not sent
+to Elasticsearch again - e.g. when movie is re-fetched due to linked person change which doesn't affect it.
+"""
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, Iterable, Optional, Tuple, Union
+from uuid import UUID
+
+import orjson
+
+from src.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 8
+RECORD_SIZE = 16 + DIGEST_SIZE  # UUID bytes + digest
+UNKNOWN_DIGEST = bytes(DIGEST_SIZE)  # recorded for forgotten documents, never matches digest of real document
+
+
+def document_digest(document: dict) -> bytes:
+    return hashlib.blake2b(orjson.dumps(document), digest_size=DIGEST_SIZE).digest()
+
+
+class DocumentDigests:
+    """
+    Digests of documents of single index. Every digest is kept as 24-byte record - 16-byte id and 8-byte digest.
+    Records are appended to binary file and fsync-ed by sync(), file is rewritten when it holds twice more records
+    than there are documents.
+    """
+
+    def __init__(self, file_path: Optional[str]):
+        self.file_path = file_path
+        self._digests: Dict[bytes, bytes] = {}
+        self._records_in_file = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return
+
+        with open(self.file_path, "rb") as f:
+            data = f.read()
+        complete = len(data) - len(data) % RECORD_SIZE  # the last record may be partially written
+        for offset in range(0, complete, RECORD_SIZE):
+            self._digests[data[offset:offset + 16]] = data[offset + 16:offset + RECORD_SIZE]
+        self._records_in_file = complete // RECORD_SIZE
+        logger.debug(f"Loaded {len(self._digests)} documents digests from {self.file_path}")
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def is_unchanged(self, id_: Union[UUID, str], digest: bytes) -> bool:
+        return self._digests.get(UUID(str(id_)).bytes) == digest
+
+    def update(self, digests: Iterable[Tuple[Union[UUID, str], bytes]]) -> None:
+        """
+        Records digests of documents loaded to Elasticsearch.
+        """
+        with self._lock:
+            records = []
+            for id_, digest in digests:
+                key = UUID(str(id_)).bytes
+                if self._digests.get(key) != digest:
+                    self._digests[key] = digest
+                    records.append(key + digest)
+            if not records or self.file_path is None:
+                return
+
+            if self._records_in_file + len(records) > 2 * len(self._digests):
+                self._rewrite()
+                return
+
+            if self._file is None:
+                self._file = open(self.file_path, "ab")
+            self._file.write(b"".join(records))
+            self._records_in_file += len(records)
+
+    def forget(self, ids: Iterable[Union[UUID, str]]) -> None:
+        """
+        Forgets digests of documents changed in Elasticsearch bypassing the loader - e.g. by partial updates.
+        """
+        self.update((id_, UNKNOWN_DIGEST) for id_ in ids)
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _rewrite(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(key + digest for key, digest in self._digests.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        self._records_in_file = len(self._digests)
+
+    def reset(self) -> None:
+        """
+        Forgets all of digests - e.g. when index is re-created and all of documents must be loaded again.
+        """
+        with self._lock:
+            self._digests = {}
+            if self.file_path is not None:
+                self._rewrite()
+
+    def adopt(self, other: "DocumentDigests") -> None:
+        """
+        Replaces digests by digests of other index - alias of rebuilt index gets digests of its new version.
+        """
+        with self._lock, other._lock:
+            self._digests = dict(other._digests)
+            if self.file_path is not None:
+                self._rewrite()
+            if other._file is not None:
+                other._file.close()
+                other._file = None
+            if other.file_path is not None and os.path.exists(other.file_path):
+                os.remove(other.file_path)
+            other._digests = {}
+
+
+_digests: Dict[str, DocumentDigests] = {}
+_digests_lock = threading.Lock()
+
+
+def get_digests(index_name: str) -> DocumentDigests:
+    """
+    Returns process-wide digests of index documents, loads them from state folder on the first call.
+    """
+    with _digests_lock:
+        if index_name not in _digests:
+            _digests[index_name] = DocumentDigests(os.path.join(CONFIG.ETL_STATE_STORAGE_FOLDER,
+                                                                f"digests_{index_name}.bin"))
+        return _digests[index_name]
@@ -1,12 +1,14 @@
-import json
 import logging
-from typing import List
-
-import backoff
-import requests
+from contextlib import contextmanager, suppress
+from typing import Generator, Iterable, Iterator, List, Optional
 
 from src.config import CONFIG
-from src.models import FullMovie, Person, Roles, Genre
+from src.digests import document_digest, get_digests
+from src.lease import Lease
+from src.loading import BulkBatch, BulkLoader, BulkLoadingQueue, encode_action, send_bulk
+from src.metrics import metrics
+from src.models import Person, Roles, Genre
+from src.state import Checkpoint, State
 from src.wrappers import coroutine
 
 logger = logging.getLogger(__name__)
@@ -19,6 +21,10 @@ class LoaderException(Exception):
 @coroutine
 def transform_person_data(target):
     while person := (yield):
+        if isinstance(person, Checkpoint):
+            target.send(person)
+            continue
+
         person = Person(**person)
 
         transformed_data = {
@@ -28,58 +34,64 @@ def transform_person_data(target):
         target.send(transformed_data)
 
 
-@coroutine
-def transform_movie_data(target):
+ACTOR, WRITER, DIRECTOR = Roles.ACTOR.value, Roles.WRITER.value, Roles.DIRECTOR.value
+
+
+def transform_movies(movies: Iterable[dict]) -> List[dict]:
     """
-    Transforms movie from PG-extracted data to ready-to-be-loaded to ES.
+    Transforms page of PG-extracted movies to ready-to-be-loaded to ES documents.
+    Every movie's persons and genres are walked only once, no intermediate objects are built.
     """
-    while movie := (yield):  # type: dict
-        movie = FullMovie(**movie)
-        writers = set()
-        actors = set()
-        directors = set()
-        for name, id_, role in zip(movie.names, movie.persons_ids, movie.roles):
-            if role is not None and name is not None and id_ is not None:
-                role = Roles(role)
-                person = Person(full_name=name, id=id_, role=role)
-                if role == Roles.WRITER:
-                    writers.add(person)
-                elif role == Roles.ACTOR:
-                    actors.add(person)
-                elif role == Roles.DIRECTOR:
-                    directors.add(person)
-                else:
-                    raise ValueError(f"Unhandled role {role}")
-            elif role is None and name is None and id_ is None:
-                logger.debug(f"Empty persons info for movie {movie.title} {movie.fw_id}")
-            else:
+    documents = []
+    for movie in movies:
+        cast = {ACTOR: [], WRITER: [], DIRECTOR: []}
+        names = {ACTOR: [], WRITER: [], DIRECTOR: []}
+        for person in movie["persons"]:
+            role, id_, full_name = person["role"], person["id"], person["full_name"]
+            if role is None or full_name is None or id_ is None:
                 logger.error(f"Invalid persons at movie {movie}")
                 raise ValueError("Invalid persons data")
-
-        genres = set()
-        for genre, id_ in zip(movie.genres, movie.genres_ids):
-            if genre is not None and id_ is not None:
-                genres.add(Genre(name=genre, id=id_))
-            elif genre is None and id_ is None:
-                logger.debug("Empty genre info, skipping")
-            else:
+            if role not in cast:
+                raise ValueError(f"{role!r} is not a valid {Roles.__name__}")
+            cast[role].append({"id": id_, "name": full_name})
+            names[role].append(full_name)
+
+        genres = []
+        for genre in movie["genres"]:
+            if genre["name"] is None or genre["id"] is None:
                 logger.error(f"Invalid genre at movie {movie}")
                 raise ValueError("Invalid genres data")
+            genres.append({"id": genre["id"], "name": genre["name"]})
+
+        documents.append({
+            "id": str(movie["fw_id"]),
+            "imdb_rating": movie["rating"],
+            "genre": genres,
+            "title": movie["title"],
+            "description": movie["description"],
+            "directors_names": names[DIRECTOR],
+            "actors_names": names[ACTOR],
+            "writers_names": names[WRITER],
+            "actors": cast[ACTOR],
+            "writers": cast[WRITER],
+            "directors": cast[DIRECTOR]
+        })
+    return documents
 
-        transformed_data = {
-            "id": str(movie.fw_id),
-            "imdb_rating": movie.rating,
-            "genre": [{"id": str(g.id), "name": g.name} for g in genres],
-            "title": movie.title,
-            "description": movie.description,
-            "directors_names": [d.full_name for d in directors],
-            "actors_names": [a.full_name for a in actors],
-            "writers_names": [w.full_name for w in writers],
-            "actors": [{"id": str(a.id), "name": a.full_name} for a in actors],
-            "writers": [{"id": str(w.id), "name": w.full_name} for w in writers],
-            "directors": [{"id": str(w.id), "name": w.full_name} for w in directors]
-        }
-        target.send(transformed_data)
+
+@coroutine
+def transform_movie_data(target):
+    """
+    Transforms movies from PG-extracted data to ready-to-be-loaded to ES.
+    Accepts either a single movie or a whole page of movies - page is transformed at once by transform_movies.
+    """
+    while (movies := (yield)) is not None:
+        if isinstance(movies, Checkpoint):
+            target.send(movies)
+            continue
+
+        for document in transform_movies(movies if isinstance(movies, list) else [movies]):
+            target.send(document)
 
 
 @coroutine
@@ -88,6 +100,10 @@ def transform_genre_data(target):
     Transforms genre from PG-extracted data to ready-to-be-loaded to ES.
     """
     while genre := (yield):  # type: dict
+        if isinstance(genre, Checkpoint):
+            target.send(genre)
+            continue
+
         genre = Genre(
             id=genre['id'],
             name=genre['name'],
@@ -103,54 +119,118 @@ def transform_genre_data(target):
         target.send(transformed_data)
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def build_bulk_body(essences: List[dict], index_name: str) -> bytes:
+    """
+    Builds NDJSON body of bulk request which indexes provided essences.
+    """
+    return b"".join(encode_action(essence, index_name) for essence in essences)
+
+
 def perform_loading(essences: List[dict], index_name: str):
     """
     Performs loading of provided movies to Elasticsearch with retries.
     :essences: List of movies or genres information.
     """
-    request_body = []
     logger.debug("Loading another batch to ES")
+    batch = BulkBatch(index_name)
     for essence in essences:
-        header = {
-            "index": {
-                "_index": index_name,
-                "_id": essence["id"]
-            }
-        }
-        request_body.append(json.dumps(header))
-        request_body.append(json.dumps(essence))
-
-    request_body = "\n".join(request_body) + "\n"  # trailing \n is mandatory
-    response = requests.post(
-        url=f"{CONFIG.ELASTIC_URL}/_bulk",
-        headers={"Content-Type": "application/x-ndjson"},
-        data=request_body
-    )
-    response.raise_for_status()
-    if response.json()["errors"]:
-        logger.error(f"Error during loading to ES. {response.text}")
-        raise RuntimeError(f"Error during loading data to ES.")
+        batch.add(essence)
+    send_bulk(batch)
 
 
 @coroutine
-def load_essences(index_name: str):
+def load_essences(index_name: str, state: Optional[State] = None, lease: Optional[Lease] = None):
     """
     Loads essences batch to Elasticsearch.
+    Batch is flushed when it reaches LOAD_TO_ES_BY documents, ES_BULK_MAX_BYTES size or ES_BULK_MAX_LATENCY_SEC age.
+    Checkpoints received along with essences are applied when their batch and all of batches before it are loaded.
+    If state provided - it's flushed to disk after every committed batch.
+    If lease provided - batches are neither loaded nor committed once it's lost, LeaseLost is raised instead.
+    In pipelined mode batches are loaded by ES_LOADING_WORKERS background workers while producer extracts next ones,
+    producer is blocked when ES_LOADING_MAX_IN_FLIGHT batches are not committed yet.
+    If ES_SKIP_UNCHANGED_DOCUMENTS is set, documents which are the same as the last loaded ones are not sent at all.
     """
-    essences_loaded = 0
-    essences_batch = []
+    digests = get_digests(index_name) if CONFIG.ES_SKIP_UNCHANGED_DOCUMENTS else None
+
+    def load(batch: BulkBatch):
+        if lease is not None:
+            lease.ensure_held()
+        if batch.ids:
+            batch.indexed = send_bulk(batch)
+
+    def commit(batch: BulkBatch):
+        if lease is not None:
+            lease.ensure_held()
+        for checkpoint in batch.checkpoints:
+            checkpoint.apply()
+        if digests is not None:
+            # documents saved to dead letters are not remembered - they are sent again even if they don't change
+            digests.update((id_, digest) for id_, digest in zip(batch.ids, batch.digests) if id_ in batch.indexed)
+            digests.sync()
+        if state is not None:
+            state.flush()
+        metrics.increment(f"{index_name}.documents_written", len(batch.indexed))
+
+    def load_and_commit(batch: BulkBatch):
+        load(batch)
+        commit(batch)
+
+    loading_queue = None
+    if CONFIG.ES_PIPELINED_LOADING:
+        loading_queue = BulkLoadingQueue(load, commit, CONFIG.ES_LOADING_WORKERS, CONFIG.ES_LOADING_MAX_IN_FLIGHT)
+    bulk_loader = BulkLoader(index_name, loading_queue.put if loading_queue is not None else load_and_commit)
+    skipped = 0
     try:
         while essence_to_load := (yield):  # type: dict
-            essences_batch.append(essence_to_load)
-            if len(essences_batch) >= CONFIG.LOAD_TO_ES_BY:
-                perform_loading(essences_batch, index_name)
-                essences_loaded += len(essences_batch)
-                essences_batch = []
+            if lease is not None:
+                lease.ensure_held()  # skipped documents are progress as well
+            if isinstance(essence_to_load, Checkpoint):
+                bulk_loader.add_checkpoint(essence_to_load)
+            elif digests is None:
+                bulk_loader.add(essence_to_load)
+            else:
+                digest = document_digest(essence_to_load)
+                if digests.is_unchanged(essence_to_load["id"], digest):
+                    skipped += 1
+                    metrics.increment(f"{index_name}.documents_skipped")
+                else:
+                    bulk_loader.add(essence_to_load, digest)
     except GeneratorExit:
         logger.debug("Generator exit, loading last batch")
-        if len(essences_batch) > 0:
-            perform_loading(essences_batch, index_name)
-
-        essences_loaded += len(essences_batch)
-        logger.info(f"Loaded {essences_loaded} to {index_name} during this iteration")
+        try:
+            bulk_loader.flush()
+        finally:
+            bulk_loader.close()
+            if loading_queue is not None:
+                loading_queue.stop()
+        if loading_queue is not None:
+            loading_queue.close()  # raises error of loader threads
+        if state is not None:
+            state.flush()
+
+        logger.info(f"Loaded {bulk_loader.documents_flushed} to {index_name} during this iteration, "
+                    f"{skipped} unchanged documents skipped")
+    except BaseException:
+        bulk_loader.close()
+        if loading_queue is not None:
+            loading_queue.stop()
+        raise
+
+
+@contextmanager
+def loading_essences(index_name: str,
+                     state: Optional[State] = None,
+                     lease: Optional[Lease] = None) -> Iterator[Generator]:
+    """
+    Provides load_essences coroutine to the block. The last batch is loaded when the block completes. If the block
+    raises, loading is aborted instead - not flushed batch is dropped along with its checkpoints, loader threads are
+    stopped.
+    """
+    loader = load_essences(index_name, state, lease)
+    try:
+        yield loader
+    except BaseException as e:
+        with suppress(BaseException):  # loader re-raises error of the block
+            loader.throw(e)
+        raise
+    loader.close()
@@ -0,0 +1,207 @@
+"""
+Leases of ETL jobs kept at content.etl_lease table (see movies_admin migrations), so several ETL processes may run
+against the same database: every pipeline is run by a single process at a time, other processes stay hot standbys.
+Lease is taken over if its holder didn't renew it for PROCESS_HANGUP_TIMEOUT_SEC - holder crashed, hanged or lost
+connection to the database. Lease is renewed only while its job makes progress, so a stalled job loses it as well.
+Lease of pipeline carries checkpoints of its holder, renewed with every heartbeat and saved on release, so process
+which takes the pipeline over continues from them instead of its own stale state.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+from uuid import uuid4
+
+import backoff
+import psycopg2.errors
+from psycopg2.extras import Json
+
+from src.config import CONFIG
+from src.db import get_pool
+from src.state import State
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_LEASE_QUERY = """
+    INSERT INTO content.etl_lease AS lease (name, holder, acquired_at, renewed_at, checkpoints)
+    VALUES (%(name)s, %(holder)s, now(), now(), %(checkpoints)s)
+    ON CONFLICT (name) DO UPDATE SET
+        holder = excluded.holder,
+        acquired_at = CASE WHEN lease.holder = excluded.holder THEN lease.acquired_at ELSE now() END,
+        renewed_at = now(),
+        checkpoints = CASE WHEN lease.holder = excluded.holder
+                           THEN COALESCE(excluded.checkpoints, lease.checkpoints) ELSE lease.checkpoints END
+    WHERE lease.holder = excluded.holder OR lease.renewed_at < now() - make_interval(secs => %(timeout)s)
+    RETURNING acquired_at, checkpoints
+"""
+# released lease is kept expired, so its checkpoints are taken over along with it
+RELEASE_LEASE_QUERY = """
+    UPDATE content.etl_lease SET renewed_at = '-infinity', checkpoints = COALESCE(%(checkpoints)s, checkpoints)
+    WHERE name = %(name)s AND holder = %(holder)s
+"""
+LEASE_HELD_QUERY = """
+    SELECT 1 FROM content.etl_lease WHERE name = %(name)s AND renewed_at >= now() - make_interval(secs => %(timeout)s)
+"""
+# identifies this process among ETL processes, random suffix distinguishes restarted process with the same pid
+HOLDER = f"{CONFIG.ETL_NODE_NAME or socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+class LeaseLost(Exception):
+    """
+    Lease is taken over by other process or is not renewed in time, so its job must be stopped.
+    """
+
+
+class Lease:
+    """
+    Named lease held by this process. Holder renews lease by acquiring it again, lease which is not renewed in time
+    may be acquired by other process.
+    If state of pipeline is bound, pipeline's checkpoints are saved to lease by every renewal and loaded to state
+    when lease is acquired.
+    """
+
+    def __init__(self,
+                 name: str,
+                 state: Optional[State] = None,
+                 pipeline: Optional[str] = None,
+                 holder: str = HOLDER,
+                 timeout_sec: int = CONFIG.PROCESS_HANGUP_TIMEOUT_SEC):
+        self.name = name
+        self.state = state
+        self.pipeline = pipeline
+        self.holder = holder
+        self.timeout_sec = timeout_sec
+        self.held = False
+        self.renewed_at = 0.0  # time.monotonic() of the last successful renewal
+        self.progressed_at = 0.0  # time.monotonic() of the last ensure_held() of job
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def get_checkpoints(self) -> Optional[Json]:
+        if self.state is None:
+            return None
+        return Json(self.state.get_checkpoints(self.pipeline))
+
+    @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+    def acquire(self) -> bool:
+        """
+        Acquires free or expired lease, or renews lease already held. Returns True if lease is held by this process.
+        """
+        renewing_at = time.monotonic()
+        # checkpoints of the previous holder are kept until this process starts to sync
+        checkpoints = self.get_checkpoints() if self.held else None
+        with get_pool().connection() as connection, connection.cursor() as cursor:
+            cursor.execute(ACQUIRE_LEASE_QUERY, {"name": self.name, "holder": self.holder,
+                                                 "timeout": self.timeout_sec, "checkpoints": checkpoints})
+            row = cursor.fetchone()
+            connection.commit()
+
+        if row is not None and not self.held:
+            logger.info(f"Lease {self.name} acquired by {self.holder}")
+            if self.state is not None and row["checkpoints"]:
+                self.state.complete_pipeline_sync(self.pipeline)  # synced ids belong to the abandoned sync
+                self.state.set_checkpoints(row["checkpoints"])
+                logger.info(f"{self.pipeline} sync continues from checkpoints of lease {self.name}")
+        elif row is None and self.held:
+            logger.warning(f"Lease {self.name} was taken over by other process")
+        self.held = row is not None
+        if self.held:
+            self.renewed_at = renewing_at
+        return self.held
+
+    def is_held(self) -> bool:
+        """
+        Whether lease is still held - it's not taken over and it was renewed recently enough that it can't expire yet.
+        """
+        return self.held and time.monotonic() - self.renewed_at < self.timeout_sec / 2
+
+    def ensure_held(self) -> None:
+        """
+        Raises LeaseLost if lease is not held anymore, so job doesn't write along with its new holder.
+        Job calls it at every step, so it also marks job's progress - lease is kept alive only while job progresses.
+        """
+        if not self.is_held():
+            raise LeaseLost(f"Lease {self.name} is lost")
+        self.progressed_at = time.monotonic()
+
+    @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+    def release(self, checkpoints: Optional[Dict[str, str]] = None) -> None:
+        """
+        Releases lease if it's held, so standby process doesn't have to wait for the lease expiration.
+        Checkpoints of bound state, or provided ones, are saved to lease for the next holder.
+        """
+        if not self.held:
+            return
+
+        checkpoints = Json(checkpoints) if checkpoints is not None else self.get_checkpoints()
+        with get_pool().connection() as connection, connection.cursor() as cursor:
+            cursor.execute(RELEASE_LEASE_QUERY, {"name": self.name, "holder": self.holder, "checkpoints": checkpoints})
+            connection.commit()
+        self.held = False
+        logger.info(f"Lease {self.name} released")
+
+    def wait(self) -> None:
+        """
+        Blocks until lease is acquired.
+        """
+        while not self.acquire():
+            logger.debug(f"Lease {self.name} is held by other process, waiting")
+            time.sleep(self.timeout_sec / 4)
+
+    @contextmanager
+    def keep_alive(self, progressed_at: Optional[Callable[[], float]] = None) -> Iterator[None]:
+        """
+        Renews held lease in background while the block runs - block may last longer than lease timeout.
+        Lease is renewed only if block made progress - called ensure_held() - within the lease timeout, so lease of
+        hanged block expires and is taken over. Progress may be tracked by other function, e.g. by progress of other
+        leases. If lease is lost meanwhile, `held` turns to False and renewals stop - block is expected to check
+        ensure_held() and abort. Nested keep_alive() of the same lease is a no-op.
+        """
+        if self._heartbeat is not None:
+            yield
+            return
+
+        progressed_at = progressed_at or (lambda: self.progressed_at)
+        self.progressed_at = time.monotonic()
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(self.timeout_sec / 4):
+                if time.monotonic() - progressed_at() >= self.timeout_sec:
+                    logger.warning(f"Job of lease {self.name} stalled, lease is not renewed anymore")
+                    return
+                try:
+                    if not self.acquire():
+                        return
+                except psycopg2.Error:
+                    logger.exception(f"Failed to renew lease {self.name}")
+
+        self._heartbeat = threading.Thread(target=renew, name=f"lease-{self.name}", daemon=True)
+        self._heartbeat.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def is_lease_held(name: str, timeout_sec: int = CONFIG.PROCESS_HANGUP_TIMEOUT_SEC) -> bool:
+    """
+    Whether lease is held by any process at the moment.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(LEASE_HELD_QUERY, {"name": name, "timeout": timeout_sec})
+        held = cursor.fetchone() is not None
+        connection.commit()
+    return held
+
+
+def get_lease(name: str, state: Optional[State] = None, pipeline: Optional[str] = None) -> Optional[Lease]:
+    """
+    Returns lease of ETL job if leases are enabled by ETL_LEASES. State is bound to lease of pipeline.
+    """
+    return Lease(name, state, pipeline) if CONFIG.ETL_LEASES else None
@@ -0,0 +1,538 @@
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+import backoff
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.config import CONFIG
+from src.metrics import metrics
+from src.state import Checkpoint
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 503}
+BODY_CHUNK_BYTES = 64 * 1024
+BULK_SIZE_DECREASE_FACTOR = 0.5
+PIPELINES_SHARING_SESSION = 3  # movies, genres and persons pipelines load concurrently by the same session
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_dead_letters_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns process-wide HTTP session which keeps connections to Elasticsearch alive between bulk requests.
+    Connections pool fits loading workers of all of pipelines, so connections are not discarded when they run at once.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            pool_size = max(CONFIG.ES_LOADING_WORKERS, 1) * PIPELINES_SHARING_SESSION
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+@lru_cache()
+def _action_header_prefix(index_name: str) -> bytes:
+    return b'{"index":{"_index":' + orjson.dumps(index_name) + b',"_id":'
+
+
+def encode_action(essence: dict, index_name: str) -> bytes:
+    """
+    Encodes bulk index action for essence - header and source lines. Header is built from prefix precomputed for index.
+    """
+    return b"".join((_action_header_prefix(index_name), orjson.dumps(essence["id"]), b"}}\n",
+                     orjson.dumps(essence), b"\n"))
+
+
+def iter_chunks(actions: Iterable[bytes], chunk_size: int = BODY_CHUNK_BYTES) -> Iterator[bytes]:
+    """
+    Groups encoded actions to chunks of about chunk_size bytes, so body is streamed without being joined as a whole.
+    """
+    chunk, size = [], 0
+    for action in actions:
+        chunk.append(action)
+        size += len(action)
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+@dataclass
+class BulkBatch:
+    index_name: str
+    actions: List[bytes] = field(default_factory=list)
+    ids: List[str] = field(default_factory=list)
+    size: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    sent: int = 0  # bytes sent over the wire, including retries
+    checkpoints: List[Checkpoint] = field(default_factory=list)
+    digests: List[bytes] = field(default_factory=list)  # digests of documents, if documents are deduplicated
+    indexed: Set[str] = field(default_factory=set)  # ids of documents accepted by Elasticsearch, set by loading
+
+    def add(self, essence: dict, digest: Optional[bytes] = None):
+        self.add_action(encode_action(essence, self.index_name), essence["id"])
+        if digest is not None:
+            self.digests.append(digest)
+
+    def add_action(self, action: bytes, id_: str):
+        self.actions.append(action)
+        self.ids.append(id_)
+        self.size += len(action)
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(self.actions)
+
+    def iter_body(self) -> Iterator[bytes]:
+        """
+        Yields body of bulk request by chunks, gzipped if ES_BULK_GZIP is set.
+        """
+        chunks = iter_chunks(self.actions)
+        if CONFIG.ES_BULK_GZIP:
+            chunks = gzip_chunks(chunks, CONFIG.ES_BULK_GZIP_LEVEL)
+        for chunk in chunks:
+            self.sent += len(chunk)
+            yield chunk
+
+
+class AdaptiveBatchSize:
+    """
+    Documents per bulk request of index tuned by AIMD: size grows by ES_BULK_SIZE_STEP after every full batch loaded
+    within ES_BULK_TARGET_LATENCY_SEC and is halved when Elasticsearch rejects documents with 429 or responds slower.
+    Size is kept within ES_BULK_MIN_DOCS..ES_BULK_MAX_DOCS, it's shared by all of loading workers of index.
+    """
+
+    def __init__(self,
+                 index_name: str,
+                 initial: int = CONFIG.LOAD_TO_ES_BY,
+                 min_docs: int = CONFIG.ES_BULK_MIN_DOCS,
+                 max_docs: int = CONFIG.ES_BULK_MAX_DOCS,
+                 step: int = CONFIG.ES_BULK_SIZE_STEP,
+                 target_latency_sec: float = CONFIG.ES_BULK_TARGET_LATENCY_SEC):
+        self.index_name = index_name
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.step = step
+        self.target_latency_sec = target_latency_sec
+        self.size = min(max(initial, min_docs), max_docs)
+        self._lock = threading.Lock()
+        metrics.set(f"{index_name}.bulk_size", self.size)
+
+    def observe(self, docs: int, latency_sec: float, rejected: int) -> None:
+        """
+        Adjusts size by result of bulk request of docs documents, rejected of them were rejected with 429.
+        """
+        with self._lock:
+            previous = self.size
+            if rejected or latency_sec > self.target_latency_sec:
+                self.size = max(int(self.size * BULK_SIZE_DECREASE_FACTOR), self.min_docs)
+            elif docs >= self.size:
+                self.size = min(self.size + self.step, self.max_docs)
+
+            if self.size != previous:
+                metrics.set(f"{self.index_name}.bulk_size", self.size)
+                logger.info(f"Bulk size of {self.index_name} changed from {previous} to {self.size} docs: "
+                            f"{docs} docs loaded in {latency_sec:.3f}s, {rejected} rejected")
+
+
+_batch_sizes: Dict[str, AdaptiveBatchSize] = {}
+_batch_sizes_lock = threading.Lock()
+
+
+def get_batch_size(index_name: str) -> Optional[AdaptiveBatchSize]:
+    """
+    Returns process-wide adaptive batch size of index, or None if ES_ADAPTIVE_BULK_SIZE is not set.
+    """
+    if not CONFIG.ES_ADAPTIVE_BULK_SIZE:
+        return None
+
+    with _batch_sizes_lock:
+        if index_name not in _batch_sizes:
+            _batch_sizes[index_name] = AdaptiveBatchSize(index_name)
+        return _batch_sizes[index_name]
+
+
+def _report_rejected_request(details: dict):
+    """
+    Reports bulk request rejected as a whole with 429 to adaptive batch size.
+    """
+    batch, error = details["args"][0], sys.exc_info()[1]
+    batch_size = get_batch_size(batch.index_name)
+    if batch_size is not None and isinstance(error, requests.HTTPError) and error.response.status_code == 429:
+        batch_size.observe(len(batch.ids), details["elapsed"], len(batch.ids))
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT,
+                      on_backoff=_report_rejected_request)
+def _post_bulk(batch: BulkBatch, headers: dict) -> requests.Response:
+    # body is sent with chunked transfer encoding, every attempt streams it from the beginning
+    response = get_session().post(url=f"{CONFIG.ELASTIC_URL}/_bulk", headers=headers, data=batch.iter_body())
+    response.raise_for_status()
+    return response
+
+
+def write_dead_letters(records: List[dict]):
+    """
+    Appends permanently rejected documents to dead letter NDJSON file.
+    """
+    if not records:
+        return
+
+    path = CONFIG.ES_DEAD_LETTER_FILE or os.path.join(CONFIG.ETL_STATE_STORAGE_FOLDER, "dead_letter.ndjson")
+    with _dead_letters_lock, open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    logger.error(f"{len(records)} documents rejected by Elasticsearch, saved to {path}")
+
+
+def split_bulk_result(batch: BulkBatch, items: List[dict]) -> BulkBatch:
+    """
+    Sorts out per-item results of bulk request. Rejected documents are saved to dead letter file, documents which
+    failed due to Elasticsearch overload are returned as a batch to be retried.
+    """
+    retry = BulkBatch(batch.index_name)
+    rejected = []
+    for action, id_, item in zip(batch.actions, batch.ids, items):
+        result = next(iter(item.values()))
+        if result["status"] < 300:
+            continue
+
+        if result["status"] in RETRYABLE_STATUSES:
+            retry.add_action(action, id_)
+        else:
+            rejected.append({
+                "index": batch.index_name,
+                "id": id_,
+                "status": result["status"],
+                "error": result.get("error"),
+                "document": json.loads(action.split(b"\n")[1]),
+                "rejected_at": str(datetime.now(timezone.utc)),
+            })
+
+    write_dead_letters(rejected)
+    return retry
+
+
+def send_bulk(batch: BulkBatch) -> Set[str]:
+    """
+    Sends batch to Elasticsearch with retries, body is gzipped if ES_BULK_GZIP is set. Reports flush throughput.
+    Only failed items of the batch are retried, documents rejected permanently are saved to dead letter file.
+    Returns ids of documents which are indexed.
+    """
+    headers = {"Content-Type": "application/x-ndjson"}
+    if CONFIG.ES_BULK_GZIP:
+        headers["Content-Encoding"] = "gzip"
+
+    batch_size = get_batch_size(batch.index_name)
+    started_at = time.monotonic()
+    pending, attempt, sent, indexed = batch, 0, 0, set()
+    while True:
+        posted_at = time.monotonic()
+        result = _post_bulk(pending, headers).json()
+        latency, posted = time.monotonic() - posted_at, pending
+        sent += pending.sent
+        if result["errors"]:
+            indexed.update(id_ for id_, item in zip(pending.ids, result["items"])
+                           if next(iter(item.values()))["status"] < 300)
+            pending = split_bulk_result(pending, result["items"])
+        else:
+            indexed.update(pending.ids)
+            pending = BulkBatch(batch.index_name)
+
+        if batch_size is not None:
+            batch_size.observe(len(posted.ids), latency, len(pending.ids))
+        if not pending.ids:
+            break
+
+        delay = min(2 ** attempt, 30)
+        if time.monotonic() - started_at + delay > CONFIG.ES_BULK_RETRY_MAX_TIME_SEC:
+            raise RuntimeError(f"Unable to load {len(pending.ids)} documents to {batch.index_name}, "
+                               f"Elasticsearch keeps rejecting them")
+        logger.warning(f"Elasticsearch rejected {len(pending.ids)} documents, retrying in {delay}s")
+        time.sleep(delay)
+        attempt += 1
+
+    elapsed = max(time.monotonic() - started_at, 1e-6)
+    logger.info(f"Loaded {len(batch.ids)} docs to {batch.index_name}: {batch.size / 1024:.1f} KiB "
+                f"({sent / 1024:.1f} KiB sent) in {elapsed:.3f}s, {len(batch.ids) / elapsed:.0f} docs/s, "
+                f"{batch.size / 1024 / 1024 / elapsed:.2f} MiB/s")
+    return indexed
+
+
+# renames persons in movie document and rebuilds names lists, document is not re-indexed if nothing changed
+RENAME_PERSONS_SCRIPT = """
+    boolean changed = false;
+    for (String role : params.roles) {
+        List persons = ctx._source[role];
+        if (persons == null) {
+            continue;
+        }
+        List names = new ArrayList();
+        for (def person : persons) {
+            String name = params.names.get(person.id);
+            if (name != null && name != person.name) {
+                person.name = name;
+                changed = true;
+            }
+            names.add(person.name);
+        }
+        ctx._source[role + '_names'] = names;
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+"""
+PERSONS_ROLES = ("actors", "writers", "directors")
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def update_persons_names(index_name: str, names: Dict[str, str]) -> int:
+    """
+    Renames persons in all of movies they participate in by update_by_query - only persons and names fields of
+    matched documents are changed. Returns amount of updated documents.
+    Index is refreshed first - update_by_query searches only documents visible to search, movies bulk loaded since
+    the last refresh would keep old names otherwise. Movies written concurrently by movies pipeline are skipped as
+    version conflicts instead of failing the whole request - that pipeline loads them with actual names anyway.
+    """
+    response = get_session().post(url=f"{CONFIG.ELASTIC_URL}/{index_name}/_refresh")
+    response.raise_for_status()
+
+    body = {
+        "query": {"bool": {"should": [
+            {"nested": {"path": role, "query": {"terms": {f"{role}.id": list(names)}}}} for role in PERSONS_ROLES
+        ]}},
+        "script": {"lang": "painless", "source": RENAME_PERSONS_SCRIPT,
+                   "params": {"roles": PERSONS_ROLES, "names": names}},
+    }
+    response = get_session().post(url=f"{CONFIG.ELASTIC_URL}/{index_name}/_update_by_query",
+                                  params={"conflicts": "proceed"},
+                                  headers={"Content-Type": "application/json"}, data=orjson.dumps(body))
+    response.raise_for_status()
+    result = response.json()
+    if result["failures"]:
+        logger.error(f"Persons renaming failed: {result['failures']}")
+        raise RuntimeError(f"Unable to rename persons in {index_name}")
+    if result.get("version_conflicts"):
+        logger.warning(f"{result['version_conflicts']} movies of {index_name} were changed concurrently and are not "
+                       f"renamed by query, they are left to movies pipeline")
+
+    logger.debug(f"Renamed {len(names)} persons in {result['updated']} movies of {index_name}")
+    return result["updated"]
+
+
+class BulkLoader:
+    """
+    Accumulates essences to bulk batches. Batch is flushed as soon as it reaches max_docs documents (adaptive batch
+    size if ES_ADAPTIVE_BULK_SIZE is set) or max_bytes of body, or its first document has been waiting for longer than
+    max_latency_sec. Latency is watched by flusher thread of loader, so batch is flushed in time even if producer
+    stalls - e.g. while waiting for a slow query. Flushes of producer and flusher are serialized by loader's lock,
+    so batches are handed over one by one in order. Error of flush by flusher is raised by the next add or flush.
+    Loader must be closed to stop its flusher.
+    """
+
+    def __init__(self,
+                 index_name: str,
+                 flush: Callable[[BulkBatch], None],
+                 max_docs: int = CONFIG.LOAD_TO_ES_BY,
+                 max_bytes: int = CONFIG.ES_BULK_MAX_BYTES,
+                 max_latency_sec: float = CONFIG.ES_BULK_MAX_LATENCY_SEC):
+        self.index_name = index_name
+        self._flush = flush
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_latency_sec = max_latency_sec
+        self.batch_size = get_batch_size(index_name)
+        self.batch = BulkBatch(index_name)
+        self.documents_flushed = 0
+        self._lock = threading.RLock()
+        self._batch_started = threading.Condition(self._lock)
+        self._flusher: Optional[threading.Thread] = None  # started by the first document
+        self._error: Optional[BaseException] = None
+        self._closed = False
+
+    def add(self, essence: dict, digest: Optional[bytes] = None):
+        with self._lock:
+            self._raise_if_failed()
+            if not self.batch.ids:
+                self.batch.started_at = time.monotonic()
+                self._start_flusher()
+                self._batch_started.notify()
+            self.batch.add(essence, digest)
+            if self._is_batch_ready():
+                self.flush()
+
+    def add_checkpoint(self, checkpoint: Checkpoint):
+        """
+        Attaches checkpoint to the current batch - it's committed together with essences added before it.
+        """
+        with self._lock:
+            self.batch.checkpoints.append(checkpoint)
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_expired, name=f"bulk-flusher-{self.index_name}",
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_expired(self):
+        with self._lock:
+            while not self._closed:
+                if not self.batch.ids:
+                    self._batch_started.wait()
+                    continue
+
+                expires_in = self.batch.started_at + self.max_latency_sec - time.monotonic()
+                if expires_in > 0:
+                    self._batch_started.wait(expires_in)
+                    continue
+
+                logger.debug(f"Flushing {len(self.batch.ids)} documents to {self.index_name} by latency")
+                try:
+                    self.flush()
+                except Exception as e:
+                    self._error = e
+                    return
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Bulk batch flush by latency failed") from self._error
+
+    def _is_batch_ready(self) -> bool:
+        max_docs = self.batch_size.size if self.batch_size is not None else self.max_docs
+        if len(self.batch.ids) >= max_docs or self.batch.size >= self.max_bytes:
+            return True
+        return time.monotonic() - self.batch.started_at >= self.max_latency_sec
+
+    def flush(self):
+        with self._lock:
+            self._raise_if_failed()
+            if not self.batch.ids and not self.batch.checkpoints:
+                return
+
+            batch, self.batch = self.batch, BulkBatch(self.index_name)
+            self._flush(batch)
+            self.documents_flushed += len(batch.ids)
+
+    def close(self):
+        """
+        Stops flusher, waits for its flush if it's running. Not flushed batch is left as is.
+        """
+        with self._lock:
+            self._closed = True
+            self._batch_started.notify()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+
+
+class BulkLoadingQueue:
+    """
+    Hands bulk batches over to pool of loader threads, so extraction from Postgres goes on while previous batches are
+    being loaded to Elasticsearch. Batches are loaded concurrently but committed strictly in order they were put -
+    batch is committed only when all of batches before it are loaded. Producer is blocked while max_in_flight batches
+    are not committed - memory is capped and Elasticsearch is not flooded with requests.
+    """
+
+    def __init__(self,
+                 load: Callable[[BulkBatch], None],
+                 commit: Callable[[BulkBatch], None],
+                 workers: int,
+                 max_in_flight: int):
+        self._load = load
+        self._commit = commit
+        self.max_in_flight = max_in_flight
+        self._queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+        self._put = 0  # sequence number of the next batch to be put
+        self._committed = 0  # sequence number of the next batch to be committed
+        self._loaded: Dict[int, BulkBatch] = {}  # batches loaded out of order, waiting for previous ones
+        self._stopped = False
+        self._workers = [threading.Thread(target=self._work, name=f"bulk-loader-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self):
+        while (item := self._queue.get()) is not None:
+            seq, batch = item
+            if self._error is not None:
+                continue  # pipeline is failed, just drain the queue
+
+            try:
+                self._load(batch)
+                self._commit_in_order(seq, batch)
+            except BaseException as e:
+                logger.exception("Batch loading failed")
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+
+    def _commit_in_order(self, seq: int, batch: BulkBatch):
+        with self._condition:
+            self._loaded[seq] = batch
+            while self._committed in self._loaded:
+                self._commit(self._loaded.pop(self._committed))
+                self._committed += 1
+            self._condition.notify_all()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Loading to Elasticsearch failed") from self._error
+
+    def put(self, batch: BulkBatch):
+        """
+        Enqueues batch for loading. Blocks while max_in_flight batches are not committed, raises if any of previous
+        batches failed.
+        """
+        with self._condition:
+            while self._put - self._committed >= self.max_in_flight and self._error is None:
+                self._condition.wait()
+            self._raise_if_failed()
+            self._queue.put((self._put, batch))
+            self._put += 1
+
+    def stop(self):
+        """
+        Waits until all of enqueued batches are processed and stops loader threads. Does nothing if already stopped.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def close(self):
+        """
+        Stops loader threads, raises if any of batches failed.
+        """
+        self.stop()
+        self._raise_if_failed()
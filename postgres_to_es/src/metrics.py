@@ -0,0 +1,27 @@
+"""
+Process-wide ETL counters and gauges. They are reported to log after every sync.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, float] = defaultdict(int)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._values[name] += value
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+metrics = Metrics()
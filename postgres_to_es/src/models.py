@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Optional, List
+from typing import Optional
 from uuid import UUID
 
 
@@ -19,21 +19,6 @@ class Person:
     modified: Optional[datetime] = None
 
 
-@dataclass
-class FullMovie:
-    fw_id: UUID
-    title: str
-    description: Optional[str]
-    rating: Optional[float]
-    created: datetime
-    modified: datetime
-    genres: List[str]
-    genres_ids: List[UUID]
-    names: List[str]
-    roles: List[str]
-    persons_ids: List[UUID]
-
-
 @dataclass(frozen=True)
 class Genre:
     id: UUID
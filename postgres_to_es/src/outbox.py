@@ -0,0 +1,122 @@
+"""
+Outbox source of ETL. Triggers at content tables put ids of changed movies, persons and genres to content.etl_outbox
+(see movies_admin migrations), ETL drains the outbox in id order. Detection of changes is a single range scan by
+primary key, link deletions are caught as well. Triggers are disabled by migration, so outbox doesn't grow while
+nothing drains it - they are switched by `enable-outbox` and `disable-outbox` commands of ETL, not by sync start.
+"""
+import logging
+import time
+from typing import Dict
+
+import backoff
+import psycopg2.errors
+
+from src.cdc import ChangedIds, load_changes
+from src.config import CONFIG
+from src.db import get_pool
+from src.lease import is_lease_held
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_TRIGGERS_QUERY = """
+    SELECT c.relname as table, t.tgenabled <> 'D' as enabled
+    FROM pg_trigger t
+    JOIN pg_class c ON c.oid = t.tgrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'content' AND t.tgname = 'etl_outbox_track'
+"""
+LOCK_OUTBOX_BATCH_QUERY = """
+    SELECT id, entity, entity_id
+    FROM content.etl_outbox
+    ORDER BY id
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+"""
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def get_outbox_tracking() -> Dict[str, bool]:
+    """
+    Returns whether outbox trigger is enabled by table. Empty if outbox is not migrated.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(OUTBOX_TRIGGERS_QUERY)
+        tracking = {row["table"]: row["enabled"] for row in cursor.fetchall()}
+        connection.commit()
+    return tracking
+
+
+def check_outbox_tracking(outbox_mode: bool) -> None:
+    """
+    Checks on sync start that outbox triggers match ETL mode, doesn't change them.
+    Outbox mode without triggers would miss changes, so it's refused. Triggers enabled in other modes only make
+    outbox grow - they may be used by other ETL process, so it's just reported.
+    """
+    tracking = get_outbox_tracking()
+    if outbox_mode and (not tracking or not all(tracking.values())):
+        raise RuntimeError("Outbox triggers are disabled, enable them by `postgres_to_es.py enable-outbox` first")
+    if not outbox_mode and any(tracking.values()):
+        logger.warning("Outbox triggers are enabled but ETL doesn't run in outbox mode - outbox grows unless other "
+                       "ETL process drains it, disable them by `postgres_to_es.py disable-outbox`")
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def set_outbox_tracking(enabled: bool) -> None:
+    """
+    Enables or disables outbox triggers, one-off command of operator. Triggers are altered only if their state
+    differs, tables are not locked otherwise. Records left in outbox are kept - they are drained when outbox mode is
+    used again.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(OUTBOX_TRIGGERS_QUERY)
+        to_alter = [row["table"] for row in cursor.fetchall() if row["enabled"] != enabled]
+        for table in to_alter:
+            action = "ENABLE" if enabled else "DISABLE"
+            cursor.execute(f"ALTER TABLE content.{table} {action} TRIGGER etl_outbox_track")
+        connection.commit()
+
+    altered = f"at {', '.join(to_alter)}" if to_alter else "- triggers were already in this state"
+    logger.info(f"Outbox tracking {'enabled' if enabled else 'disabled'} {altered}")
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def drain_outbox() -> int:
+    """
+    Loads changes recorded in outbox by batches of OUTBOX_DRAIN_BY records until outbox is empty.
+    Records of batch are locked while its changes are loaded and deleted only when they are loaded to Elasticsearch,
+    locked records are skipped - so several ETL processes may drain outbox concurrently.
+    Returns amount of drained records.
+    """
+    drained = 0
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        while True:
+            cursor.execute(LOCK_OUTBOX_BATCH_QUERY, {"limit": CONFIG.OUTBOX_DRAIN_BY})
+            records = cursor.fetchall()
+            if not records:
+                connection.commit()
+                return drained
+
+            changes = ChangedIds()
+            by_entity = {"movie": changes.movies, "person": changes.persons, "genre": changes.genres}
+            for record in records:
+                by_entity[record["entity"]].add(str(record["entity_id"]))
+
+            load_changes(changes)
+            cursor.execute("DELETE FROM content.etl_outbox WHERE id = ANY(%(ids)s)",
+                           {"ids": [record["id"] for record in records]})
+            connection.commit()
+            drained += len(records)
+            logger.debug(f"Drained {len(records)} outbox records up to {records[-1]['id']}")
+
+
+def run_outbox_process() -> None:
+    """
+    Drains outbox every OUTBOX_POLL_INTERVAL_SEC. Doesn't return.
+    Draining is paused while indexes are rebuilt - changes recorded meanwhile are loaded to the rebuilt indexes.
+    """
+    while True:
+        if CONFIG.ETL_LEASES and is_lease_held("rebuild"):
+            logger.debug("Indexes are being rebuilt, outbox draining is paused")
+        elif drained := drain_outbox():
+            logger.info(f"Drained {drained} outbox records")
+        time.sleep(CONFIG.OUTBOX_POLL_INTERVAL_SEC)
@@ -1,88 +1,211 @@
 import datetime
 import logging
-from typing import List
+from functools import partial
+from itertools import count, islice
+from typing import Callable, Dict, Iterator, List, Optional, Union
+from uuid import UUID
 
 import backoff
 import psycopg2
-from psycopg2.extensions import cursor as _cursor
+from psycopg2.extensions import connection as _connection, cursor as _cursor
 from psycopg2.extras import DictCursor
 
 from src.config import CONFIG
-from src.consts import DEFAULT_DATE
-from src.state import State
+from src.consts import DEFAULT_DATE, DEFAULT_ID
+from src.db import execute_prepared, get_pool, uuid_array
+from src.digests import get_digests
+from src.lease import Lease
+from src.loading import update_persons_names
+from src.sharding import Shard
+from src.state import Checkpoint, State
 from src.wrappers import coroutine
 
 logger = logging.getLogger(__name__)
-DSN = {"dbname": CONFIG.DB_NAME, "user": CONFIG.DB_USER, "password": CONFIG.DB_PASSWORD, "host": CONFIG.DB_HOST,
-       "port": CONFIG.DB_PORT}
+_cursors_counter = count()
+# queries are written with pyformat placeholders, they are shared with asyncio ETL runner
+MOVIES_BY_IDS_QUERY = """
+    SELECT
+        fw.id as fw_id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.created,
+        fw.modified,
+        COALESCE(g.genres, '[]') as genres,
+        COALESCE(p.persons, '[]') as persons
+    FROM content.film_work fw
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('id', g.id, 'name', g.name) ORDER BY g.name, g.id) as genres
+        FROM content.genre_film_work gfw
+        JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE gfw.film_work_id = fw.id
+    ) g ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT json_agg(
+            json_build_object('id', p.id, 'full_name', p.full_name, 'role', pfw.role) ORDER BY p.full_name, p.id
+        ) as persons
+        FROM content.person_film_work pfw
+        JOIN content.person p ON p.id = pfw.person_id
+        WHERE pfw.film_work_id = fw.id
+    ) p ON TRUE
+    WHERE fw.id = ANY(%(ids)s::uuid[])
+"""
+UPDATED_PERSONS_QUERY = """
+    SELECT id, modified, full_name
+    FROM content.person
+    WHERE (modified, id) > (%(modified)s, %(id)s)
+    ORDER BY modified, id
+"""
+UPDATED_GENRES_QUERY = """
+    SELECT
+        id,
+        name,
+        description,
+        modified
+    FROM content.genre
+    WHERE (modified, id) > (%(modified)s, %(id)s)
+    ORDER BY modified, id
+"""
+MOVIES_IDS_BY_PERSONS_QUERY = """
+    SELECT DISTINCT film_work_id as id
+    FROM content.person_film_work
+    WHERE person_id = ANY(%(ids)s::uuid[])
+"""
+LAST_MODIFIED_ROWS_QUERY = """
+    SELECT 'movie' as source, * FROM (
+        SELECT modified, id FROM content.film_work ORDER BY modified DESC, id DESC LIMIT 1
+    ) fw
+    UNION ALL
+    SELECT 'person' as source, * FROM (
+        SELECT modified, id FROM content.person ORDER BY modified DESC, id DESC LIMIT 1
+    ) p
+    UNION ALL
+    SELECT 'genre' as source, * FROM (
+        SELECT modified, id FROM content.genre ORDER BY modified DESC, id DESC LIMIT 1
+    ) g
+"""
+CHANGED_MOVIES_IDS_QUERY = """
+    SELECT fw.id
+    FROM content.film_work fw
+    WHERE (fw.modified, fw.id) > (%(movie_modified)s, %(movie_id)s)
+    UNION
+    SELECT pfw.film_work_id
+    FROM content.person p
+    JOIN content.person_film_work pfw ON pfw.person_id = p.id
+    WHERE (p.modified, p.id) > (%(person_modified)s, %(person_id)s)
+    UNION
+    SELECT gfw.film_work_id
+    FROM content.genre g
+    JOIN content.genre_film_work gfw ON gfw.genre_id = g.id
+    WHERE (g.modified, g.id) > (%(genre_modified)s, %(genre_id)s)
+"""
+
+
+def send_checkpoint(target, apply: Callable, *args) -> None:
+    """
+    Sends state change down the pipeline - it's applied only when everything sent before it is loaded.
+    """
+    target.send(Checkpoint(partial(apply, *args)))
 
 
-def get_movies_by_ids(ids: List[str], cursor: _cursor) -> List[dict]:
+def iter_updated_after(connection: _connection,
+                       query: str,
+                       updated_after: datetime.datetime,
+                       updated_after_id: UUID = DEFAULT_ID,
+                       params: Optional[dict] = None) -> Iterator[List[dict]]:
+    """
+    Iterates over query results by (modified, id) keyset and yields them by pages of FETCH_FROM_PG_BY rows.
+    Query must filter rows by `(modified, id) > (%(modified)s, %(id)s)` condition and order them by modified, id - so
+    rows sharing the same modified date are never lost on page boundaries.
+    In streaming mode query is executed once with server-side cursor which is read by PG_CURSOR_ITERSIZE rows,
+    otherwise every page is retrieved by the same prepared statement.
+    """
+    params = params or {}
+    if CONFIG.PG_STREAMING_EXTRACT:
+        with connection.cursor(f"etl_stream_{next(_cursors_counter)}", cursor_factory=DictCursor) as cursor:
+            cursor.itersize = CONFIG.PG_CURSOR_ITERSIZE
+            cursor.execute(query, {**params, "modified": updated_after, "id": updated_after_id})
+            rows = iter(cursor)
+            while page := list(islice(rows, CONFIG.FETCH_FROM_PG_BY)):
+                logger.debug(f"Streamed {len(page)} rows")
+                yield page
+        return
+
+    with connection.cursor(cursor_factory=DictCursor) as cursor:
+        while True:
+            execute_prepared(cursor, f"{query} LIMIT {CONFIG.FETCH_FROM_PG_BY}",
+                             {**params, "modified": updated_after, "id": updated_after_id})
+            page = cursor.fetchall()
+            logger.debug(f"Fetched {len(page)} rows")
+            if not page:
+                return
+
+            yield page
+            updated_after, updated_after_id = page[-1]["modified"], page[-1]["id"]
+
+
+def get_movies_by_ids(ids: List[Union[UUID, str]], cursor: _cursor) -> List[dict]:
     """
     Retrieves full movies data.
+    Genres and persons are aggregated by independent lateral subqueries - so every movie is a single row with
+    json arrays of its genres and persons, without rows multiplication by joining persons with genres.
     """
     logger.debug(f"Looking for {len(ids)} movies")
-    args = ",".join(cursor.mogrify("%s", (_id,)).decode() for _id in ids)
-    cursor.execute(f"""
-    SELECT
-        fw.id as fw_id, 
-        fw.title, 
-        fw.description, 
-        fw.rating, 
-        fw.created, 
-        fw.modified, 
-        array_agg(g.name) as genres,
-        array_agg(g.id) as genres_ids,
-        array_agg(p.full_name) as names,
-        array_agg(pfw.role) as roles,
-        array_agg(p.id) as persons_ids
-    FROM content.film_work fw
-    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-    LEFT JOIN content.person p ON p.id = pfw.person_id
-    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-    LEFT JOIN content.genre g ON g.id = gfw.genre_id
-    WHERE fw.id IN ({args})
-    GROUP BY fw_id;
-    """)
+    execute_prepared(cursor, MOVIES_BY_IDS_QUERY, {"ids": uuid_array(ids)})
     movies = cursor.fetchall()
     logger.debug(f"Found {len(movies)} movies by ids")
     return movies
 
 
-def fetch_updated_persons(cursor: _cursor, updated_after: datetime.datetime) -> List[dict]:
+def iter_updated_persons(connection: _connection,
+                         updated_after: datetime.datetime,
+                         updated_after_id: UUID = DEFAULT_ID) -> Iterator[List[dict]]:
     """
-    Extracts all persons updated after provided date.
+    Extracts all persons updated after provided keyset.
     """
-    cursor.execute(f"""
-                SELECT id, modified, full_name
-                FROM content.person
-                WHERE modified > %s
-                ORDER BY modified
-                LIMIT {CONFIG.FETCH_FROM_PG_BY};
-                """, (updated_after,))
-    updated_persons = cursor.fetchall()
-    logger.debug(f"Fetched {len(updated_persons)} persons")
-    return updated_persons
+    return iter_updated_after(connection, UPDATED_PERSONS_QUERY, updated_after, updated_after_id)
 
 
-def fetch_movies_by_persons(cursor: _cursor, persons: List[dict], updated_after: datetime.datetime):
+def iter_movies_by_persons(connection: _connection, persons: List[dict]) -> Iterator[List[dict]]:
     """
     Extracts movies where provided persons participate.
-    Also filters movies by updated_at.
+    Movies are ordered by (modified, id) keyset.
     """
-    args = ",".join(cursor.mogrify("%s", (person["id"],)).decode() for person in persons)
-    cursor.execute(f"""
-                    SELECT fw.id, fw.modified 
-                    FROM content.film_work fw 
-                    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id 
-                    WHERE modified > %s AND pfw.person_id IN ({args}) 
-                    ORDER BY fw.modified 
-                    LIMIT {CONFIG.FETCH_FROM_PG_BY};
-                    """, (updated_after,))
+    return iter_updated_after(connection, """
+                    SELECT DISTINCT fw.id, fw.modified
+                    FROM content.film_work fw
+                    JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+                    WHERE (fw.modified, fw.id) > (%(modified)s, %(id)s) AND pfw.person_id = ANY(%(ids)s::uuid[])
+                    ORDER BY fw.modified, fw.id
+                    """, DEFAULT_DATE, params={"ids": uuid_array(p["id"] for p in persons)})
 
-    linked_movies = cursor.fetchall()
-    logger.debug(f"Fetched {len(linked_movies)} linked movies")
-    return linked_movies
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def rename_persons_in_movies(state: State, index_name: str, lease: Optional[Lease] = None):
+    """
+    Applies names of persons updated since the last checkpoint to movies documents by partial updates, so movies are
+    neither fetched from Postgres nor re-indexed as a whole. Digests of renamed movies are forgotten.
+    Assumes that only person's own data may change without movie's updated_at change.
+    Renames stop with LeaseLost once lease is lost, if lease is provided.
+    """
+    digests = get_digests(index_name) if CONFIG.ES_SKIP_UNCHANGED_DOCUMENTS else None
+    with get_pool().connection() as connection, connection.cursor() as cursor:  # type: _cursor
+        date_start = state.last_person_for_movies_synced_at
+
+        for updated_persons in iter_updated_persons(connection, date_start, state.last_person_for_movies_synced_id):
+            if lease is not None:
+                lease.ensure_held()
+            update_persons_names(index_name, {str(p["id"]): p["full_name"] for p in updated_persons})
+            if digests is not None:
+                execute_prepared(cursor, MOVIES_IDS_BY_PERSONS_QUERY,
+                                 {"ids": uuid_array(p["id"] for p in updated_persons)})
+                digests.forget(row["id"] for row in cursor.fetchall())
+                digests.sync()
+
+            state.set_last_person_for_movies_synced_at(updated_persons[-1]["modified"], updated_persons[-1]["id"])
+            state.flush()
+
+        logger.debug(f"Persons updated after {date_start} renamed in movies")
 
 
 @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
@@ -91,48 +214,41 @@ def extract_movies_updated_due_to_person_change(target, state: State):
     """
     Data producer for movies which necessary to be synced due to linked persons data change.
     """
-    with psycopg2.connect(**DSN, cursor_factory=DictCursor).cursor() as cursor:  # type: _cursor
-        date_start = last_person_synced = state.last_person_for_movies_synced_at
+    with get_pool().connection() as connection, connection.cursor() as cursor:  # type: _cursor
+        date_start = state.last_person_for_movies_synced_at
 
-        while updated_persons := fetch_updated_persons(cursor, last_person_synced):
+        for updated_persons in iter_updated_persons(connection, date_start, state.last_person_for_movies_synced_id):
             # we don"t care when movie"s data changed - updated_at will not be changed if person data changes
             # updated_at is used as cursor to iterate over movies
-            last_movie_synced_by_persons_at = DEFAULT_DATE
-            while linked_movies := fetch_movies_by_persons(cursor, updated_persons, last_movie_synced_by_persons_at):
-                movies_ids_not_synced = [m["id"] for m in linked_movies if str(m["id"]) not in state.movies_synced]
+            for linked_movies in iter_movies_by_persons(connection, updated_persons):
+                movies_ids_not_synced = [m["id"] for m in linked_movies if m["id"] not in state.movies_synced]
 
                 if movies_ids_not_synced:
                     movies_to_send = get_movies_by_ids(movies_ids_not_synced, cursor)
-                    for movie in movies_to_send:
-                        target.send(movie)
-                        state.add_movies_synced([str(movie["fw_id"])])
-
-                logger.debug(f"Synced all movies updated after {last_movie_synced_by_persons_at} "
-                             f"for persons updated after {last_person_synced}. Searching for more movies")
+                    target.send(movies_to_send)
+                    send_checkpoint(target, state.add_movies_synced, [m["fw_id"] for m in movies_to_send])
 
-                last_movie_synced_by_persons_at = linked_movies[-1]["modified"]
+                logger.debug(f"Synced {len(linked_movies)} movies for persons updated after "
+                             f"{updated_persons[0]['modified']}. Searching for more movies")
 
-            last_person_synced = updated_persons[-1]["modified"]
-            state.set_last_person_for_movies_synced_at(last_person_synced)
+            send_checkpoint(target, state.set_last_person_for_movies_synced_at,
+                            updated_persons[-1]["modified"], updated_persons[-1]["id"])
 
         logger.debug(f"All movies linked with persons updated after {date_start}, shutting down receiving coroutine")
 
 
-def fetch_movies_updated_after(cursor: _cursor, updated_after: datetime.datetime) -> List[dict]:
+def iter_movies_updated_after(connection: _connection,
+                              updated_after: datetime.datetime,
+                              updated_after_id: UUID = DEFAULT_ID) -> Iterator[List[dict]]:
     """
-    Returns all movies updated after provided date.
+    Returns all movies updated after provided keyset.
     """
-    cursor.execute(f"""
+    return iter_updated_after(connection, """
                 SELECT id, modified
                 FROM content.film_work
-                WHERE modified > %s
-                ORDER BY modified
-                LIMIT {CONFIG.FETCH_FROM_PG_BY};
-                """, (updated_after,))
-
-    updated_movies = cursor.fetchall()
-    logger.debug(f"Fetched {len(updated_movies)} linked movies")
-    return updated_movies
+                WHERE (modified, id) > (%(modified)s, %(id)s)
+                ORDER BY modified, id
+                """, updated_after, updated_after_id)
 
 
 @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
@@ -142,87 +258,142 @@ def extract_movies_updated_due_to_movie_change(target, state: State):
     Data producer for movies which necessary to be synced due to movies itself change.
     Assumes that if genre or person relation is added/deleted to/from movie - movie"s updated_at field will be changed.
     """
-    with psycopg2.connect(**DSN, cursor_factory=DictCursor).cursor() as cursor:  # type: _cursor
+    with get_pool().connection() as connection, connection.cursor() as cursor:  # type: _cursor
 
-        date_start = last_movie_synced_at = state.last_movie_synced_at
-        while updated_movies := fetch_movies_updated_after(cursor, last_movie_synced_at):
-            movies_ids_not_synced = [m["id"] for m in updated_movies if str(m["id"]) not in state.movies_synced]
+        date_start = state.last_movie_synced_at
+        for updated_movies in iter_movies_updated_after(connection, date_start, state.last_movie_synced_id):
+            movies_ids_not_synced = [m["id"] for m in updated_movies if m["id"] not in state.movies_synced]
 
             if movies_ids_not_synced:
                 movies_to_send = get_movies_by_ids(movies_ids_not_synced, cursor)
-                for movie in movies_to_send:
-                    target.send(movie)
-                    state.add_movies_synced([str(movie["fw_id"])])
+                target.send(movies_to_send)
+                send_checkpoint(target, state.add_movies_synced, [m["fw_id"] for m in movies_to_send])
 
-            logger.debug(f"Synced all movies updated after {last_movie_synced_at} Searching for more movies")
-            last_movie_synced_at = updated_movies[-1]["modified"]
-            state.set_last_movie_synced_at(last_movie_synced_at)
+            logger.debug(f"Synced all movies updated after {updated_movies[0]['modified']} Searching for more movies")
+            send_checkpoint(target, state.set_last_movie_synced_at,
+                            updated_movies[-1]["modified"], updated_movies[-1]["id"])
 
         logger.debug(f"Finished with movies updated due to movie data change after {date_start}")
 
 
+def get_last_modified_rows(cursor: _cursor) -> Dict[str, dict]:
+    """
+    Returns (modified, id) keyset of the last changed movie, person and genre by source name.
+    Source is absent if its table is empty.
+    """
+    cursor.execute(LAST_MODIFIED_ROWS_QUERY)
+    return {row["source"]: row for row in cursor.fetchall()}
+
+
+def changed_movies_ids_params(state: State) -> dict:
+    """
+    Checkpoints of all sources of movies changes - parameters for CHANGED_MOVIES_IDS_QUERY.
+    """
+    return {"movie_modified": state.last_movie_synced_at, "movie_id": state.last_movie_synced_id,
+            "person_modified": state.last_person_for_movies_synced_at,
+            "person_id": state.last_person_for_movies_synced_id,
+            "genre_modified": state.last_genre_synced_at, "genre_id": state.last_genre_synced_id}
+
+
+def iter_changed_movies_ids(connection: _connection,
+                            state: State,
+                            shard: Optional[Shard] = None) -> Iterator[List[UUID]]:
+    """
+    Yields by pages ids of all movies which should be synced due to movie itself, linked person or linked genre change
+    since the last checkpoints. Ids from all of three sources are deduplicated by a single query.
+    Only ids owned by shard are yielded if shard is provided.
+    """
+    query, params = CHANGED_MOVIES_IDS_QUERY, changed_movies_ids_params(state)
+    if shard is not None:
+        query = f"SELECT id FROM ({query}) changed WHERE {shard.filter('id')}"
+        params.update(shard.params())
+
+    with connection.cursor(f"etl_plan_{next(_cursors_counter)}", cursor_factory=DictCursor) as cursor:
+        cursor.itersize = CONFIG.PG_CURSOR_ITERSIZE
+        cursor.execute(query, params)
+        rows = iter(cursor)
+        while page := [row["id"] for row in islice(rows, CONFIG.FETCH_FROM_PG_BY)]:
+            yield page
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+@coroutine
+def extract_updated_movies(target, state: State, shard: Optional[Shard] = None):
+    """
+    Data producer for movies which necessary to be synced due to movie, linked persons or linked genres change.
+    Plans the sync first - collects deduplicated ids of all changed movies, so every movie is fetched and sent only
+    once per iteration. Checkpoints of all three sources are advanced when the whole plan is completed, all of queries
+    are run in the same snapshot. Shard syncs only movies it owns, its state keeps checkpoints of the shard.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:  # type: _cursor
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        last_modified = get_last_modified_rows(cursor)
+
+        movies_synced = 0
+        for movies_ids in iter_changed_movies_ids(connection, state, shard):
+            movies_ids_not_synced = [id_ for id_ in movies_ids if id_ not in state.movies_synced]
+            if movies_ids_not_synced:
+                movies_to_send = get_movies_by_ids(movies_ids_not_synced, cursor)
+                target.send(movies_to_send)
+                send_checkpoint(target, state.add_movies_synced, [m["fw_id"] for m in movies_to_send])
+                movies_synced += len(movies_ids_not_synced)
+
+        if "movie" in last_modified:
+            send_checkpoint(target, state.set_last_movie_synced_at,
+                            last_modified["movie"]["modified"], last_modified["movie"]["id"])
+        if "person" in last_modified:
+            send_checkpoint(target, state.set_last_person_for_movies_synced_at,
+                            last_modified["person"]["modified"], last_modified["person"]["id"])
+        if "genre" in last_modified:
+            send_checkpoint(target, state.set_last_genre_synced_at,
+                            last_modified["genre"]["modified"], last_modified["genre"]["id"])
+
+        logger.debug(f"Planned sync of {movies_synced} changed movies completed")
+
+
 @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
 @coroutine
 def extract_genres_updated_due_to_genre_change(target, state: State):
     """
     Data producer for genres which necessary to be synced due to genres itself change.
     """
-    with psycopg2.connect(**DSN, cursor_factory=DictCursor).cursor() as cursor:  # type: _cursor
-
-        date_start = last_genre_synced_at = state.last_genre_for_genres_synced_at
-        while updated_genres := fetch_updated_genres(cursor, last_genre_synced_at):
-            genres_synced = state.genres_for_genres_synced
-            genres_to_send = [g for g in updated_genres if str(g["id"]) not in genres_synced]
+    with get_pool().connection() as connection:
+        date_start = state.last_genre_for_genres_synced_at
+        for updated_genres in iter_updated_genres(connection, date_start, state.last_genre_for_genres_synced_id):
+            genres_to_send = [g for g in updated_genres if g["id"] not in state.genres_for_genres_synced]
 
             for genre in genres_to_send:
                 target.send(genre)
-                state.add_genres_for_genres_synced([str(genre["id"])])
+            send_checkpoint(target, state.add_genres_for_genres_synced, [g["id"] for g in genres_to_send])
 
-            logger.debug(f"Synced all genres updated after {last_genre_synced_at} Searching for more genres")
-            last_genre_synced_at = updated_genres[-1]["modified"]
-            state.set_last_genre_for_genres_synced_at(last_genre_synced_at)
+            logger.debug(f"Synced all genres updated after {updated_genres[0]['modified']} Searching for more genres")
+            send_checkpoint(target, state.set_last_genre_for_genres_synced_at,
+                            updated_genres[-1]["modified"], updated_genres[-1]["id"])
 
         logger.debug(f"Finished with genres updated due to genre data change after {date_start}")
 
 
-def fetch_updated_genres(cursor: _cursor, updated_after: datetime.datetime) -> List[dict]:
+def iter_updated_genres(connection: _connection,
+                        updated_after: datetime.datetime,
+                        updated_after_id: UUID = DEFAULT_ID) -> Iterator[List[dict]]:
     """
-    Returns all genres updated after provided date
+    Returns all genres updated after provided keyset
     """
-    cursor.execute(f"""
-                SELECT
-                    id,
-                    name,
-                    description,
-                    modified
-                FROM content.genre
-                WHERE modified > %s
-                ORDER BY modified
-                LIMIT {CONFIG.FETCH_FROM_PG_BY};
-                """, (updated_after,))
-    updated_genres = cursor.fetchall()
-    logger.debug(f"Fetched {len(updated_genres)} genres")
-    return updated_genres
+    return iter_updated_after(connection, UPDATED_GENRES_QUERY, updated_after, updated_after_id)
 
 
-def fetch_movies_by_genres(cursor: _cursor, genres: List[dict], movie_updated_after: datetime.datetime) -> List[dict]:
+def iter_movies_by_genres(connection: _connection, genres: List[dict]) -> Iterator[List[dict]]:
     """
     Returns all movies related to provided genres list.
-    Also filters movies by provided updated_at field.
+    Movies are ordered by (modified, id) keyset.
     """
-    args = ",".join(cursor.mogrify("%s", (genre["id"],)).decode() for genre in genres)
-    cursor.execute(f"""
-                    SELECT fw.id, fw.modified 
-                    FROM content.film_work fw 
-                    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id 
-                    WHERE modified > %s AND gfw.genre_id IN ({args}) 
-                    ORDER BY fw.modified 
-                    LIMIT {CONFIG.FETCH_FROM_PG_BY};
-                    """, (movie_updated_after,))
-
-    linked_movies = cursor.fetchall()
-    logger.debug(f"Fetched {len(linked_movies)} linked movies")
-    return linked_movies
+    return iter_updated_after(connection, """
+                    SELECT DISTINCT fw.id, fw.modified
+                    FROM content.film_work fw
+                    JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+                    WHERE (fw.modified, fw.id) > (%(modified)s, %(id)s) AND gfw.genre_id = ANY(%(ids)s::uuid[])
+                    ORDER BY fw.modified, fw.id
+                    """, DEFAULT_DATE, params={"ids": uuid_array(g["id"] for g in genres)})
 
 
 @backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
@@ -231,27 +402,24 @@ def extract_movies_updated_due_to_genre_change(target, state: State):
     """
     Data producer for movies which necessary to be synced due to linked genre data change.
     """
-    with psycopg2.connect(**DSN, cursor_factory=DictCursor).cursor() as cursor:  # type: _cursor
+    with get_pool().connection() as connection, connection.cursor() as cursor:  # type: _cursor
 
-        date_start = last_genre_synced = state.last_genre_synced_at
-        while updated_genres := fetch_updated_genres(cursor, last_genre_synced):
+        date_start = state.last_genre_synced_at
+        for updated_genres in iter_updated_genres(connection, date_start, state.last_genre_synced_id):
 
-            last_movie_synced_by_genre = DEFAULT_DATE
-            while linked_movies := fetch_movies_by_genres(cursor, updated_genres, last_movie_synced_by_genre):
-                movies_ids_not_synced = [m["id"] for m in linked_movies if str(m["id"]) not in state.movies_synced]
+            for linked_movies in iter_movies_by_genres(connection, updated_genres):
+                movies_ids_not_synced = [m["id"] for m in linked_movies if m["id"] not in state.movies_synced]
 
                 if movies_ids_not_synced:
                     movies_to_send = get_movies_by_ids(movies_ids_not_synced, cursor)
-                    for movie in movies_to_send:
-                        target.send(movie)
-                        state.add_movies_synced([str(movie["fw_id"])])
+                    target.send(movies_to_send)
+                    send_checkpoint(target, state.add_movies_synced, [m["fw_id"] for m in movies_to_send])
 
-                logger.debug(f"Synced all movies updated after {last_movie_synced_by_genre} "
-                             f"for genres updated after {last_genre_synced}. Searching for more movies")
-                last_movie_synced_by_genre = linked_movies[-1]["modified"]
+                logger.debug(f"Synced {len(linked_movies)} movies for genres updated after "
+                             f"{updated_genres[0]['modified']}. Searching for more movies")
 
-            last_genre_synced = updated_genres[-1]["modified"]
-            state.set_last_genre_synced_at(last_genre_synced)
+            send_checkpoint(target, state.set_last_genre_synced_at,
+                            updated_genres[-1]["modified"], updated_genres[-1]["id"])
 
         logger.debug(f"All movies linked with genres updated after {date_start}")
 
@@ -262,16 +430,16 @@ def extract_updated_persons(target, state: State):
     """
     Data producer for updated persons since last sync.
     """
-    with psycopg2.connect(**DSN, cursor_factory=DictCursor).cursor() as cursor:  # type: _cursor
-        date_start = last_person_synced = state.last_person_synced_at
+    with get_pool().connection() as connection:
+        date_start = state.last_person_synced_at
 
-        while updated_persons := fetch_updated_persons(cursor, last_person_synced):
-            persons_not_synced = [p for p in updated_persons if str(p["id"] not in state.persons_synced)]
+        for updated_persons in iter_updated_persons(connection, date_start, state.last_person_synced_id):
+            persons_not_synced = [p for p in updated_persons if p["id"] not in state.persons_synced]
             for person in persons_not_synced:
                 target.send(person)
-                state.add_persons_synced([str(person["id"])])
+            send_checkpoint(target, state.add_persons_synced, [p["id"] for p in persons_not_synced])
 
-            last_person_synced = updated_persons[-1]["modified"]
-            state.set_last_person_synced_at(last_person_synced)
+            send_checkpoint(target, state.set_last_person_synced_at,
+                            updated_persons[-1]["modified"], updated_persons[-1]["id"])
 
         logger.debug(f"All persons updated after {date_start} synced, shutting down receiving coroutine")
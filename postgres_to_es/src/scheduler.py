@@ -0,0 +1,110 @@
+"""
+Adaptive polling of pipelines. Every pipeline has its own polling interval: it's dropped to ETL_POLL_MIN_INTERVAL_SEC
+when pipeline's tables change and doubles up to ETL_POLL_MAX_INTERVAL_SEC while they don't. Whether tables changed is
+checked by a cheap probe - the last modified date of every table, read from (modified, id) indexes - so idle
+pipelines are not run at all. Every pipeline is polled by its own worker thread, so a long run of one pipeline
+doesn't delay the others.
+"""
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import backoff
+import psycopg2.errors
+
+from src.config import CONFIG
+from src.db import get_pool
+from src.lease import Lease
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def build_probe_query(tables: Iterable[str]) -> str:
+    return "SELECT " + ", ".join(f"(SELECT max(modified) FROM content.{table}) as {table}" for table in tables)
+
+
+@backoff.on_exception(backoff.expo, psycopg2.errors.ConnectionException, max_time=CONFIG.PG_TIMEOUT_SEC)
+def probe_last_modified(tables: Iterable[str]) -> Dict[str, Optional[datetime]]:
+    """
+    Returns the last modified date of every table by a single query. Date is None for empty table.
+    """
+    with get_pool().connection() as connection, connection.cursor() as cursor:
+        cursor.execute(build_probe_query(tables))
+        return dict(cursor.fetchone())
+
+
+@dataclass
+class PipelineSchedule:
+    name: str
+    tables: Tuple[str, ...]
+    interval: float = CONFIG.ETL_POLL_MIN_INTERVAL_SEC
+    next_run_at: float = 0
+    last_modified: Optional[Dict[str, Optional[datetime]]] = None  # probe result of the last run, None before it
+
+    def changed(self, probe: Dict[str, Optional[datetime]]) -> bool:
+        return self.last_modified != {table: probe[table] for table in self.tables}
+
+    def completed(self, probe: Dict[str, Optional[datetime]], changed: bool) -> None:
+        """
+        Schedules next poll - soon after change, later and later while pipeline is idle.
+        """
+        if changed:
+            self.last_modified = {table: probe[table] for table in self.tables}
+            self.interval = CONFIG.ETL_POLL_MIN_INTERVAL_SEC
+        else:
+            self.interval = min(self.interval * 2, CONFIG.ETL_POLL_MAX_INTERVAL_SEC)
+        self.next_run_at = time.monotonic() + self.interval
+        metrics.set(f"{self.name}.poll_interval_sec", self.interval)
+
+
+@dataclass
+class PollingScheduler:
+    """
+    Runs pipelines whose tables changed since their last run. Every pipeline is probed when its interval expires.
+    run() returns whether pipeline was run - pipeline leased by other process is not, so its changes are not
+    considered handled and it's probed again.
+    Leases of idle pipelines are renewed at every probe, so they are not taken over while nothing changes.
+    """
+    pipelines_tables: Dict[str, Tuple[str, ...]]
+    run: Callable[[str], bool]
+    leases: Dict[str, Lease] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.schedules = [PipelineSchedule(name, tables) for name, tables in self.pipelines_tables.items()]
+
+    def poll(self, schedule: PipelineSchedule) -> float:
+        """
+        Probes pipeline and runs it if its tables changed. Returns time to wait until the next poll.
+        """
+        # probe is taken before run, so changes made while pipeline runs are caught by the next probe
+        probe = probe_last_modified(schedule.tables)
+        changed = schedule.changed(probe)
+        if changed:
+            changed = self.run(schedule.name)
+        elif schedule.name in self.leases:
+            self.leases[schedule.name].acquire()
+        schedule.completed(probe, changed)
+        logger.debug(f"{schedule.name} polling interval is {schedule.interval}s")
+        return max(schedule.next_run_at - time.monotonic(), 0)
+
+    def run_forever(self) -> None:
+        """
+        Polls every pipeline by its own worker thread. Raises error of the first failed worker.
+        """
+        failures = queue.Queue()
+
+        def work(schedule: PipelineSchedule):
+            try:
+                while True:
+                    time.sleep(self.poll(schedule))
+            except Exception as e:
+                failures.put(e)
+
+        for schedule in self.schedules:
+            threading.Thread(target=work, args=(schedule,), name=f"poll-{schedule.name}", daemon=True).start()
+        raise failures.get()
@@ -0,0 +1,134 @@
+"""
+Sharding of movies sync between worker processes. Every shard owns a contiguous range of hashtext(film_work.id) values,
+so shards never load the same movie and each of them keeps its own checkpoints in its own state file.
+Shard ranges depend on amount of shards, so shards states are kept per amount - states of other amounts are orphaned.
+"""
+import glob
+import logging
+import multiprocessing
+import os
+import re
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+HASH_MIN = -2 ** 31  # hashtext() returns int4
+HASH_SPACE = 2 ** 32
+
+
+@dataclass(frozen=True)
+class Shard:
+    number: int  # zero-based
+    count: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.number + 1}-of-{self.count}"
+
+    @property
+    def hash_low(self) -> int:
+        return HASH_MIN + self.number * HASH_SPACE // self.count
+
+    @property
+    def hash_high(self) -> int:
+        return HASH_MIN + (self.number + 1) * HASH_SPACE // self.count
+
+    def filter(self, column: str) -> str:
+        """
+        SQL condition which selects rows owned by shard by uuid column, bound by params().
+        """
+        return f"hashtext({column}::text) >= %(shard_low)s AND hashtext({column}::text) < %(shard_high)s"
+
+    def params(self) -> dict:
+        return {"shard_low": self.hash_low, "shard_high": self.hash_high}
+
+    def state_file(self, prefix: str) -> str:
+        """
+        State file of shard next to state file of coordinator - f"{prefix}.json".
+        """
+        return f"{prefix}.movies-{self.name}.json"
+
+
+def get_shards(count: int) -> List[Shard]:
+    return [Shard(number, count) for number in range(count)]
+
+
+def find_orphaned_shards_states(prefix: str, count: int) -> List[str]:
+    """
+    Returns state files of shards of other amount than count, left since amount of shards was changed.
+    """
+    pattern = re.compile(rf"{re.escape(prefix)}\.movies-\d+-of-(\d+)\.json")
+    return sorted(path for path in glob.glob(f"{glob.escape(prefix)}.movies-*-of-*.json")
+                  if (match := pattern.fullmatch(path)) and int(match.group(1)) != count)
+
+
+def remove_shards_states(prefix: str, count: int) -> None:
+    """
+    Removes state files of all of shards - snapshots with their journals.
+    """
+    for shard in get_shards(count):
+        for path in (shard.state_file(prefix), f"{shard.state_file(prefix)}.journal"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class ShardWorker:
+    """
+    Long-lived process which syncs shard on every request, so process spawn, imports and connections to Postgres and
+    Elasticsearch are paid once. Target is called in worker process with shard and its end of pipe: it receives True
+    for every sync request or None to stop, and replies with None when sync is completed or with error description.
+    Worker which died is started again by the next request.
+    """
+
+    def __init__(self, shard: Shard, target: Callable, args: tuple = ()):
+        self.shard = shard
+        self.target = target
+        self.args = args
+        self.process: Optional[multiprocessing.Process] = None
+        self.connection: Optional[Connection] = None
+        self.error: Optional[str] = None
+
+    def request(self) -> None:
+        if self.process is None or not self.process.is_alive():
+            context = multiprocessing.get_context("spawn")  # worker must not inherit connections and locks
+            self.connection, child_connection = context.Pipe()
+            self.process = context.Process(target=self.target, args=(self.shard, child_connection, *self.args),
+                                           name=f"movies-shard-{self.shard.name}", daemon=True)
+            self.process.start()
+            child_connection.close()
+        self.error = None
+        self.connection.send(True)
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """
+        Waits for up to timeout, or without timeout if it's None, for the requested sync to complete. Returns whether
+        it's completed, error of completed sync is kept by `error`.
+        """
+        if not self.connection.poll(timeout):
+            return False
+        try:
+            self.error = self.connection.recv()
+        except (EOFError, OSError):  # worker died
+            self.process.join()
+            self.error = f"exited with code {self.process.exitcode}"
+        return True
+
+    def stop(self) -> None:
+        """
+        Stops worker - gracefully if it's idle, terminates it if it's syncing.
+        """
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.connection.close()
+        self.process = self.connection = None
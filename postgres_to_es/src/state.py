@@ -1,9 +1,14 @@
 import datetime
 import json
 import logging
-from typing import Any, List
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Union
+from uuid import UUID
 
-from src.consts import DEFAULT_DATE, DATE_PARSE_PATTERN
+from src.config import CONFIG
+from src.consts import DEFAULT_DATE, DEFAULT_ID, DATE_PARSE_PATTERN
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +18,15 @@ class JsonFileStorage:
         self.file_path = file_path
 
     def save_state(self, state: dict) -> None:
-        with open(self.file_path, "w") as f:
-            json.dump(state, f)
+        """
+        Atomically replaces state file - state is written to temporary file which is moved over the old one.
+        """
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, default=sorted)  # collections are kept as sets in memory
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> dict:
         if self.file_path is None:
@@ -32,28 +44,258 @@ class JsonFileStorage:
             self.save_state({})
 
 
-class State:
+class JournalFileStorage:
+    """
+    State storage which keeps compacted state snapshot in json file and appends every change to the journal next to it.
+    Journal records are written without fsync, durability is provided by explicit sync() calls. Journal is replayed
+    on top of the snapshot on start and folded into the snapshot by compact().
+    """
+
+    def __init__(self, file_path: Optional[str] = "state.json"):
+        self.snapshot = JsonFileStorage(file_path)
+        self.journal_path = f"{file_path}.journal" if file_path is not None else None
+        self.records_in_journal = 0
+        self._journal = None
+        self._dirty = False
+
+    @staticmethod
+    def apply(state: dict, record: dict) -> None:
+        """
+        Applies journal record to state. Every operation is idempotent, so journal may be safely replayed over the
+        snapshot which already contains its changes.
+        """
+        op, key = record["op"], record["key"]
+        if op == "set":
+            state[key] = record["value"]
+        elif op == "add":
+            collection = state.get(key)
+            if not isinstance(collection, set):
+                collection = state[key] = set(collection or ())
+            collection.update(record["values"])
+        elif op == "reset":
+            state[key] = set()
+        else:
+            raise ValueError(f"Unknown journal operation {op}")
+
+    def retrieve_state(self) -> dict:
+        state = self.snapshot.retrieve_state() or {}
+        if self.journal_path is None:
+            return state
+
+        try:
+            with open(self.journal_path, "rb") as f:
+                replayed_bytes = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Record is not terminated")
+                        record = json.loads(line)
+                    except ValueError:
+                        # only the last record may be partially written if process was killed, nothing to replay after
+                        logger.warning("Broken state journal record found, ignoring the rest of journal")
+                        break
+
+                    self.apply(state, record)
+                    self.records_in_journal += 1
+                    replayed_bytes += len(line)
+                else:
+                    replayed_bytes = None
+
+            if replayed_bytes is not None:
+                # new records must not be appended to the broken one - they would be lost at the next replay
+                os.truncate(self.journal_path, replayed_bytes)
+        except FileNotFoundError:
+            logger.debug("No state journal found")
+
+        logger.debug(f"Replayed {self.records_in_journal} state journal records")
+        return state
+
+    def append(self, record: dict) -> None:
+        if self.journal_path is None:
+            return
+
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a")
+        self._journal.write(json.dumps(record) + "\n")
+        self.records_in_journal += 1
+        self._dirty = True
+
+    def sync(self) -> None:
+        """
+        Flushes journal records written since the previous call to disk.
+        """
+        if not self._dirty:
+            return
+
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._dirty = False
+
+    def compact(self, state: dict) -> None:
+        """
+        Saves full state as a new snapshot and truncates the journal.
+        """
+        if self.journal_path is None:
+            return
 
-    def __init__(self, storage_file: str):
-        self.storage = JsonFileStorage(storage_file)
+        self.sync()
+        self.snapshot.save_state(state)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, "w")
+        self.records_in_journal = 0
+        logger.debug("State journal compacted")
+
+
+class SyncedIds:
+    """
+    Set of synced essences ids. Ids are kept as 16-byte UUID keys instead of strings, so even the cache of the whole
+    catalog stays compact. Membership check accepts both UUID and str ids and takes constant time.
+    """
+    __slots__ = ("_keys",)
+
+    def __init__(self, ids: Iterable[Union[UUID, str]] = ()):
+        self._keys = {self._key(id_) for id_ in ids}
+
+    @staticmethod
+    def _key(id_: Union[UUID, str]) -> bytes:
+        if isinstance(id_, UUID):
+            return id_.bytes
+        return UUID(id_).bytes
+
+    def __contains__(self, id_: Union[UUID, str]) -> bool:
+        return self._key(id_) in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self._keys:
+            yield str(UUID(bytes=key))
+
+    def update(self, ids: Iterable[Union[UUID, str]]) -> None:
+        self._keys.update(self._key(id_) for id_ in ids)
+
+
+@dataclass(frozen=True)
+class Checkpoint:
+    """
+    State change which producer sends down the pipeline along with essences. Loader applies it only when all of
+    essences sent before it are loaded to Elasticsearch, so state never runs ahead of the index.
+    """
+    apply: Callable[[], None]
+
+
+class State:
+    """
+    ETL state shared by all of pipelines. Every pipeline has its own checkpoints and synced ids caches, so pipelines
+    may run concurrently - state changes are serialized by the lock.
+    """
+    COLLECTIONS = ("movies_synced", "genres_synced", "genres_for_genres_synced", "persons_synced")
+    CHECKPOINTS = ("last_person_synced_at", "last_person_for_movies_synced_at", "last_genre_synced_at",
+                   "last_genre_for_genres_synced_at", "last_movie_synced_at")
+    PIPELINES_CHECKPOINTS = {
+        "movies": ("last_movie_synced_at", "last_person_for_movies_synced_at", "last_genre_synced_at"),
+        "genres": ("last_genre_for_genres_synced_at",),
+        "persons": ("last_person_synced_at",),
+    }
+    PIPELINES_COLLECTIONS = {
+        "movies": ("movies_synced",),
+        "genres": ("genres_synced", "genres_for_genres_synced"),
+        "persons": ("persons_synced",),
+    }
+
+    def __init__(self, storage_file: Optional[str], compact_every: int = CONFIG.ETL_STATE_JOURNAL_COMPACT_EVERY):
+        self.storage = JournalFileStorage(storage_file)
+        self.compact_every = compact_every
         self.state = self.retrieve_state()
+        self._lock = threading.RLock()
 
     def retrieve_state(self) -> dict:
         data = self.storage.retrieve_state()
         if not data:
-            return {}
+            data = {}
+
+        for key in self.COLLECTIONS:
+            data[key] = SyncedIds(data.get(key) or ())
+
         return data
 
     def set_state(self, key: str, value: Any) -> None:
         """Set state for specific key"""
-        self.state[key] = value
+        with self._lock:
+            self.state[key] = value
 
-        self.storage.save_state(self.state)
+            self.storage.append({"op": "set", "key": key, "value": value})
 
     def get_state(self, key: str) -> Any:
         """Retrieve state by specific key. Defaults to None."""
         return self.state.get(key)
 
+    def add_to_collection(self, key: str, ids: Iterable[Union[UUID, str]]) -> None:
+        """Adds ids to synced ids collection stored by specific key"""
+        with self._lock:
+            ids = [str(id_) for id_ in ids if id_ not in self.state[key]]
+            if ids:
+                self.state[key].update(ids)
+                self.storage.append({"op": "add", "key": key, "values": ids})
+
+    def reset_collection(self, key: str) -> None:
+        with self._lock:
+            self.state[key] = SyncedIds()
+            self.storage.append({"op": "reset", "key": key})
+
+    def _get_last_synced_id(self, checkpoint: str) -> UUID:
+        id_ = self.get_state(f"{checkpoint}_id")
+        if id_ is None:
+            return DEFAULT_ID
+
+        return UUID(id_)
+
+    def _set_checkpoint(self, checkpoint: str, value: datetime.datetime, id_: UUID) -> None:
+        with self._lock:
+            self.set_state(checkpoint, str(value))
+            self.set_state(f"{checkpoint}_id", str(id_))
+
+    def copy_checkpoints(self, other: "State") -> None:
+        """
+        Replaces all of checkpoints by checkpoints of other state.
+        """
+        with self._lock:
+            for checkpoint in self.CHECKPOINTS:
+                for key in (checkpoint, f"{checkpoint}_id"):
+                    if other.get_state(key) is not None:
+                        self.set_state(key, other.get_state(key))
+
+    def get_checkpoints(self, pipeline: str) -> Dict[str, str]:
+        """
+        Returns checkpoints of pipeline by state keys, checkpoints which are not reached yet are omitted.
+        """
+        with self._lock:
+            return {key: self.get_state(key)
+                    for checkpoint in self.PIPELINES_CHECKPOINTS[pipeline]
+                    for key in (checkpoint, f"{checkpoint}_id")
+                    if self.get_state(key) is not None}
+
+    def set_checkpoints(self, checkpoints: Dict[str, str]) -> None:
+        """
+        Replaces checkpoints by provided ones, e.g. by checkpoints of other ETL process. Changes are flushed.
+        """
+        with self._lock:
+            for key, value in checkpoints.items():
+                self.set_state(key, value)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Makes all of state changes durable. Compacts state journal if it grew too much.
+        """
+        with self._lock:
+            if self.storage.records_in_journal >= self.compact_every:
+                self.storage.compact(self.state)
+            else:
+                self.storage.sync()
+
     @property
     def last_person_synced_at(self) -> datetime.datetime:
         """
@@ -110,45 +352,69 @@ class State:
         return datetime.datetime.strptime(date, DATE_PARSE_PATTERN)
 
     @property
-    def movies_synced(self) -> tuple:
+    def last_person_synced_id(self) -> UUID:
         """
-        cache of movies which has been synced during this iteration. Necessary to avoid movies re-uploading -
-        movie may be retrieved due to related person/genre change and also due to movie"s own data change.
-        Cache stored as a tuple of movies ids.
+        id of the last essence synced by last_person_synced_at checkpoint.
+        Together with checkpoint date forms (modified, id) keyset.
+        """
+        return self._get_last_synced_id("last_person_synced_at")
+
+    @property
+    def last_person_for_movies_synced_id(self) -> UUID:
+        """
+        id of the last essence synced by last_person_for_movies_synced_at checkpoint.
+        Together with checkpoint date forms (modified, id) keyset.
         """
-        movies = self.get_state("movies_synced")
-        if movies is None:
-            return tuple()
+        return self._get_last_synced_id("last_person_for_movies_synced_at")
 
-        return tuple(movies)
+    @property
+    def last_genre_synced_id(self) -> UUID:
+        """
+        id of the last essence synced by last_genre_synced_at checkpoint.
+        Together with checkpoint date forms (modified, id) keyset.
+        """
+        return self._get_last_synced_id("last_genre_synced_at")
+
+    @property
+    def last_genre_for_genres_synced_id(self) -> UUID:
+        """
+        id of the last essence synced by last_genre_for_genres_synced_at checkpoint.
+        Together with checkpoint date forms (modified, id) keyset.
+        """
+        return self._get_last_synced_id("last_genre_for_genres_synced_at")
 
     @property
-    def genres_synced(self) -> tuple:
-        genres = self.get_state("genres_synced")
-        if genres is None:
-            return tuple()
+    def last_movie_synced_id(self) -> UUID:
+        """
+        id of the last essence synced by last_movie_synced_at checkpoint.
+        Together with checkpoint date forms (modified, id) keyset.
+        """
+        return self._get_last_synced_id("last_movie_synced_at")
 
-        return tuple(genres)
+    @property
+    def movies_synced(self) -> SyncedIds:
+        """
+        cache of movies which has been synced during this iteration. Necessary to avoid movies re-uploading -
+        movie may be retrieved due to related person/genre change and also due to movie"s own data change.
+        Cache stored as a set of movies ids, membership check takes constant time.
+        """
+        return self.state["movies_synced"]
 
     @property
-    def genres_for_genres_synced(self):
-        genres = self.get_state("genres_for_genres_synced")
-        if genres is None:
-            return tuple()
+    def genres_synced(self) -> SyncedIds:
+        return self.state["genres_synced"]
 
-        return tuple(genres)
+    @property
+    def genres_for_genres_synced(self) -> SyncedIds:
+        return self.state["genres_for_genres_synced"]
 
     @property
-    def persons_synced(self) -> tuple:
+    def persons_synced(self) -> SyncedIds:
         """
         Cache of persons updated during current iteration.
-        Cache stored as a tuple of persons ids.
+        Cache stored as a set of persons ids, membership check takes constant time.
         """
-        persons = self.get_state("persons_synced")
-        if persons is None:
-            return tuple()
-
-        return tuple(persons)
+        return self.state["persons_synced"]
 
     @property
     def last_full_state_sync_started_at(self) -> datetime.datetime:
@@ -164,34 +430,54 @@ class State:
     def set_last_full_state_sync_started_at(self, value: datetime.datetime):
         self.set_state("last_full_state_sync_started_at", str(value))
 
-    def set_last_person_synced_at(self, value: datetime.datetime):
-        self.set_state("last_person_synced_at", str(value))
+    def get_pipeline_sync_started_at(self, pipeline: str) -> datetime.datetime:
+        """
+        date when the last sync of specific pipeline started.
+        """
+        date = self.get_state(f"last_{pipeline}_sync_started_at")
+        if date is None:
+            return DEFAULT_DATE
+
+        return datetime.datetime.strptime(date, DATE_PARSE_PATTERN)
 
-    def set_last_person_for_movies_synced_at(self, value: datetime.datetime):
-        self.set_state("last_person_for_movies_synced_at", str(value))
+    def set_pipeline_sync_started_at(self, pipeline: str, value: datetime.datetime):
+        self.set_state(f"last_{pipeline}_sync_started_at", str(value))
 
-    def set_last_movie_synced_at(self, value: datetime.datetime):
-        self.set_state("last_movie_synced_at", str(value))
+    def set_last_person_synced_at(self, value: datetime.datetime, id_: UUID = DEFAULT_ID):
+        self._set_checkpoint("last_person_synced_at", value, id_)
 
-    def set_last_genre_synced_at(self, value: datetime.datetime):
-        self.set_state(f"last_genre_synced_at", str(value))
+    def set_last_person_for_movies_synced_at(self, value: datetime.datetime, id_: UUID = DEFAULT_ID):
+        self._set_checkpoint("last_person_for_movies_synced_at", value, id_)
 
-    def set_last_genre_for_genres_synced_at(self, value: datetime.datetime):
-        self.set_state(f"last_genre_for_genres_synced_at", str(value))
+    def set_last_movie_synced_at(self, value: datetime.datetime, id_: UUID = DEFAULT_ID):
+        self._set_checkpoint("last_movie_synced_at", value, id_)
 
-    def add_movies_synced(self, movie_ids: List[str]):
-        self.set_state("movies_synced", self.movies_synced + tuple(movie_ids))
+    def set_last_genre_synced_at(self, value: datetime.datetime, id_: UUID = DEFAULT_ID):
+        self._set_checkpoint("last_genre_synced_at", value, id_)
 
-    def add_genres_for_genres_synced(self, genre_ids: List[str]):
-        self.set_state(f"genres_for_genres_synced", self.genres_synced + tuple(genre_ids))
+    def set_last_genre_for_genres_synced_at(self, value: datetime.datetime, id_: UUID = DEFAULT_ID):
+        self._set_checkpoint("last_genre_for_genres_synced_at", value, id_)
 
-    def add_persons_synced(self, person_ids: List[str]):
-        self.set_state("persons_synced", self.persons_synced + tuple(person_ids))
+    def add_movies_synced(self, movie_ids: Iterable[Union[UUID, str]]):
+        self.add_to_collection("movies_synced", movie_ids)
+
+    def add_genres_for_genres_synced(self, genre_ids: Iterable[Union[UUID, str]]):
+        self.add_to_collection("genres_for_genres_synced", genre_ids)
+
+    def add_persons_synced(self, person_ids: Iterable[Union[UUID, str]]):
+        self.add_to_collection("persons_synced", person_ids)
 
     def complete_full_sync(self):
         """
         Resets updated entities cache - we should sync again all of updated movies since last iteration finish.
         """
-        self.set_state("movies_synced", [])
-        self.set_state("genres_synced", [])
-        self.set_state("persons_synced", [])
+        for pipeline in self.PIPELINES_COLLECTIONS:
+            self.complete_pipeline_sync(pipeline)
+
+    def complete_pipeline_sync(self, pipeline: str):
+        """
+        Resets updated entities cache of specific pipeline only.
+        """
+        for key in self.PIPELINES_COLLECTIONS[pipeline]:
+            self.reset_collection(key)
+        self.flush()
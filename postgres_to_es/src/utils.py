@@ -1,5 +1,7 @@
 import json
 import logging
+from datetime import datetime, timezone
+from typing import List
 
 import backoff
 import requests
@@ -12,7 +14,8 @@ ES_INDEXES_BODIES = {
     CONFIG.ES_GENRE_INDEX: ES_GENRES_INDEX_CREATE_BODY,
     CONFIG.ES_PERSONS_INDEX: ES_PERSONS_INDEX_CREATE_BODY
 }
-
+# settings of index being filled by rebuild - no refreshes and replication until bulk load is finished
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +24,10 @@ logger = logging.getLogger(__name__)
                       requests.exceptions.RequestException,
                       max_time=CONFIG.ES_STARTUP_TIMEOUT,
                       interval=10)
-def ensure_es_index_exists(es_url: str, index_name: str):
+def ensure_es_index_exists(es_url: str, index_name: str) -> bool:
+    """
+    Creates index if it doesn't exist. Returns True if index was created.
+    """
     if index_name not in ES_INDEXES_BODIES:
         raise ValueError(f"Unable to create index {index_name}. Index body not found")
     request_body = ES_INDEXES_BODIES[index_name]
@@ -30,9 +36,80 @@ def ensure_es_index_exists(es_url: str, index_name: str):
     response = requests.put(f"{es_url}/{index_name}", headers=headers, data=json.dumps(request_body))
     if response.status_code == 200:
         logger.info(f"Created new index {index_name}")
+        return True
     elif response.status_code == 400 and "resource_already_exists_exception" in response.text:
         logger.info(f"Index {index_name} already exists, do nothing")
+    elif response.status_code == 400 and "invalid_index_name_exception" in response.text and "alias" in response.text:
+        logger.info(f"Index {index_name} already exists as alias of rebuilt index, do nothing")
     else:
         logger.error(f"Error {response.status_code}")
         logger.error(response.text)
         raise RuntimeError(f"Unable to create index. Response {response.status_code}")
+    return False
+
+
+def _raise_for_status(response: requests.Response, action: str):
+    if not response.ok:
+        logger.error(response.text)
+        raise RuntimeError(f"Unable to {action}. Response {response.status_code}")
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def create_versioned_index(es_url: str, alias: str) -> str:
+    """
+    Creates new version of index served by alias. Index is created without replicas and periodic refreshes - these
+    are restored by finish_bulk_load when index is filled.
+    """
+    if alias not in ES_INDEXES_BODIES:
+        raise ValueError(f"Unable to create index {alias}. Index body not found")
+    index_name = f"{alias}_{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+    request_body = ES_INDEXES_BODIES[alias]
+    request_body = {**request_body, "settings": {**request_body["settings"], **BULK_LOAD_SETTINGS}}
+    response = requests.put(f"{es_url}/{index_name}", headers={"Content-Type": "application/json"},
+                            data=json.dumps(request_body))
+    _raise_for_status(response, f"create index {index_name}")
+    logger.info(f"Created index {index_name} for alias {alias}")
+    return index_name
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def finish_bulk_load(es_url: str, alias: str, index_name: str):
+    """
+    Restores refresh interval and replicas of index created by create_versioned_index and merges its segments.
+    """
+    settings = ES_INDEXES_BODIES[alias]["settings"]
+    response = requests.put(f"{es_url}/{index_name}/_settings", headers={"Content-Type": "application/json"},
+                            data=json.dumps({"index": {key: settings.get(key) for key in BULK_LOAD_SETTINGS}}))
+    _raise_for_status(response, f"restore settings of {index_name}")
+    response = requests.post(f"{es_url}/{index_name}/_forcemerge", params={"max_num_segments": 1})
+    _raise_for_status(response, f"force merge {index_name}")
+    response = requests.post(f"{es_url}/{index_name}/_refresh")
+    _raise_for_status(response, f"refresh {index_name}")
+    logger.info(f"Index {index_name} is ready to be served")
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def swap_alias(es_url: str, alias: str, index_name: str) -> List[str]:
+    """
+    Atomically points alias to index. Index which had the same name as alias (created before rebuilds were
+    introduced) is removed in the same request. Returns indexes alias pointed to before - they're not served anymore.
+    """
+    response = requests.get(f"{es_url}/_alias/{alias}")
+    previous = list(response.json()) if response.status_code == 200 else []
+    actions = [{"add": {"index": index_name, "alias": alias}}]
+    if requests.head(f"{es_url}/{alias}").ok and not previous:
+        actions.append({"remove_index": {"index": alias}})
+    actions.extend({"remove": {"index": index, "alias": alias}} for index in previous)
+
+    response = requests.post(f"{es_url}/_aliases", headers={"Content-Type": "application/json"},
+                             data=json.dumps({"actions": actions}))
+    _raise_for_status(response, f"swap alias {alias}")
+    logger.info(f"Alias {alias} swapped from {previous or alias} to {index_name}")
+    return previous
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_time=CONFIG.ES_CONNECT_TIMEOUT)
+def delete_index(es_url: str, index_name: str):
+    response = requests.delete(f"{es_url}/{index_name}")
+    _raise_for_status(response, f"delete index {index_name}")
+    logger.info(f"Index {index_name} deleted")
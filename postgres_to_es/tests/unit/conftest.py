@@ -0,0 +1,5 @@
+import os
+
+# config is read on import, database settings are required but unit tests never connect
+os.environ.setdefault("POSTGRES_DB", "test")
+os.environ.setdefault("POSTGRES_USER", "test")
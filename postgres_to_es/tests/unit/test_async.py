@@ -0,0 +1,30 @@
+import asyncio
+import threading
+
+import postgres_to_es_async
+from postgres_to_es_async import process_in_order
+
+
+async def pages_of(*pages):
+    for page in pages:
+        yield page
+
+
+def test_pages_are_checkpointed_in_order_off_event_loop(monkeypatch):
+    monkeypatch.setattr(postgres_to_es_async.CONFIG, "ASYNC_PAGES_IN_FLIGHT", 3)
+    loop_thread = threading.get_ident()
+    checkpoints, flush_threads = [], []
+
+    def flush(page):
+        flush_threads.append(threading.get_ident())
+        checkpoints.append(page)
+
+    async def process(page):
+        await asyncio.sleep(0.01 * (3 - page[0]))  # the first page is the slowest one
+
+    async def checkpoint(page):
+        await postgres_to_es_async.in_executor(flush, page)
+
+    asyncio.run(process_in_order(pages_of([0], [1], [2]), process, checkpoint))
+    assert checkpoints == [[0], [1], [2]]
+    assert loop_thread not in flush_threads
@@ -0,0 +1,28 @@
+from src.cdc import ChangedIds, parse_change
+
+MOVIE_ID = "5e5c4a3e-4b6b-4bd1-a1b4-2a7e4b9d6c10"
+OTHER_MOVIE_ID = "0b0f9a52-0c6e-4d8e-9b1f-3f1c8a7f1e22"
+PERSON_ID = "9d1a3c55-8f0e-4b8a-a4c1-6a2d5e7b3f90"
+
+
+def test_person_rename_is_parsed():
+    columns = parse_change(f"table content.person: UPDATE: id[uuid]:'{PERSON_ID}' "
+                           f"full_name[character varying]:'O''Brien' modified[timestamp with time zone]:null")
+
+    assert columns == {"__table__": "person", "id": PERSON_ID, "full_name": "O'Brien", "modified": "null"}
+
+
+def test_link_moved_to_other_movie_changes_both_movies():
+    changes = ChangedIds()
+    changes.add(parse_change(
+        f"table content.person_film_work: UPDATE: old-key: id[uuid]:'1' film_work_id[uuid]:'{MOVIE_ID}' "
+        f"person_id[uuid]:'{PERSON_ID}' new-tuple: id[uuid]:'1' film_work_id[uuid]:'{OTHER_MOVIE_ID}' "
+        f"person_id[uuid]:'{PERSON_ID}'"
+    ))
+
+    assert changes.movies == {MOVIE_ID, OTHER_MOVIE_ID}
+
+
+def test_other_tables_are_ignored():
+    assert parse_change("BEGIN") is None
+    assert parse_change("table content.etl_lease: UPDATE: name[text]:'cdc'") is None
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from src import db
+from src.db import ConnectionPool, execute_prepared
+
+QUERY = "SELECT * FROM content.film_work WHERE modified > %(modified)s AND id > %(id)s"
+
+
+class FakeConnection:
+    closed = False
+
+    def rollback(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+
+def test_statement_is_prepared_per_parameters_order():
+    cursor = FakeCursor()
+    execute_prepared(cursor, QUERY, {"modified": "2021-06-16", "id": "0"})
+    execute_prepared(cursor, QUERY, {"id": "0", "modified": "2021-06-16"})
+    execute_prepared(cursor, QUERY, {"modified": "2021-06-16", "id": "1"})
+
+    prepares = [query for query, _ in cursor.executed if query.startswith("PREPARE")]
+    assert len(prepares) == 2
+    assert prepares[0].endswith("modified > $1 AND id > $2")
+    assert prepares[1].endswith("modified > $2 AND id > $1")
+    executes = [query for query, _ in cursor.executed if query.startswith("EXECUTE")]
+    assert executes[1] == f"EXECUTE {prepares[1].split()[1]} (%(id)s, %(modified)s)"
+
+
+def test_pool_fails_to_acquire_when_all_of_connections_are_taken(monkeypatch):
+    monkeypatch.setattr(db.psycopg2, "connect", lambda **kwargs: FakeConnection())
+    pool = ConnectionPool({}, max_size=1, max_lifetime_sec=3600, healthcheck_idle_sec=30, acquire_timeout_sec=0.1)
+
+    with pool.connection():
+        with pytest.raises(RuntimeError, match="pooled connections are taken"):
+            with pool.connection():
+                pass
+
+
+def test_pool_hands_released_connection_to_waiting_borrower(monkeypatch):
+    monkeypatch.setattr(db.psycopg2, "connect", lambda **kwargs: FakeConnection())
+    pool = ConnectionPool({}, max_size=1, max_lifetime_sec=3600, healthcheck_idle_sec=30, acquire_timeout_sec=5)
+    borrowed = []
+
+    def borrow():
+        with pool.connection() as connection:
+            borrowed.append(connection)
+
+    with pool.connection() as connection:
+        waiting = threading.Thread(target=borrow)
+        waiting.start()
+        waiting.join(0.1)
+        assert waiting.is_alive()
+    waiting.join(5)
+    assert borrowed == [connection]
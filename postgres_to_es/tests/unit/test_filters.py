@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from benchmarks.movie_transform import per_movie
+from src.filters import transform_movie_data, transform_movies
+from src.wrappers import coroutine
+
+MODIFIED = datetime.datetime(2021, 6, 16, 20, 14, 9, tzinfo=datetime.timezone.utc)
+
+
+def make_movie(fw_id, persons=(), genres=(), rating=None, description=None):
+    return {"fw_id": fw_id, "title": f"Movie {fw_id}", "description": description, "rating": rating,
+            "created": MODIFIED, "modified": MODIFIED, "genres": list(genres), "persons": list(persons)}
+
+
+def person(id_, full_name, role):
+    return {"id": id_, "full_name": full_name, "role": role}
+
+
+MOVIES = [
+    make_movie("5e5c4a3e-4b6b-4bd1-a1b4-2a7e4b9d6c10", rating=7.5, description="Some description",
+               genres=[{"id": "g1", "name": "Drama"}, {"id": "g2", "name": "Comedy"}],
+               persons=[person("p1", "Director One", "director"), person("p2", "Actor One", "actor"),
+                        person("p3", "Writer One", "writer"), person("p4", "Actor Two", "actor"),
+                        person("p1", "Director One", "writer")]),
+    make_movie("0b0f9a52-0c6e-4d8e-9b1f-3f1c8a7f1e22", genres=[{"id": "g1", "name": "Drama"}],
+               persons=[person("p2", "Actor One", "actor")]),  # no directors and writers, no rating
+    make_movie("9f1d3c2b-7a6e-4f5d-8c4b-3a2e1f0d9c8b"),  # neither persons nor genres
+]
+
+
+def test_movies_are_transformed_as_by_previous_per_movie_transform():
+    assert transform_movies(MOVIES) == per_movie(MOVIES)
+
+
+def test_movies_transform_keeps_empty_roles_and_null_rating():
+    document = transform_movies(MOVIES[1:2])[0]
+    assert document["imdb_rating"] is None
+    assert document["actors"] == [{"id": "p2", "name": "Actor One"}]
+    assert document["directors"] == document["writers"] == []
+    assert document["directors_names"] == document["writers_names"] == []
+
+
+def test_single_movie_and_page_are_transformed_alike():
+    @coroutine
+    def collect(documents):
+        while document := (yield):
+            documents.append(document)
+
+    documents = []
+    transformer = transform_movie_data(collect(documents))
+    transformer.send(MOVIES[0])
+    transformer.send(MOVIES[1:])
+    assert documents == per_movie(MOVIES)
+
+
+@pytest.mark.parametrize("persons", [
+    [person("p1", None, "actor")],
+    [person("p1", "Actor One", "producer")],
+])
+def test_invalid_persons_are_refused(persons):
+    movies = [make_movie("5e5c4a3e-4b6b-4bd1-a1b4-2a7e4b9d6c10", persons=persons)]
+    with pytest.raises(ValueError):
+        per_movie(movies)
+    with pytest.raises(ValueError):
+        transform_movies(movies)
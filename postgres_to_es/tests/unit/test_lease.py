@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from src import lease as lease_module
+from src.lease import Lease, LeaseLost
+from src.state import State
+
+MOVIE_ID = "5e5c4a3e-4b6b-4bd1-a1b4-2a7e4b9d6c10"
+
+
+class FakeLeaseTable:
+    """
+    Pooled connection and its cursor at once, fetchone() returns prepared rows of lease queries one by one, then
+    renews lease.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.params = []
+
+    def connection(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.params.append(params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else {"acquired_at": None, "checkpoints": None}
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def lease_table(monkeypatch):
+    table = FakeLeaseTable()
+    monkeypatch.setattr(lease_module, "get_pool", lambda: table)
+    return table
+
+
+def test_lost_lease_aborts_job(lease_table):
+    lease = Lease("pipeline_movies", timeout_sec=60)
+    lease_table.rows.extend([{"acquired_at": None, "checkpoints": None}, None])
+    assert lease.acquire()
+    lease.ensure_held()
+
+    assert not lease.acquire()  # taken over by other process
+    with pytest.raises(LeaseLost):
+        lease.ensure_held()
+
+
+def test_lease_not_renewed_in_time_is_lost(lease_table, monkeypatch):
+    lease = Lease("pipeline_movies", timeout_sec=60)
+    lease_table.rows.append({"acquired_at": None, "checkpoints": None})
+    assert lease.acquire()
+
+    monkeypatch.setattr(lease_module.time, "monotonic", lambda: lease.renewed_at + 31)
+    with pytest.raises(LeaseLost):
+        lease.ensure_held()
+
+
+def test_checkpoints_are_taken_over_with_lease(lease_table, tmp_path):
+    state = State(str(tmp_path / "state.json"))
+    lease = Lease("pipeline_movies", state, "movies", timeout_sec=60)
+    checkpoints = {"last_movie_synced_at": "2021-06-16 20:14:09.221000+00:00", "last_movie_synced_at_id": MOVIE_ID}
+    lease_table.rows.extend([{"acquired_at": None, "checkpoints": checkpoints}, {"acquired_at": None}])
+
+    assert lease.acquire()
+    assert state.get_checkpoints("movies") == checkpoints
+    assert lease_table.params[0]["checkpoints"] is None  # checkpoints of the previous holder are kept
+
+    assert lease.acquire()
+    assert lease_table.params[1]["checkpoints"].adapted == checkpoints  # renewal saves holder's checkpoints
+
+
+def test_stalled_holder_loses_lease(lease_table):
+    lease = Lease("pipeline_movies", timeout_sec=0.4)
+    assert lease.acquire()
+
+    with lease.keep_alive():
+        for _ in range(10):  # progressing job keeps lease alive
+            time.sleep(0.1)
+            lease.ensure_held()
+        renewals = len(lease_table.params)
+        assert renewals > 5
+
+        time.sleep(1)  # job hangs, heartbeat stops renewing the lease
+        assert len(lease_table.params) <= renewals + 4
+        with pytest.raises(LeaseLost):
+            lease.ensure_held()
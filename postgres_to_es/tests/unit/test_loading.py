@@ -0,0 +1,202 @@
+import threading
+import uuid
+
+import pytest
+
+from src import loading
+from src.config import CONFIG
+from src.filters import load_essences, loading_essences
+
+
+class FakeResponse:
+    def __init__(self, result: dict):
+        self.result = result
+
+    def json(self) -> dict:
+        return self.result
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def bulk_statuses(monkeypatch, tmp_path):
+    """
+    Replaces Elasticsearch by fake bulk endpoint. Status of every document is taken from the returned dict by id,
+    documents which are not there are indexed.
+    """
+    statuses, requests = {}, []
+    monkeypatch.setattr(CONFIG, "ETL_STATE_STORAGE_FOLDER", str(tmp_path))
+
+    def post_bulk(batch, headers):
+        requests.append(list(batch.ids))
+        items = [{"index": {"_id": id_, "status": statuses.get(id_, 201)}} for id_ in batch.ids]
+        return FakeResponse({"errors": any(item["index"]["status"] >= 300 for item in items), "items": items})
+
+    monkeypatch.setattr(loading, "_post_bulk", post_bulk)
+    monkeypatch.setattr(loading.time, "sleep", lambda seconds: None)
+    statuses["requests"] = requests
+    return statuses
+
+
+def make_batch(ids):
+    batch = loading.BulkBatch("movies")
+    for id_ in ids:
+        batch.add({"id": id_, "title": f"Movie {id_}"})
+    return batch
+
+
+def test_send_bulk_returns_indexed_ids(bulk_statuses):
+    bulk_statuses["rejected"] = 400
+
+    assert loading.send_bulk(make_batch(["indexed", "rejected"])) == {"indexed"}
+
+
+def test_send_bulk_retries_overloaded_documents(bulk_statuses, monkeypatch):
+    bulk_statuses["retried"] = 429
+    batch = make_batch(["indexed", "retried"])
+    original_split = loading.split_bulk_result
+
+    def split_once(pending, items):
+        retry = original_split(pending, items)
+        bulk_statuses.pop("retried", None)  # accepted by the next attempt
+        return retry
+
+    monkeypatch.setattr(loading, "split_bulk_result", split_once)
+    assert loading.send_bulk(batch) == {"indexed", "retried"}
+    assert bulk_statuses["requests"] == [["indexed", "retried"], ["retried"]]
+
+
+def test_rejected_documents_are_not_remembered_as_loaded(bulk_statuses, monkeypatch):
+    monkeypatch.setattr(CONFIG, "ES_SKIP_UNCHANGED_DOCUMENTS", True)
+    index_name = f"movies_{uuid.uuid4().hex}"
+    indexed_id, rejected_id = str(uuid.uuid4()), str(uuid.uuid4())
+    bulk_statuses[rejected_id] = 400
+
+    for _ in range(2):
+        loader = load_essences(index_name)
+        loader.send({"id": indexed_id, "title": "Indexed"})
+        loader.send({"id": rejected_id, "title": "Rejected"})
+        loader.close()
+
+    assert bulk_statuses["requests"] == [[indexed_id, rejected_id], [rejected_id]]
+    assert loading.metrics.snapshot()[f"{index_name}.documents_written"] == 1
+
+
+def test_partial_batches_are_flushed_when_producer_stalls():
+    flushed = threading.Semaphore(0)
+    batches = []
+    loader = loading.BulkLoader("movies", lambda batch: batches.append(batch.ids) or flushed.release(),
+                                max_docs=100, max_latency_sec=0.05)
+    for id_ in ("stalled", "stalled again"):
+        loader.add({"id": id_, "title": "Movie"})
+        assert flushed.acquire(timeout=5)
+
+    assert batches == [["stalled"], ["stalled again"]]
+    assert len([thread for thread in threading.enumerate() if thread.name == "bulk-flusher-movies"]) == 1
+    loader.flush()
+    loader.close()
+    assert batches == [["stalled"], ["stalled again"]]
+    assert not [thread for thread in threading.enumerate() if thread.name == "bulk-flusher-movies"]
+
+
+def test_batches_are_committed_in_order_they_were_put():
+    first_loading, second_loaded = threading.Event(), threading.Event()
+    committed = []
+
+    def load(batch):
+        if batch.ids == ["first"]:
+            first_loading.set()
+            assert second_loaded.wait(5)
+        else:
+            assert first_loading.wait(5)
+            second_loaded.set()
+
+    loading_queue = loading.BulkLoadingQueue(load, lambda batch: committed.append(batch.ids), 2, 4)
+    loading_queue.put(make_batch(["first"]))
+    loading_queue.put(make_batch(["second"]))
+    loading_queue.close()
+
+    assert committed == [["first"], ["second"]]
+
+
+def test_loading_is_torn_down_when_producer_fails(bulk_statuses, monkeypatch):
+    monkeypatch.setattr(CONFIG, "ES_PIPELINED_LOADING", True)
+    monkeypatch.setattr(CONFIG, "ES_LOADING_WORKERS", 2)
+    index_name = f"movies_{uuid.uuid4().hex}"
+
+    with pytest.raises(ValueError):
+        with loading_essences(index_name) as loader:
+            loader.send({"id": "pending", "title": "Movie"})
+            raise ValueError("Producer failed")
+
+    assert not [thread for thread in threading.enumerate()
+                if thread.name.startswith(("bulk-loader", "bulk-flusher"))]
+    assert bulk_statuses["requests"] == []  # pending batch is dropped, not flushed
+
+
+def test_persons_are_renamed_in_refreshed_index_despite_conflicts(monkeypatch):
+    calls = []
+
+    class Session:
+        def post(self, url, params=None, **kwargs):
+            calls.append((url.rsplit("/", 1)[-1], params))
+            return FakeResponse({"failures": [], "updated": 2, "version_conflicts": 1})
+
+    monkeypatch.setattr(loading, "get_session", Session)
+
+    assert loading.update_persons_names("movies", {"person": "New Name"}) == 2
+    assert calls == [("_refresh", None), ("_update_by_query", {"conflicts": "proceed"})]
+
+
+def make_batch_size(initial=100):
+    return loading.AdaptiveBatchSize("movies", initial=initial, min_docs=50, max_docs=300, step=100,
+                                     target_latency_sec=1)
+
+
+def test_batch_size_grows_after_full_fast_batches_only():
+    batch_size = make_batch_size()
+    batch_size.observe(docs=60, latency_sec=0.1, rejected=0)  # partial batch says nothing about capacity
+    assert batch_size.size == 100
+    batch_size.observe(docs=100, latency_sec=0.1, rejected=0)
+    assert batch_size.size == 200
+
+
+def test_batch_size_is_halved_on_rejects_and_slow_responses():
+    batch_size = make_batch_size(initial=300)
+    batch_size.observe(docs=300, latency_sec=0.1, rejected=1)
+    assert batch_size.size == 150
+    batch_size.observe(docs=150, latency_sec=1.5, rejected=0)
+    assert batch_size.size == 75
+
+
+def test_batch_size_is_kept_within_limits():
+    assert make_batch_size(initial=10).size == 50
+    assert make_batch_size(initial=1000).size == 300
+
+    batch_size = make_batch_size(initial=250)
+    batch_size.observe(docs=250, latency_sec=0.1, rejected=0)
+    assert batch_size.size == 300
+    batch_size.observe(docs=300, latency_sec=0.1, rejected=0)
+    assert batch_size.size == 300
+
+    batch_size = make_batch_size(initial=60)
+    batch_size.observe(docs=60, latency_sec=0.1, rejected=60)
+    assert batch_size.size == 50
+
+
+def test_send_bulk_shrinks_batch_size_on_overload(bulk_statuses, monkeypatch):
+    batch_size = make_batch_size(initial=200)
+    monkeypatch.setattr(CONFIG, "ES_ADAPTIVE_BULK_SIZE", True)
+    monkeypatch.setitem(loading._batch_sizes, "movies", batch_size)
+    bulk_statuses["retried"] = 429
+    original_split = loading.split_bulk_result
+
+    def split_once(pending, items):
+        retry = original_split(pending, items)
+        bulk_statuses.pop("retried", None)
+        return retry
+
+    monkeypatch.setattr(loading, "split_bulk_result", split_once)
+    loading.send_bulk(make_batch(["indexed", "retried"]))
+    assert batch_size.size == 100
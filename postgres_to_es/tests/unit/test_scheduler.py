@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from src import scheduler
+from src.scheduler import PipelineSchedule, PollingScheduler
+
+MODIFIED = datetime(2021, 6, 16, 20, 14, 9)
+
+
+def test_pipeline_skipped_by_standby_is_not_handled(monkeypatch):
+    monkeypatch.setattr(scheduler, "probe_last_modified", lambda tables: {table: MODIFIED for table in tables})
+    runs = []
+    polling = PollingScheduler({"genres": ("genre",)}, lambda name: runs.append(name) or False)
+    schedule = polling.schedules[0]
+
+    polling.poll(schedule)
+    polling.poll(schedule)
+    assert runs == ["genres", "genres"]  # changes are still pending
+    assert schedule.last_modified is None
+
+
+def test_idle_pipeline_is_polled_less_often(monkeypatch):
+    monkeypatch.setattr(scheduler, "probe_last_modified", lambda tables: {table: MODIFIED for table in tables})
+    runs = []
+    schedule = PipelineSchedule("genres", ("genre",))
+    polling = PollingScheduler({}, lambda name: runs.append(name) or True)
+
+    polling.poll(schedule)
+    interval = schedule.interval
+    polling.poll(schedule)
+    assert runs == ["genres"]
+    assert schedule.interval == interval * 2
@@ -0,0 +1,12 @@
+from src.sharding import find_orphaned_shards_states, get_shards
+
+
+def test_states_of_other_shards_amount_are_orphaned(tmp_path):
+    prefix = str(tmp_path / "state")
+    for shard in get_shards(2) + get_shards(4):
+        (tmp_path / shard.state_file("state")).write_text("{}")
+    (tmp_path / "state.json").write_text("{}")
+
+    assert find_orphaned_shards_states(prefix, 4) == [shard.state_file(prefix) for shard in get_shards(2)]
+    assert find_orphaned_shards_states(prefix, 3) == sorted(shard.state_file(prefix)
+                                                            for shard in get_shards(2) + get_shards(4))
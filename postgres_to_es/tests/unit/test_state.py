@@ -0,0 +1,66 @@
+import json
+
+from src.state import JournalFileStorage, State
+
+MOVIE_ID = "5e5c4a3e-4b6b-4bd1-a1b4-2a7e4b9d6c10"
+OTHER_MOVIE_ID = "0b0f9a52-0c6e-4d8e-9b1f-3f1c8a7f1e22"
+
+
+def test_journal_is_replayed_over_snapshot(tmp_path):
+    state = State(str(tmp_path / "state.json"))
+    state.set_state("key", "value")
+    state.add_movies_synced([MOVIE_ID])
+    state.flush()
+
+    state = State(str(tmp_path / "state.json"))
+    assert state.get_state("key") == "value"
+    assert MOVIE_ID in state.movies_synced
+
+
+def test_torn_journal_tail_is_truncated(tmp_path):
+    storage_file = str(tmp_path / "state.json")
+    state = State(storage_file)
+    state.add_movies_synced([MOVIE_ID])
+    state.flush()
+    with open(f"{storage_file}.journal", "a") as f:
+        f.write('{"op": "set", "key": "torn", "val')  # process killed in the middle of the record
+
+    state = State(storage_file)
+    assert state.get_state("torn") is None
+    state.reset_collection("movies_synced")
+    state.set_state("key", "value")
+    state.flush()
+
+    state = State(storage_file)
+    assert MOVIE_ID not in state.movies_synced
+    assert state.get_state("key") == "value"
+
+
+def test_unterminated_journal_record_is_dropped(tmp_path):
+    storage = JournalFileStorage(str(tmp_path / "state.json"))
+    with open(storage.journal_path, "w") as f:
+        f.write(json.dumps({"op": "add", "key": "movies_synced", "values": [MOVIE_ID]}) + "\n")
+        f.write(json.dumps({"op": "add", "key": "movies_synced", "values": [OTHER_MOVIE_ID]}))
+
+    state = storage.retrieve_state()
+    assert state["movies_synced"] == {MOVIE_ID}
+    storage.append({"op": "set", "key": "key", "value": "value"})
+    storage.sync()
+
+    state = JournalFileStorage(str(tmp_path / "state.json")).retrieve_state()
+    assert state["movies_synced"] == {MOVIE_ID}
+    assert state["key"] == "value"
+
+
+def test_pipeline_checkpoints_are_replaced(tmp_path):
+    state = State(str(tmp_path / "state.json"))
+    state.set_last_movie_synced_at("2021-06-16 20:14:09.221000+00:00", MOVIE_ID)
+    state.set_last_person_synced_at("2021-06-16 20:14:09.221000+00:00", OTHER_MOVIE_ID)
+    checkpoints = state.get_checkpoints("movies")
+    assert checkpoints == {"last_movie_synced_at": "2021-06-16 20:14:09.221000+00:00",
+                           "last_movie_synced_at_id": MOVIE_ID}
+
+    other = State(str(tmp_path / "other.json"))
+    other.set_checkpoints(checkpoints)
+    assert State(str(tmp_path / "other.json")).last_movie_synced_id == state.last_movie_synced_id
+    assert other.get_checkpoints("persons") == {}